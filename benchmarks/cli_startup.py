@@ -0,0 +1,77 @@
+"""
+Measure the startup latency of ``stock`` commands on a temporary stock repository
+and list the modules that take the longest to import for each of them.
+
+    python benchmarks/cli_startup.py --runs 5 --top 10
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+COMMANDS = [["--help"], ["list", "--help"], ["list", "-e"], ["list", "-m"]]
+ENTRYPOINT = "from stockroom.cli import stock; stock()"
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def run(args, cwd, env, importtime=False):
+    cmd = [sys.executable, *(["-X", "importtime"] if importtime else [])]
+    cmd += ["-c", ENTRYPOINT, *args]
+    start = time.perf_counter()
+    res = subprocess.run(
+        cmd,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    elapsed = time.perf_counter() - start
+    if res.returncode != 0:
+        raise RuntimeError(f"stock {' '.join(args)} failed\n{res.stderr}")
+    return elapsed, res.stderr
+
+
+def slowest_imports(stderr, top):
+    # top level imports only, with their cumulative time in microseconds
+    imports = [
+        (int(cumulative), name)
+        for cumulative, indent, name in IMPORT_TIME.findall(stderr)
+        if len(indent) == 1
+    ]
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    root = str(Path(__file__).resolve().parents[1])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    with tempfile.TemporaryDirectory() as path:
+        Path(path, ".git").mkdir()
+        run(["init", "--username", "bench", "--email", "bench@stock.room"], path, env)
+        for command in COMMANDS:
+            # the first run warms up the file system cache and the bytecode cache
+            times = [run(command, path, env)[0] for _ in range(args.runs + 1)][1:]
+            name = "stock " + " ".join(command)
+            print(
+                f"{name:>20}: median {statistics.median(times) * 1000:>7.1f} ms, "
+                f"min {min(times) * 1000:>7.1f} ms"
+            )
+            _, stderr = run(command, path, env, importtime=True)
+            for cumulative, module in slowest_imports(stderr, args.top):
+                print(f"{'':>22}{cumulative / 1000:>7.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
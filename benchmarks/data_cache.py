@@ -0,0 +1,51 @@
+"""
+Compare the cost of reading one sample (µs/sample) from a stock column without a
+cache, with the in-process cache and with the shared memory cache, both warm, on a
+temporary stock repository.
+
+    python benchmarks/data_cache.py --samples 5000 --rounds 3
+"""
+
+import argparse
+import tempfile
+import time
+
+from stockroom import StockRoom
+
+from dataset_throughput import build_repo
+
+
+def per_sample(column, keys, rounds):
+    for key in keys:
+        # warm up the cache, if there is one
+        column[key]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for key in keys:
+            column[key]
+    return (time.perf_counter() - start) / (rounds * len(keys)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    keys = range(args.samples)
+    size = args.samples * 3 * 32 * 32 * 4 * 2
+    with tempfile.TemporaryDirectory() as path:
+        build_repo(path, args.samples, (3, 32, 32))
+        stocks = {
+            "no cache": StockRoom(),
+            "in-process cache": StockRoom(data_cache_size=size),
+            "shared cache": StockRoom(data_cache_size=size, shared_data_cache=True),
+        }
+        for name, stock in stocks.items():
+            cost = per_sample(stock.data["image"], keys, args.rounds)
+            print(f"{name:>18}: {cost:>8.1f} µs/sample")
+            stock.close()
+
+
+if __name__ == "__main__":
+    main()
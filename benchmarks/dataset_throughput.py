@@ -0,0 +1,97 @@
+"""
+Compare the throughput (samples/sec) of hangar's ``make_torch_dataset`` against
+stockroom's native datasets on a temporary stock repository.
+
+    python benchmarks/dataset_throughput.py --samples 20000 --workers 2
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from stockroom import (
+    StockDataset,
+    StockIterableDataset,
+    StockRoom,
+    init_repo,
+    make_torch_dataset,
+)
+from stockroom.utils import clean_create_column
+from torch.utils.data import DataLoader
+
+
+def build_repo(path, num_samples, shape):
+    os.chdir(path)
+    Path(".git").mkdir()
+    init_repo("bench", "bench@stock.room", overwrite=True)
+    stock = StockRoom(enable_write=True)
+    clean_create_column(
+        stock.accessor,
+        [
+            ("add_ndarray_column", {"name": "image", "shape": shape, "dtype": "f4"}),
+            ("add_ndarray_column", {"name": "label", "shape": (), "dtype": "i8"}),
+        ],
+    )
+    rng = np.random.default_rng(0)
+    for start in range(0, num_samples, 1000):
+        keys = range(start, min(start + 1000, num_samples))
+        images = rng.random((len(keys), *shape), dtype=np.float32)
+        stock.data.set_many("image", images, keys=keys)
+        stock.data.set_many("label", rng.integers(0, 10, len(keys)), keys=keys)
+    stock.commit("benchmark data")
+    stock.close()
+
+
+def throughput(loader, num_samples):
+    start = time.perf_counter()
+    count = 0
+    for batch in loader:
+        count += len(batch[0])
+    elapsed = time.perf_counter() - start
+    assert count == num_samples, count
+    return num_samples / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        build_repo(path, args.samples, (3, 32, 32))
+        stock = StockRoom()
+        columns = [stock.data["image"], stock.data["label"]]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            hangar_dataset = make_torch_dataset(columns)
+        loaders = {
+            "hangar make_torch_dataset": DataLoader(
+                hangar_dataset, batch_size=args.batch_size, num_workers=args.workers
+            ),
+            "StockDataset": DataLoader(
+                StockDataset(stock, ["image", "label"]),
+                batch_size=args.batch_size,
+                num_workers=args.workers,
+            ),
+            "StockIterableDataset": DataLoader(
+                StockIterableDataset(
+                    stock, ["image", "label"], batch_size=args.batch_size
+                ),
+                batch_size=None,
+                num_workers=args.workers,
+            ),
+        }
+        for name, loader in loaders.items():
+            print(f"{name:>28}: {throughput(loader, args.samples):>10.0f} samples/sec")
+        stock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,58 @@
-from stockroom.core import StockRoom
-from stockroom.keeper import init_repo
+import importlib
+import sys
 
-__all__ = ["StockRoom", "init_repo", "__version__", "make_torch_dataset"]
+__all__ = [
+    "StockRoom",
+    "init_repo",
+    "__version__",
+    "make_torch_dataset",
+    "StockDataset",
+    "StockIterableDataset",
+]
 
+__version__ = "__version__ = '0.3.0'"
 
-try:
-    from hangar.dataset import make_torch_dataset  # type: ignore
-except ModuleNotFoundError:
-    from hangar import make_torch_dataset
+# hangar, and torch along with it, are imported only when one of these is accessed for
+# the first time. It keeps `import stockroom.cli` (and hence the CLI startup) fast
+_lazy_attrs = {
+    "StockRoom": "stockroom.core",
+    "init_repo": "stockroom.keeper",
+    "StockDataset": "stockroom.dataset",
+    "StockIterableDataset": "stockroom.dataset",
+}
 
 
-__version__ = "__version__ = '0.3.0'"
+def _make_torch_dataset():
+    try:
+        from hangar.dataset import make_torch_dataset  # type: ignore
+    except ModuleNotFoundError:
+        from hangar import make_torch_dataset
+    return make_torch_dataset
+
+
+def __getattr__(name):
+    if name == "make_torch_dataset":
+        value = _make_torch_dataset()
+    elif name in _lazy_attrs:
+        try:
+            value = getattr(importlib.import_module(_lazy_attrs[name]), name)
+        except ModuleNotFoundError as e:
+            if e.name is None or e.name.split(".")[0] != "torch":
+                raise
+            # the datasets need torch, which is an optional dependency
+            raise AttributeError(
+                f"module {__name__} has no attribute {name} (requires torch)"
+            ) from e
+    else:
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    # module level __getattr__ is not supported
+    for _name in list(_lazy_attrs) + ["make_torch_dataset"]:
+        try:
+            globals()[_name] = __getattr__(_name)
+        except AttributeError:
+            pass
@@ -2,15 +2,17 @@ from pathlib import Path
 
 import click
 from click_didyoumean import DYMGroup  # type: ignore
-from hangar import Repository
-from rich.progress import Progress
-from stockroom import __version__, console, external
-from stockroom.core import StockRoom
-from stockroom.keeper import init_repo
-from stockroom.utils import clean_create_column
+from stockroom import __version__
+
+# Commands import what they need (hangar, numpy, rich etc.) when they run, so that
+# `stock --help` or a mistyped command doesn't pay for importing all of them. See
+# benchmarks/cli_startup.py
 
 
 def get_stock_obj(path: Path = Path.cwd(), enable_write=False):
+    from hangar import Repository
+    from stockroom.core import StockRoom
+
     try:
         stock_obj = StockRoom(enable_write=enable_write)
     except RuntimeError:
@@ -58,6 +60,8 @@ def init(username, email, overwrite):
     a stock repository by using `stock import` but in all other case, you'd need to
     initialize a stock repository to start operating on it with the python APIs
     """
+    from stockroom.keeper import init_repo
+
     try:
         init_repo(username, email, overwrite)
     except RuntimeError as e:
@@ -81,13 +85,23 @@ def commit(message):
     1. Make a hangar commit
     2. Update the `head.stock` file (git will track this file if you are using git)
     """
+    from stockroom.core import StockRoom
+    from stockroom.daemon import WriterClient
+
     if len(message) < 1:
         raise click.ClickException(ValueError("Require commit message"))
-    # TODO: There should be a way to share the write enabled checkout if user need to
-    #  commit let's say when he has a writer checkout open in jupyter notebook
-    stock_obj = StockRoom(enable_write=True)
     msg = "\n".join(message)
     click.echo("Commit message:\n" + msg)
+    try:
+        # the writer daemon, if running, has the writer checkout
+        with WriterClient() as client:
+            digest = client.commit(msg)
+    except (ConnectionRefusedError, FileNotFoundError):
+        pass
+    else:
+        click.echo(f"Commit Successful. Digest: {digest}")
+        return
+    stock_obj = StockRoom(enable_write=True)
     try:
         digest = stock_obj.commit(message)
     except (FileNotFoundError, RuntimeError) as e:
@@ -105,6 +119,8 @@ def liberate():
     If another process, that has the writer lock, is writing to the repo, releasing the
     lock leads to an exception in that process. Use it carefully
     """
+    from hangar import Repository
+
     repo = Repository(Path.cwd(), exists=True)
     if repo.force_release_writer_lock():
         click.echo("Writer lock released")
@@ -112,6 +128,31 @@ def liberate():
         click.echo("Error while attempting to release the writer lock")
 
 
+@stock.command()
+@click.option(
+    "--commit-interval",
+    default=30.0,
+    show_default=True,
+    help="Seconds after the first uncommitted write when the writes are committed",
+)
+def serve(commit_interval):
+    """
+    Run the writer daemon of the stock repository in the foreground. The daemon keeps
+    the writer lock and lets multiple processes (see `stockroom.daemon.WriterClient`)
+    write tags, metrics and models concurrently. `stock commit` commits through the
+    daemon while it's running. Stop it with Ctrl+C, pending writes are committed
+    """
+    from stockroom.daemon import WriterDaemon
+
+    daemon = WriterDaemon(commit_interval=commit_interval)
+    click.echo(f"Writer daemon listening at {daemon.socket_path}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    click.echo("Writer daemon stopped")
+
+
 @stock.command(name="list")
 @click.option(
     "--data",
@@ -135,18 +176,16 @@ def list_shelf(data, model, experiment):
     """
     Lists the items in the 3 shelves(Data, Model, Experiment) for the current stock head.
     """
+    from stockroom import console
+
     stock_obj = get_stock_obj()
     console.print_current_head(stock_obj.head)
     if data:
         columns = []
         try:
-            for col in stock_obj.data.keys():
-
-                shape = stock_obj.data[col].shape
-                length = len(stock_obj.data[col])
-                dtype = stock_obj.data[col].dtype
-
-                columns.append((col, length, shape, dtype))
+            # read from the stats manifest, without going through the columns
+            for col, stats in stock_obj.data.stats().items():
+                columns.append((col, stats["count"], stats["shape"], stats["dtype"]))
         except AttributeError:
             pass
         console.print_data_summary(columns)
@@ -181,12 +220,33 @@ def list_shelf(data, model, experiment):
         "to download it to a non-default path, pass it here"
     ),
 )
-def import_data(dataset_name, download_dir):
+@click.option(
+    "--workers",
+    "-w",
+    default=0,
+    type=click.IntRange(min=0),
+    help=(
+        "Number of processes used for decoding and preprocessing the data samples. "
+        "By default, everything runs in the current process"
+    ),
+)
+@click.option(
+    "--chunk-size",
+    default=256,
+    type=click.IntRange(min=1),
+    help="Number of samples processed and written together",
+)
+def import_data(dataset_name, download_dir, workers, chunk_size):
     """
     Downloads and add a pytorch dataset (from torchvision, torchtext or torchaudio)
     to StockRoom. It creates the repo if it doesn't exist and loads the dataset
     into a repo for you
     """
+    import numpy as np
+    from rich.progress import Progress
+    from stockroom import console, external
+    from stockroom.utils import clean_create_column
+
     stock_obj = get_stock_obj(enable_write=True)
 
     # TODO: use the auto-column-creation logic in stockroom later
@@ -223,12 +283,16 @@ def import_data(dataset_name, download_dir):
                     )
             clean_create_column(co, new_col_details)
 
-            columns = [co[name] for name in column_names]
-            for i, data in enumerate(importer):
-                progress.advance(stock_add_bar)
-                for col, dt in zip(columns, data):
-                    # TODO: use the keys from importer
-                    col[i] = dt
+            columns = [stock_obj.data[name] for name in column_names]
+            i = 0
+            for batch in external.iter_chunks(importer, chunk_size, workers):
+                length = len(batch[0])
+                # TODO: use the keys from importer
+                for col, values in zip(columns, batch):
+                    # asarray to get 0-d arrays, not numpy scalars, from 1-d batches
+                    col.update({i + k: np.asarray(v) for k, v in enumerate(values)})
+                i += length
+                progress.advance(stock_add_bar, length)
 
     stock_obj.commit(f"Data from {dataset_name} added through stock import")
     stock_obj.close()
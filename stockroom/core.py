@@ -1,6 +1,8 @@
 import logging
+import threading
 import time
 import warnings
+from concurrent import futures
 from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from typing import Union
@@ -8,7 +10,14 @@ from typing import Union
 from hangar import Repository
 from hangar.checkout import WriterCheckout
 from stockroom.storages import Data, Experiment, Model
-from stockroom.utils import get_current_head, get_stock_root, set_current_head
+from stockroom.storages.cache import SampleCache, SharedSampleCache
+from stockroom.storages.index import ColumnIndex
+from stockroom.utils import (
+    HeadWatcher,
+    get_current_head,
+    get_stock_root,
+    set_current_head,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,74 +34,268 @@ class StockRoom:
 
     An object of this class holds an object to these three storages each has a dictionary
     style access machinery
+
+    Long running readers, such as inference servers, can pass ``auto_refresh=True`` for
+    picking up new commits without restarting. The stock file is then checked, at most
+    once every ``refresh_interval`` seconds, whenever a storage is accessed and the
+    checkout is reopened only if the head has moved. Column handles from
+    ``stock.data[name]``, model views from ``stock.model.open`` and datasets hold on
+    to the checkout they were created from and raise :class:`PermissionError` once
+    it is closed by a refresh. Get them again from the stock object instead of
+    keeping them across requests
+
+    Examples
+    --------
+    >>> stock = StockRoom(auto_refresh=True, refresh_interval=5)
+    >>> while True:
+    ...     request = next(requests)
+    ...     model.load_state_dict(stock.model['resnet'])
     """
 
-    def __init__(self, path: Union[str, Path] = None, enable_write: bool = False):
+    def __init__(
+        self,
+        path: Union[str, Path] = None,
+        enable_write: bool = False,
+        data_cache_size: int = 0,
+        shared_data_cache: bool = False,
+        max_async_commits: int = 2,
+        auto_refresh: bool = False,
+        refresh_interval: float = 1.0,
+    ):
         self.path = Path(path) if path else get_stock_root(Path.cwd())
         self._repo = Repository(self.path)
-        self.head = get_current_head(
-            self.path
-        )  # TODO: should this be None if writer enabled
+        self._head_watcher = HeadWatcher(self.path)
+        # TODO: should this be None if writer enabled
+        self.head = self._head_watcher.head
+        self.auto_refresh = auto_refresh
+        self.refresh_interval = refresh_interval
+        self._last_refresh = time.monotonic()
+        self._stack = ExitStack()
+        # writer kept open across ``enable_write`` sessions, with its index
+        self._write_session = None
+        self._max_async_commits = max_async_commits
+        self._init_commit_state()
         if enable_write:
             self.accessor = self._repo.checkout(write=True)
-        else:
-            if not self.head:
-                self.accessor = None
-            else:
-                self.accessor = self._repo.checkout(commit=self.head)
-        # TODO: Test this extensively
-        if self.accessor is not None:
             with ExitStack() as stack:
                 stack.enter_context(self.accessor)
                 self._stack = stack.pop_all()
+        else:
+            self.accessor = self._open_reader(self.head)
+
+        if not data_cache_size:
+            self._data_cache = None
+        elif shared_data_cache:
+            self._data_cache = SharedSampleCache(data_cache_size)
+        else:
+            self._data_cache = SampleCache(data_cache_size)
+        self._init_storages()
+
+    def _init_commit_state(self):
+        # shared by the storages of the writer and the background commit thread
+        self._write_lock = threading.RLock()
+        self._commit_slots = threading.BoundedSemaphore(self._max_async_commits)
+        self._commit_executor = None
+        self._pending_commits = set()
+
+    def _init_storages(self):
+        self._data = Data(self.accessor, cache=self._data_cache)
+        self._model = Model(self.accessor)
+        self._experiment = Experiment(self.accessor)
+        self._bind_storages(self.accessor)
+
+    @property
+    def data(self) -> Data:
+        self._maybe_refresh()
+        return self._data
+
+    @property
+    def model(self) -> Model:
+        self._maybe_refresh()
+        return self._model
+
+    @property
+    def experiment(self) -> Experiment:
+        self._maybe_refresh()
+        return self._experiment
 
-        self.data = Data(self.accessor)
-        self.model = Model(self.accessor)
-        self.experiment = Experiment(self.accessor)
+    def _maybe_refresh(self):
+        if not self.auto_refresh:
+            return
+        now = time.monotonic()
+        if now - self._last_refresh >= self.refresh_interval:
+            self._last_refresh = now
+            self.update_head()
+
+    def _bind_storages(self, accessor, index=None):
+        """
+        Point the existing storage objects to ``accessor``. ``index`` must be the
+        index of the same checkout if passed and a new one is built otherwise. One
+        index per checkout is shared by all the storages
+        """
+        self.accessor = accessor
+        self.index = ColumnIndex(accessor) if index is None else index
+        lock = self._write_lock if isinstance(accessor, WriterCheckout) else None
+        for storage in (self._data, self._model, self._experiment):
+            storage._bind(accessor, self.index, lock)
+
+    def _open_reader(self, head):
+        if not head:
+            return None
+        reader = self._repo.checkout(commit=head)
+        with ExitStack() as stack:
+            stack.enter_context(reader)
+            self._stack = stack.pop_all()
+        return reader
+
+    def _close_reader(self):
+        self._stack.close()
+        if self.accessor is not None:
+            self.accessor.close()
 
     @contextmanager
-    def enable_write(
-        self, autocommit=True, commit_msg=f"Auto-committing at {time.time()}"
-    ):
+    def enable_write(self, autocommit=True, commit_msg=None, keep_writer=False):
+        """
+        Context manager that makes a read-only stock object writable for the duration
+        of the context. The storages are pointed to a writer checkout and back in
+        place. The read checkout stays open during the session and is reused as is
+        if nothing was committed. Otherwise, a new read checkout is opened at the new
+        head.
+
+        Parameters
+        ----------
+        autocommit : bool
+            Commit the changes, if any, while exiting the context
+        commit_msg : Optional[str]
+            Message for the auto commit. By default, a message with the current time
+        keep_writer : bool
+            Keep the writer checkout open after the context exits so that the next
+            ``enable_write`` doesn't have to check it out again. The writer lock is
+            held until :meth:`StockRoom.close` or until an ``enable_write`` session
+            with ``keep_writer=False`` ends
+
+        Examples
+        --------
+        >>> stock = StockRoom()
+        >>> for epoch in range(epochs):
+        ...     train(model)
+        ...     with stock.enable_write(keep_writer=True):
+        ...         stock.model['resnet'] = model.state_dict()
+        """
         if isinstance(self.accessor, WriterCheckout):
             warnings.warn(
                 "Write access is already enabled. Doing nothing!!", UserWarning
             )
             yield
-        else:
-            self.accessor = self._repo.checkout(write=True)
-            self.data = Data(self.accessor)
-            self.model = Model(self.accessor)
-            self.experiment = Experiment(self.accessor)
+            return
 
-            with self.accessor:
+        reader, reader_index = self.accessor, self.index
+        if self._write_session is not None:
+            writer, writer_index = self._write_session
+            self._write_session = None
+        else:
+            writer, writer_index = self._repo.checkout(write=True), None
+        self._bind_storages(writer, writer_index)
+        try:
+            with writer:
                 yield
-            if autocommit and self.accessor.diff.status() != "CLEAN":
-                self.commit(commit_msg)
-            self.accessor.close()
+                self._experiment.flush()
+            if autocommit and writer.diff.status() != "CLEAN":
+                if commit_msg is None:
+                    commit_msg = f"Auto-committing at {time.time()}"
+                self.commit(commit_msg, update_head=False)
+        finally:
+            self.wait_commits()
+            if keep_writer:
+                self._write_session = (writer, self.index)
+            else:
+                writer.close()
+            self._restore_reader(reader, reader_index)
 
-            # TODO: these objects doesn't need to recreate no column creation inside the CM.
-            #   Find a way to track that
-            self.accessor = self._repo.checkout()
-            self.data = Data(self.accessor)
-            self.model = Model(self.accessor)
-            self.experiment = Experiment(self.accessor)
+    def _restore_reader(self, reader, index):
+        head = get_current_head(self.path)
+        if reader is not None and reader.commit_hash == head:
+            self._bind_storages(reader, index)
+            return
+        self.accessor = reader
+        self._close_reader()
+        self._bind_storages(self._open_reader(head))
+        if self._data_cache is not None:
+            self._data_cache.clear()
+        self.head = head
 
-    def update_head(self):
-        if self._repo.writer_lock_held:
+    def declare_model(
+        self, name, spec, packed=False, dedup=False, backend=None, store_dtype=None
+    ):
+        """
+        Create the columns for saving the model ``name``, for the experiment tags and
+        metrics and for the stats manifest of the data storage up front, in one go.
+        Saving the model (as long as it fits in the declared columns), writing tags,
+        logging metrics and committing will then never have to leave and re-enter the
+        checkout context for creating columns. See
+        :meth:`stockroom.storages.Model.declare` for the parameters
+
+        Examples
+        --------
+        >>> stock = StockRoom(enable_write=True)
+        >>> stock.declare_model('resnet', model.state_dict())
+        >>> for epoch in range(epochs):
+        ...     stock.model['resnet'] = model.state_dict()
+        ...     stock.experiment.log(epoch, loss=loss)
+        """
+        col_args = self._model._declaration_args(
+            name, spec, packed, dedup, backend, store_dtype
+        )
+        col_args += self._experiment._declaration_args()
+        col_args += self._data._stats_column_args()
+        self.index.create_columns(col_args)
+
+    def update_head(self) -> bool:
+        """
+        Move the read checkout to the current head of the repository. The stock file
+        is read only if it was modified and the checkout is reopened only if the head
+        has moved, so calling this often (or using ``auto_refresh``) is cheap. The old
+        checkout is closed and handles obtained from it, such as columns and model
+        views, raise :class:`PermissionError` afterwards
+
+        Returns
+        -------
+        bool
+            Whether the checkout was moved to a new head
+        """
+        if isinstance(self.accessor, WriterCheckout):
             logger.info(
                 "Write enabled checkouts will always be on the latest head "
                 "(staging). Doing nothing"
             )
-            return
-        self.head = get_current_head(self.path)
-        self.accessor.__exit__()
-        self.accessor.close()
-        self.accessor = self._repo.checkout(commit=self.head).__enter__()
+            return False
+        head = self._head_watcher.poll()
+        if head == self.head and (self.accessor is not None or not head):
+            return False
+        self._close_reader()
+        self._bind_storages(self._open_reader(head))
+        if self._data_cache is not None:
+            self._data_cache.clear()
+        self.head = head
+        return True
 
     def close(self):
-        self._stack.close()
-        self.accessor.close()
+        try:
+            self.wait_commits()
+            if self._commit_executor is not None:
+                self._commit_executor.shutdown()
+                self._commit_executor = None
+            self._experiment.flush()
+        finally:
+            # checkouts are released even if the pending writes failed
+            self._stack.close()
+            if self.accessor is not None:
+                self.accessor.close()
+            if self._write_session is not None:
+                self._write_session[0].close()
+                self._write_session = None
+            if isinstance(self._data_cache, SharedSampleCache):
+                self._data_cache.close()
 
     @property
     def stockroot(self) -> Path:
@@ -108,13 +311,142 @@ class StockRoom:
         close after the commit. Which means, no other write operations should be running
         while stock commit is in progress
         """
-        digest = self.accessor.commit(message)
-        set_current_head(self.stockroot, digest)
+        self.wait_commits()
+        self._experiment.flush()
+        digest = self._commit(self.accessor, message)
         if update_head:
             self.update_head()
         return digest
 
+    def _commit(self, writer, message):
+        with self._write_lock:
+            self._data._update_stats()
+            digest = writer.commit(message)
+            set_current_head(self.stockroot, digest)
+        return digest
+
+    def commit_async(self, message, models=None, tags=None, save_kwargs=None):
+        """
+        Make a stock commit in a background thread, so that the training loop
+        doesn't have to wait for the weights to be hashed and written to the disk.
+        The models and tags passed are copied right away, along with the metrics
+        logged so far, and the rest of the work is done in the background. Commits
+        are made one after the other in the order they were requested. If
+        ``max_async_commits`` (argument of :class:`StockRoom`) commits are already in
+        flight, this blocks until one of them is done.
+
+        Note
+        ----
+        The storage methods, such as :meth:`stockroom.storages.Model.save` or
+        :meth:`stockroom.storages.Experiment.update`, and hence also
+        :meth:`stockroom.storages.Experiment.log` when it flushes its buffer, block
+        while an in flight commit writes to the checkout and commits. So do data
+        writes through ``stock.data`` and the columns it returns. Converting and
+        hashing the weights is done before that and doesn't block them. Writes made
+        directly on the hangar checkout (``stock.accessor``) are not synchronized,
+        call :meth:`StockRoom.wait_commits` before making them. Failed commits raise
+        from the returned future and are logged
+
+        Parameters
+        ----------
+        message : str
+            Commit message
+        models : Optional[dict]
+            Model names to the weights (``state_dict`` or the output of
+            ``get_weights``) to save in this commit
+        tags : Optional[dict]
+            Experiment tags to write in this commit
+        save_kwargs : Optional[dict]
+            Keyword arguments for :meth:`stockroom.storages.Model.save`
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future that holds the commit digest once the commit is done
+
+        Examples
+        --------
+        >>> stock = StockRoom(enable_write=True)
+        >>> for epoch in range(epochs):
+        ...     loss = train(model)
+        ...     stock.experiment.log(epoch, loss=loss)
+        ...     stock.commit_async(f'epoch {epoch}', models={'resnet': model.state_dict()})
+        >>> stock.wait_commits()
+        """
+        if not isinstance(self.accessor, WriterCheckout):
+            raise PermissionError("Commits require a write enabled stock object")
+        models = {k: self._model._snapshot(v) for k, v in (models or {}).items()}
+        tags = dict(tags or {})
+        for value in tags.values():
+            # invalid tags must fail here and not in the background
+            self._experiment._value_type(value)
+        metrics = self._experiment._take_buffer()
+
+        self._commit_slots.acquire()
+        try:
+            if self._commit_executor is None:
+                self._commit_executor = futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="stockroom-commit"
+                )
+            future = self._commit_executor.submit(
+                self._commit_job,
+                self.accessor,
+                message,
+                models,
+                tags,
+                metrics,
+                save_kwargs or {},
+            )
+        except BaseException:
+            self._commit_slots.release()
+            raise
+        self._pending_commits.add(future)
+        future.add_done_callback(self._commit_done)
+        return future
+
+    def _commit_job(self, writer, message, models, tags, metrics, save_kwargs):
+        # the layers are converted and hashed before taking the lock, the storages
+        # wait only for the checkout writes and the commit
+        writes = [
+            self._model._prepare_save(name, weights, **save_kwargs)
+            for name, weights in models.items()
+        ]
+        with self._write_lock:
+            for write in writes:
+                write()
+            if tags:
+                self._experiment.update(tags)
+            if metrics:
+                self._experiment._write_series(metrics)
+            return self._commit(writer, message)
+
+    def _commit_done(self, future):
+        self._pending_commits.discard(future)
+        self._commit_slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            # callers are not required to keep the future around
+            logger.error("Asynchronous commit failed", exc_info=future.exception())
+
+    def wait_commits(self):
+        """
+        Block until all the commits made with :meth:`StockRoom.commit_async` are done
+        """
+        futures.wait(list(self._pending_commits))
+
     def __getstate__(self):
-        if isinstance(self.accessor, WriterCheckout):
+        if isinstance(self.accessor, WriterCheckout) or self._write_session:
             raise RuntimeError("Write enabled instance is not pickle-able")
-        return self.__dict__
+        state = self.__dict__.copy()
+        # recreated by ``__setstate__``
+        for key in (
+            "_write_lock",
+            "_commit_slots",
+            "_commit_executor",
+            "_pending_commits",
+        ):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_commit_state()
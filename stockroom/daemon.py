@@ -0,0 +1,328 @@
+import logging
+import numbers
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+import numpy as np
+from stockroom.core import StockRoom
+from stockroom.storages import Experiment
+from stockroom.storages.model import _to_numpy, _to_tensor
+from stockroom.utils import get_stock_root, staged_status
+
+logger = logging.getLogger(__name__)
+
+
+def daemon_paths(root):
+    """
+    Location of the unix socket the writer daemon of the stock repository at ``root``
+    listens on and of the file that has the key clients authenticate with
+    """
+    hangar_dir = Path(root) / ".hangar"
+    return hangar_dir / "stockroom.sock", hangar_dir / "stockroom.key"
+
+
+class WriterDaemon:
+    """
+    Local service that owns the writer checkout of a stock repository and lets any
+    number of processes, such as the ranks of a distributed training job or multiple
+    notebooks, write tags, metrics and models to the repository concurrently.
+    Clients (see :class:`WriterClient`) connect over a unix socket and submit batches
+    of writes. All the writes are applied by one thread, in the order they arrive,
+    and are coalesced into a commit every ``commit_interval`` seconds or whenever a
+    client asks for a commit. Unix sockets are required and hence the daemon is not
+    available on Windows.
+
+    Parameters
+    ----------
+    path : Optional[Union[str, Path]]
+        Root of the stock repository. By default, the one the current working
+        directory is in
+    commit_interval : Optional[float]
+        Seconds after the first uncommitted write when all the writes so far are
+        committed. Set it to None for committing only when clients ask for it
+    max_pending : int
+        Maximum number of batches waiting to be applied. Clients block when the
+        daemon falls behind by this much
+
+    Examples
+    --------
+    From the command line, ``stock serve`` runs the daemon in the foreground
+
+    >>> daemon = WriterDaemon(commit_interval=60)
+    >>> daemon.serve_forever()
+    """
+
+    def __init__(self, path=None, commit_interval=30.0, max_pending=64):
+        if sys.platform == "win32":
+            raise RuntimeError(
+                "The writer daemon listens on a unix socket and hence is not "
+                "supported on Windows"
+            )
+        self.stock = StockRoom(path, enable_write=True)
+        self.socket_path, self.key_path = daemon_paths(self.stock.path)
+        self.commit_interval = commit_interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._listener = None
+        self._dirty = False
+        self._batches = 0
+        self._stopped = threading.Event()
+        self.ready = threading.Event()
+
+    def serve_forever(self):
+        """
+        Accept clients until :meth:`WriterDaemon.shutdown` is called. Uncommitted
+        writes are committed before returning
+        """
+        authkey = secrets.token_bytes(32)
+        # a leftover from a daemon that died, the writer lock proves it's not running
+        for path in (self.socket_path, self.key_path):
+            if path.exists():
+                path.unlink()
+        fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(authkey)
+        self._listener = Listener(str(self.socket_path), "AF_UNIX", authkey=authkey)
+        writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        writer_thread.start()
+        self.ready.set()
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except Exception:
+                    logger.exception("Rejected a client")
+                    continue
+                if self._stopped.is_set():
+                    conn.close()
+                    break
+                threading.Thread(
+                    target=self._serve_client, args=(conn,), daemon=True
+                ).start()
+        finally:
+            self._stopped.set()
+            self._listener.close()
+            self._queue.put(("stop", None, None))
+            writer_thread.join()
+            for path in (self.socket_path, self.key_path):
+                if path.exists():
+                    path.unlink()
+            self.stock.close()
+
+    def shutdown(self):
+        """
+        Stop accepting clients and make :meth:`WriterDaemon.serve_forever` return
+        """
+        self._stopped.set()
+        # closing the listener doesn't wake up a blocked accept, a connection does
+        with Client(
+            str(self.socket_path), "AF_UNIX", authkey=self.key_path.read_bytes()
+        ):
+            pass
+
+    def _serve_client(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, payload = conn.recv()
+                except (EOFError, OSError):
+                    return
+                done = Future()
+                self._queue.put((op, payload, done))
+                try:
+                    conn.send(("ok", done.result()))
+                except Exception as e:
+                    # the exception itself might not be picklable
+                    conn.send(("error", (type(e).__name__, str(e))))
+
+    def _write_loop(self):
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                op, payload, done = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                op, payload, done = "commit", None, None
+            try:
+                if op == "write":
+                    result = self._apply(payload)
+                    if deadline is None and self.commit_interval is not None:
+                        deadline = time.monotonic() + self.commit_interval
+                elif op in ("commit", "stop"):
+                    result = self._commit(payload)
+                    deadline = None
+                else:
+                    raise ValueError(f"Unknown operation {op}")
+            except Exception as e:
+                if done is None:
+                    logger.exception("Periodic commit failed")
+                else:
+                    done.set_exception(e)
+            else:
+                if done is not None:
+                    done.set_result(result)
+            if op == "stop":
+                return
+
+    def _apply(self, payload):
+        stock = self.stock
+        # set first, a batch that fails halfway leaves its first writes staged
+        self._dirty = True
+        if payload.get("tags"):
+            stock.experiment.update(payload["tags"])
+        if payload.get("metrics"):
+            stock.experiment._write_series(payload["metrics"])
+        for name, (library, weights, save_kwargs) in payload.get("models", {}).items():
+            if library == "torch":
+                weights = {k: _to_tensor(*v) for k, v in weights.items()}
+            stock.model.save(name, weights, **save_kwargs)
+        self._batches += 1
+
+    def _commit(self, message):
+        """
+        Commit everything written so far. Clients that ask for a commit when there is
+        nothing new get the digest of the last commit
+        """
+        if not self._dirty or staged_status(self.stock.accessor) == "CLEAN":
+            # batches that failed before writing anything leave nothing to commit
+            self._dirty = False
+            return self.stock.head
+        if message is None:
+            message = f"Auto-committing {self._batches} batches at {time.time()}"
+        digest = self.stock.commit(message)
+        self.stock.head = digest
+        self._dirty = False
+        self._batches = 0
+        return digest
+
+
+class WriterClient:
+    """
+    Client of a :class:`WriterDaemon`. Tags and metrics are collected locally and
+    sent as one batch on :meth:`WriterClient.flush`, when ``log_buffer_size``
+    metrics are collected, or before a commit. Models are sent right away. Values of
+    an invalid type are rejected right away. Errors the daemon runs into while
+    applying a batch are raised as :class:`RuntimeError` by the call that sent it.
+
+    Parameters
+    ----------
+    path : Optional[Union[str, Path]]
+        Root of the stock repository. By default, the one the current working
+        directory is in
+    log_buffer_size : int
+        Number of metric values collected before they are sent to the daemon
+
+    Examples
+    --------
+    >>> with WriterClient() as client:
+    ...     client.update({'lr': 0.01, 'rank': rank})
+    ...     for step in range(steps):
+    ...         client.log(step, loss=loss)
+    ...     client.save_model(f'resnet-{rank}', model.state_dict())
+    ...     digest = client.commit('finished training')
+    """
+
+    def __init__(self, path=None, log_buffer_size=256):
+        root = Path(path) if path else get_stock_root(Path.cwd())
+        socket_path, key_path = daemon_paths(root)
+        try:
+            authkey = key_path.read_bytes()
+        except FileNotFoundError:
+            raise ConnectionRefusedError(f"No writer daemon is running at {root}")
+        self._conn = Client(str(socket_path), "AF_UNIX", authkey=authkey)
+        self.log_buffer_size = log_buffer_size
+        self._tags = {}
+        self._metrics = {}
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, op, payload):
+        self._conn.send((op, payload))
+        status, result = self._conn.recv()
+        if status == "error":
+            name, message = result
+            raise RuntimeError(f"Writer daemon failed with {name}: {message}")
+        return result
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, mapping):
+        """
+        Collect experiment tags, see :meth:`stockroom.storages.Experiment.update`
+        """
+        for value in mapping.values():
+            Experiment._value_type(value)
+        self._tags.update(mapping)
+
+    def log(self, step, **metrics):
+        """
+        Collect the metrics of a training step, see
+        :meth:`stockroom.storages.Experiment.log`
+        """
+        for name, value in metrics.items():
+            if not isinstance(value, numbers.Real):
+                raise TypeError(f"Metric {name} is not a real number")
+        for name, value in metrics.items():
+            self._metrics.setdefault(name, []).append((step, value))
+        self._buffered += len(metrics)
+        if self._buffered >= self.log_buffer_size:
+            self.flush()
+
+    def save_model(self, name, weights, **save_kwargs):
+        """
+        Send the weights of a model along with the tags and metrics collected so far.
+        ``save_kwargs`` are passed to :meth:`stockroom.storages.Model.save`
+        """
+        if isinstance(weights, dict):
+            library = "torch"
+            # arrays along with the dtype names, which keeps bfloat16 layers intact
+            weights = {k: _to_numpy(v.detach().cpu()) for k, v in weights.items()}
+        elif isinstance(weights, list):
+            library = "tf"
+            weights = [np.asarray(w) for w in weights]
+        else:
+            raise TypeError("Unknown type. Weights has to be a dict or list")
+        self._send({name: (library, weights, save_kwargs)})
+
+    def flush(self):
+        """
+        Send the tags and metrics collected so far
+        """
+        if self._tags or self._metrics:
+            self._send({})
+
+    def _send(self, models):
+        payload = {"tags": self._tags, "metrics": self._metrics, "models": models}
+        self._request("write", payload)
+        # kept for the next send if the daemon failed to apply them
+        self._tags, self._metrics, self._buffered = {}, {}, 0
+
+    def commit(self, message=None):
+        """
+        Commit everything the daemon has received so far from all the clients
+
+        Returns
+        -------
+        str
+            Commit digest
+        """
+        self.flush()
+        return self._request("commit", message)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._conn.close()
@@ -0,0 +1,215 @@
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+from stockroom.storages.data import read_samples
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+
+def _torch_dtype(dtype):
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def _to_tensor(array):
+    # samples from the data cache are shared and hence read-only
+    return torch.from_numpy(array) if array.flags.writeable else torch.tensor(array)
+
+
+class StockDataset(Dataset):
+    """
+    Map style torch dataset over one or more data columns of the commit a
+    :class:`stockroom.StockRoom` object is checked out to. Each item is a tuple with
+    one tensor per column. DataLoaders (torch>=1.13) that support
+    ``__getitems__`` fetch a whole batch of keys in one go, grouped by the backend
+    file each sample is stored in, instead of one key at a time. Samples are read
+    through the data cache of the stock object, if it has one (see
+    :class:`stockroom.storages.Data`).
+
+    Parameters
+    ----------
+    stock : :class:`stockroom.StockRoom`
+        Stock object, the dataset is bound to its current head
+    columns : Sequence[str]
+        Names of the data columns. All the columns must have the same keys
+    keys : Optional[Sequence[Union[str, int]]]
+        Sample keys to use. By default, all the keys of the first column
+
+    Examples
+    --------
+    >>> stock = StockRoom()
+    >>> dataset = StockDataset(stock, ['cifar10-train-image', 'cifar10-train-label'])
+    >>> loader = DataLoader(dataset, batch_size=32, shuffle=True, num_workers=4)
+    """
+
+    def __init__(self, stock, columns, keys=None):
+        self.columns = [stock.data[name] for name in columns]
+        self.keys = list(self.columns[0].keys()) if keys is None else list(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        key = self.keys[index]
+        return tuple(_to_tensor(col[key]) for col in self.columns)
+
+    def __getitems__(self, indices):
+        keys = [self.keys[i] for i in indices]
+        batches = [read_samples(col, keys) for col in self.columns]
+        return [
+            tuple(torch.from_numpy(batch[i, ...]) for batch in batches)
+            for i in range(len(keys))
+        ]
+
+
+class StockIterableDataset(IterableDataset):
+    """
+    Iterable torch dataset that yields ready made batches from one or more data
+    columns of the commit a :class:`stockroom.StockRoom` object is checked out to.
+    Use it with ``DataLoader(dataset, batch_size=None)``.
+
+    - Each batch is read with one grouped read per column (see
+      :func:`stockroom.storages.data.read_samples`), through the data cache of
+      the stock object if it has one
+    - Batches are sharded across dataloader workers so that each worker reads a
+      disjoint set of keys
+    - A background thread in each worker keeps ``prefetch`` batches ready
+    - With ``pin_memory=True``, batches of fixed shape columns are read directly
+      into page-locked tensors (requires CUDA) and can be moved to the GPU with
+      ``non_blocking=True``
+
+    Parameters
+    ----------
+    stock : :class:`stockroom.StockRoom`
+        Stock object, the dataset is bound to its current head
+    columns : Sequence[str]
+        Names of the data columns. All the columns must have the same keys
+    batch_size : int
+        Number of samples in each batch
+    keys : Optional[Sequence[Union[str, int]]]
+        Sample keys to use. By default, all the keys of the first column
+    shuffle : bool
+        Shuffle the keys on every epoch. Call :meth:`set_epoch` for a new order
+    drop_last : bool
+        Drop the last batch if it is smaller than ``batch_size``
+    prefetch : int
+        Number of batches read ahead of time by each worker
+    pin_memory : bool
+        Read the batches into pinned memory
+    seed : int
+        Seed for shuffling
+
+    Examples
+    --------
+    >>> stock = StockRoom()
+    >>> dataset = StockIterableDataset(stock, ['image', 'label'], batch_size=64)
+    >>> loader = DataLoader(dataset, batch_size=None, num_workers=4)
+    >>> for images, labels in loader:
+    ...     train(images, labels)
+    """
+
+    def __init__(
+        self,
+        stock,
+        columns,
+        batch_size,
+        keys=None,
+        shuffle=False,
+        drop_last=False,
+        prefetch=2,
+        pin_memory=False,
+        seed=0,
+    ):
+        self.columns = [stock.data[name] for name in columns]
+        self.keys = list(self.columns[0].keys()) if keys is None else list(keys)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.keys) // self.batch_size
+        return -(-len(self.keys) // self.batch_size)
+
+    def _batch_keys(self):
+        keys = self.keys
+        if self.shuffle:
+            keys = keys.copy()
+            random.Random(self.seed + self.epoch).shuffle(keys)
+        batches = [
+            keys[i : i + self.batch_size] for i in range(0, len(keys), self.batch_size)
+        ]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        worker = get_worker_info()
+        if worker is not None:
+            batches = batches[worker.id :: worker.num_workers]
+        return batches
+
+    def _read_column(self, col, keys):
+        if self.pin_memory and col.schema_type == "fixed_shape":
+            out = torch.empty(
+                (len(keys), *col.shape),
+                dtype=_torch_dtype(col.dtype),
+                pin_memory=True,
+            )
+            read_samples(col, keys, out=out.numpy())
+            return out
+        out = torch.from_numpy(read_samples(col, keys))
+        return out.pin_memory() if self.pin_memory else out
+
+    def _read_batch(self, keys):
+        return tuple(self._read_column(col, keys) for col in self.columns)
+
+    @staticmethod
+    def _put(out_queue, item, stop):
+        # gives up once the consumer is gone so that the thread can always finish
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producer(self, batches, out_queue, stop):
+        try:
+            for keys in batches:
+                if not self._put(out_queue, self._read_batch(keys), stop):
+                    return
+        except Exception as e:
+            self._put(out_queue, e, stop)
+            return
+        self._put(out_queue, None, stop)
+
+    def __iter__(self):
+        batches = self._batch_keys()
+        if self.prefetch < 1:
+            for keys in batches:
+                yield self._read_batch(keys)
+            return
+        out_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._producer, args=(batches, out_queue, stop), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                batch = out_queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -1 +1 @@
-from stockroom.external.importer import get_importers
+from stockroom.external.importer import get_importers, iter_chunks
@@ -1,2 +1,2 @@
 from stockroom.external.importer.base import BaseImporter
-from stockroom.external.importer.utils import get_importers
+from stockroom.external.importer.utils import get_importers, iter_chunks
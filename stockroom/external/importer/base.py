@@ -66,6 +66,38 @@ class BaseImporter(abc.ABC):
         """
         pass
 
+    def get_batch(self, start, stop):
+        """
+        Return the data samples from index ``start`` to ``stop`` as a tuple with one
+        sequence per data entity. For instance, if the data sample is image and label,
+        this function should return `(images, labels)`. Importers that can convert
+        a batch at once should override this and return stacked arrays.
+
+        The default implementation requires ``__getitem__`` which returns the data
+        sample at an index in the same format as ``__iter__``. Importers implementing
+        it are processed in parallel if ``stock import`` is invoked with ``--workers``
+        """
+        samples = [self[i] for i in range(start, stop)]  # type: ignore
+        return tuple(zip(*samples))
+
+    def iter_batches(self, batch_size):
+        """
+        Yield batches of at most ``batch_size`` data samples in the format of
+        :meth:`get_batch`
+        """
+        if hasattr(type(self), "__getitem__"):
+            for start in range(0, len(self), batch_size):
+                yield self.get_batch(start, min(start + batch_size, len(self)))
+            return
+        batch = []
+        for sample in self:
+            batch.append(sample)
+            if len(batch) == batch_size:
+                yield tuple(zip(*batch))
+                batch = []
+        if batch:
+            yield tuple(zip(*batch))
+
     @abc.abstractmethod
     def __len__(self):
         """
@@ -23,17 +23,43 @@ class TorchvisionCommon(BaseImporter):
         return self.sample_img.dtype, self.sample_label.dtype
 
     @staticmethod
-    def _process_data(img, lbl):
-        # TODO: memory copy
-        img = np.array(img)
-        img = img.astype(np.float32) / 255
+    def _normalize(img):
+        # single allocation: uint8 -> float32 conversion and the division in one pass
+        out = np.empty(img.shape, dtype=np.float32)
+        np.divide(img, np.float32(255), out=out)
+        return out
+
+    @classmethod
+    def _process_data(cls, img, lbl):
+        img = cls._normalize(np.asarray(img))
         lbl = np.array(lbl)
         return img, lbl
 
+    @classmethod
+    def _process_batch(cls, imgs, lbls):
+        return cls._normalize(imgs), lbls
+
     def __iter__(self):
         for img, label in self.dataset:
             yield self._process_data(img, label)
 
+    def __getitem__(self, index):
+        return self._process_data(*self.dataset[index])
+
+    def get_batch(self, start, stop):
+        """
+        Returns the processed samples from ``start`` to ``stop`` as stacked arrays.
+        Torchvision datasets that keep the whole dataset in memory (``data`` and
+        ``targets`` attributes) are converted as one slab instead of sample by sample
+        """
+        data = getattr(self.dataset, "data", None)
+        targets = getattr(self.dataset, "targets", None)
+        if data is None or targets is None:
+            return super().get_batch(start, stop)
+        return self._process_batch(
+            np.asarray(data[start:stop]), np.asarray(targets[start:stop])
+        )
+
     def variability_status(self):
         return False, False
 
@@ -56,14 +82,16 @@ class Cifar10(TorchvisionCommon):
     def gen_splits(cls, root):
         return super().gen_splits(datasets.CIFAR10, root)
 
-    @staticmethod
-    def _process_data(img, lbl):
-        img = np.transpose(np.array(img), (2, 0, 1))
-        img = np.ascontiguousarray(img)
-        img = img.astype(np.float32) / 255
+    @classmethod
+    def _process_data(cls, img, lbl):
+        img = cls._normalize(np.transpose(np.asarray(img), (2, 0, 1)))
         lbl = np.array(lbl)
         return img, lbl
 
+    @classmethod
+    def _process_batch(cls, imgs, lbls):
+        return cls._normalize(np.transpose(imgs, (0, 3, 1, 2))), lbls
+
 
 class Mnist(TorchvisionCommon):
     name = "mnist"
@@ -1,7 +1,13 @@
+import importlib
 import inspect
+import multiprocessing
+import sys
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
 
-from stockroom.external.importer import torchvision_importers
 from stockroom.external.importer.base import BaseImporter
 
 
@@ -9,11 +15,53 @@ def is_valid(x):
     return inspect.isclass(x) and issubclass(x, BaseImporter) and x != BaseImporter
 
 
-importers_dict = {
-    "torchvision": {
-        cls.name: cls for _, cls in inspect.getmembers(torchvision_importers, is_valid)
-    }
-}
+class ImporterRegistry(Mapping):
+    """
+    Importers by package name (the part before the dot in ``stock import
+    <package>.<dataset>``) and dataset name. Only the module of each package is
+    registered up front. The module, and whatever heavy library it depends on such
+    as torchvision, is imported and its importers are discovered on first access of
+    the package.
+
+    Examples
+    --------
+    >>> importers_dict.register("mylib", "mypackage.importers")
+    >>> importers_dict["mylib"]["mydataset"].gen_splits(download_dir)
+    """
+
+    def __init__(self, modules):
+        self._modules = dict(modules)
+        self._importers = {}
+
+    def register(self, package, module):
+        """
+        Register the importers of ``package``, found in the module with the dotted
+        path ``module``
+        """
+        self._modules[package] = module
+        self._importers.pop(package, None)
+
+    def __getitem__(self, package):
+        if package not in self._importers:
+            module = importlib.import_module(self._modules[package])
+            self._importers[package] = {
+                cls.name: cls for _, cls in inspect.getmembers(module, is_valid)
+            }
+        return self._importers[package]
+
+    def __contains__(self, package):
+        return package in self._modules
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+
+importers_dict = ImporterRegistry(
+    {"torchvision": "stockroom.external.importer.torchvision_importers"}
+)
 
 
 def get_importers(source: str, download_dir: Path):
@@ -29,3 +77,64 @@ def get_importers(source: str, download_dir: Path):
             "Could not fetch the dataset you were looking for. "
             "Create a request for new importers"
         )
+
+
+# importer instance of the current worker process, set by the pool initializer
+# or, on python 3.6, inherited from the parent process by forking
+_worker_importer = None
+_POOL_INITIALIZER = sys.version_info >= (3, 7)
+
+
+def _init_worker(importer: BaseImporter):
+    global _worker_importer
+    _worker_importer = importer
+
+
+def _process_chunk(start: int, stop: int):
+    return _worker_importer.get_batch(start, stop)
+
+
+def iter_chunks(importer: BaseImporter, chunk_size: int, workers: int = 0):
+    """
+    Yield the data from the importer in order, as batches of ``chunk_size`` samples
+    (see :meth:`BaseImporter.get_batch` for the format). If ``workers`` is more than
+    zero and the importer supports random access (i.e. implements ``__getitem__``),
+    chunks are decoded and processed in a pool of ``workers`` processes. At most
+    ``2 * workers`` chunks are in flight at a time so that the memory stays bounded
+    even if the consumer is slower than the workers.
+
+    Note
+    ----
+    ``ProcessPoolExecutor`` has no initializer on python 3.6 and hence the workers
+    get the importer by forking. Chunks are processed serially if processes are
+    not started by forking there
+    """
+    if (
+        workers < 1
+        or not hasattr(type(importer), "__getitem__")
+        or not (_POOL_INITIALIZER or multiprocessing.get_start_method() == "fork")
+    ):
+        yield from importer.iter_batches(chunk_size)
+        return
+
+    total = len(importer)
+    bounds = ((i, min(i + chunk_size, total)) for i in range(0, total, chunk_size))
+    if _POOL_INITIALIZER:
+        pool = ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(importer,)
+        )
+    else:
+        _init_worker(importer)
+        pool = ProcessPoolExecutor(workers)
+    try:
+        with pool:
+            pending = deque(
+                pool.submit(_process_chunk, *b) for b in islice(bounds, 2 * workers)
+            )
+            while pending:
+                chunk = pending.popleft().result()
+                for b in islice(bounds, 1):
+                    pending.append(pool.submit(_process_chunk, *b))
+                yield chunk
+    finally:
+        _init_worker(None)
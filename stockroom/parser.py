@@ -1,3 +1,5 @@
+import json
+
 SEP = "--_"
 PREFIX = "_STK"
 
@@ -11,14 +13,54 @@ def model_metakey(name):
     return f"{PREFIX}M{SEP}{name}{SEP}meta"
 
 
-def modelkey(name, longest, dtype):
+def modelkey(name, dtype):
+    return f"{PREFIX}M{SEP}{name}{SEP}{dtype}"
+
+
+def model_packedkey(name, dtype):
+    return f"{PREFIX}M{SEP}{name}{SEP}packed{SEP}{dtype}"
+
+
+def model_registrykey():
+    return f"{PREFIX}{SEP}models"
+
+
+# Older versions of stockroom kept the length of the longest layer in the column names
+def legacy_modelkey(name, longest, dtype):
     return f"{PREFIX}M{SEP}{name}{SEP}{longest}{SEP}{dtype}"
 
 
-def model_shapekey(name, longest):
+def legacy_model_shapekey(name, longest):
     return f"{PREFIX}M{SEP}{name}{SEP}{longest}{SEP}shape"
 
 
+def model_layerkey(dtype):
+    # content addressed layer store shared by all the models
+    return f"{PREFIX}L{SEP}{dtype}"
+
+
+# ===================================================================
+#                         Column namespaces
+# ===================================================================
+
+
+def column_kind(name):
+    """
+    Kind of the storage a column belongs to and the owner of the column within that
+    storage, e.g. ``("model", model_name)`` for model columns or ``("data", name)``
+    for user data columns
+    """
+    if name.startswith(f"{PREFIX}M{SEP}"):
+        return "model", name.split(SEP)[1]
+    if name.startswith(f"{PREFIX}L{SEP}"):
+        return "layer", None
+    if name in (tagkey(), tag_typekey()) or name.startswith(f"{PREFIX}E{SEP}"):
+        return "experiment", None
+    if name.startswith(PREFIX):
+        return "internal", None
+    return "data", name
+
+
 # ===================================================================
 #                      Metadata Value parsers
 # ===================================================================
@@ -32,6 +74,36 @@ def destringify(string):
     return string.split(",") if string else ""
 
 
+def stringify_shapes(shapes):
+    # dimensions are space separated, layers are comma separated. Scalars
+    # become empty strings and hence the layer count must be known while parsing
+    return ",".join(" ".join(str(dim) for dim in shape) for shape in shapes)
+
+
+def destringify_shapes(string, num_layers):
+    if num_layers == 0:
+        return []
+    return [tuple(int(dim) for dim in shape.split()) for shape in string.split(",")]
+
+
+def stringify_scales(scales):
+    # quantization scales of each channel are space separated, layers are comma
+    # separated. Layers that are not quantized have empty strings
+    return ",".join(
+        "" if layer is None else " ".join(repr(float(x)) for x in layer)
+        for layer in scales
+    )
+
+
+def destringify_scales(string, num_layers):
+    if num_layers == 0:
+        return []
+    return [
+        [float(x) for x in layer.split()] if layer else None
+        for layer in string.split(",")
+    ]
+
+
 # ===================================================================
 #                            Tag keys
 # ===================================================================
@@ -43,3 +115,48 @@ def tagkey():
 
 def tag_typekey():
     return f"{PREFIX}{SEP}tag{SEP}type"
+
+
+# ===================================================================
+#                       Metric time series keys
+# ===================================================================
+
+
+def metric_serieskey():
+    return f"{PREFIX}E{SEP}series"
+
+
+def metric_metakey():
+    return f"{PREFIX}E{SEP}series{SEP}meta"
+
+
+def metric_chunkkey(name, chunk):
+    return f"{name}{SEP}{chunk}"
+
+
+def stringify_chunks(chunks):
+    # first step, last step and number of rows of each chunk of a metric
+    return ",".join(f"{first} {last} {count}" for first, last, count in chunks)
+
+
+def destringify_chunks(string):
+    if not string:
+        return []
+    return [tuple(int(x) for x in chunk.split()) for chunk in string.split(",")]
+
+
+# ===================================================================
+#                      Data column statistics
+# ===================================================================
+
+
+def data_statskey():
+    return f"{PREFIX}{SEP}stats"
+
+
+def stringify_stats(stats):
+    return json.dumps(stats, sort_keys=True)
+
+
+def destringify_stats(string):
+    return json.loads(string) if string else {}
@@ -0,0 +1,340 @@
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+class SampleCache:
+    """
+    A bounded, in-process, least recently used cache for data samples. The size of
+    the cache is tracked in bytes (``nbytes`` of the arrays) and the least recently
+    used samples are evicted once the total size goes beyond ``maxsize``. Keys are
+    expected to be ``(commit, column, sample_key)`` tuples which makes entries from
+    one commit invisible to another.
+
+    The cache is not shared across processes. A pickled cache (for instance, while
+    sending a :class:`stockroom.StockRoom` object to dataloader workers) starts empty
+    in the new process.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum total size of the cached samples in bytes
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._store: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        return getattr(value, "nbytes", None) or sys.getsizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._store[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._store.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache ``value`` under ``key``. Returns whether ``value`` was cached, in which
+        case the same object is returned by every hit
+        """
+        size = self._sizeof(value)
+        if size > self.maxsize:
+            return False
+        with self._lock:
+            if key in self._store:
+                self.currsize -= self._sizeof(self._store.pop(key))
+            self._store[key] = value
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                _, evicted = self._store.popitem(last=False)
+                self.currsize -= self._sizeof(evicted)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+            self.currsize = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __getstate__(self):
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])
+
+
+_MAX_NDIM = 8
+# one record per cached sample, in the order the samples were written: digest of the
+# key (2 words), logical position in the arena (grows across wrap arounds), size,
+# dtype, ndim & shape
+_RECORD_WORDS = 6 + _MAX_NDIM
+# logical write position, first record of the ring & number of records
+_STATE_WORDS = 3
+
+
+def _dtype_code(dtype):
+    return int.from_bytes(dtype.str.encode().ljust(8, b"\0"), "little")
+
+
+class SharedSampleCache:
+    """
+    A bounded sample cache that lives in shared memory so that the processes
+    created from one :class:`stockroom.StockRoom` object (for instance, torch
+    dataloader workers) decode each sample only once. Samples are published into an
+    arena of ``maxsize`` bytes which is used as a ring buffer, i.e. once the arena is
+    full, the oldest samples are evicted first. Samples are looked up in a hash
+    table (open addressing with linear probing) which, along with the records of
+    at most ``max_entries`` samples, lives in a second shared memory block. Both
+    are guarded by one inter-process lock, which is held only for the constant time
+    lookup and the copy of the sample.
+
+    Only numpy arrays are cached and every hit returns a copy of the cached array
+    in the local process' memory. The entries are shared but ``hits`` and ``misses``
+    are not, they count the lookups made by the local process only.
+
+    Note
+    ----
+    The cache can only be shared with processes created by the creator process
+    (through inheritance or as arguments while spawning, which is how dataloader
+    workers receive their dataset). The creator owns the shared memory and must
+    call :meth:`close` (done by :meth:`stockroom.StockRoom.close`) to release it
+
+    Parameters
+    ----------
+    maxsize : int
+        Size of the arena in bytes
+    max_entries : int
+        Maximum number of samples in the cache
+    """
+
+    def __init__(self, maxsize: int, max_entries: int = 65536):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory cache requires python 3.8 or above")
+        self.maxsize = maxsize
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = multiprocessing.Lock()
+        self._arena_shm = shared_memory.SharedMemory(create=True, size=maxsize)
+        table_size = self._table_size(max_entries)
+        words = _STATE_WORDS + 3 * table_size + _RECORD_WORDS * max_entries
+        self._index_shm = shared_memory.SharedMemory(create=True, size=8 * words)
+        self._owner_pid = os.getpid()
+        self._map_views()
+        self.clear()
+
+    @staticmethod
+    def _table_size(max_entries):
+        # at most half full, which keeps the probe sequences short
+        return 1 << (2 * max_entries - 1).bit_length()
+
+    def _map_views(self):
+        # memoryviews, unlike numpy arrays, give python ints on indexing, which is
+        # what makes the lookups cheap
+        table_size = self._table_size(self.max_entries)
+        self._mask = table_size - 1
+        self._dtypes = {}
+        self._arena = np.ndarray(
+            (self.maxsize,), dtype=np.uint8, buffer=self._arena_shm.buf
+        )
+        buf = self._index_shm.buf
+        offsets = [
+            8 * x for x in accumulate([0, _STATE_WORDS, 2 * table_size, table_size])
+        ]
+        self._state = buf[offsets[0] : offsets[1]].cast("q")
+        # digests of the keys & their records, record -1 marks an empty slot
+        self._keys = buf[offsets[1] : offsets[2]].cast("Q")
+        self._slots = buf[offsets[2] : offsets[3]].cast("q")
+        self._records = buf[offsets[3] :].cast("Q")
+
+    def __getstate__(self):
+        return {
+            "maxsize": self.maxsize,
+            "max_entries": self.max_entries,
+            "lock": self._lock,
+            "names": (self._arena_shm.name, self._index_shm.name),
+            "owner_pid": self._owner_pid,
+        }
+
+    def __setstate__(self, state):
+        self.maxsize = state["maxsize"]
+        self.max_entries = state["max_entries"]
+        self.hits = 0
+        self.misses = 0
+        self._lock = state["lock"]
+        arena_name, index_name = state["names"]
+        self._arena_shm = shared_memory.SharedMemory(name=arena_name)
+        self._index_shm = shared_memory.SharedMemory(name=index_name)
+        self._owner_pid = state["owner_pid"]
+        self._map_views()
+
+    @staticmethod
+    def _digest(key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(
+            digest[8:], "little"
+        )
+
+    def _find(self, h0, h1):
+        # slot of the table that has the key or the empty slot that ends its probe
+        keys, slots, mask = self._keys, self._slots, self._mask
+        i = h0 & mask
+        while slots[i] >= 0 and (keys[2 * i] != h0 or keys[2 * i + 1] != h1):
+            i = (i + 1) & mask
+        return i
+
+    def _remove(self, h0, h1):
+        keys, slots, mask = self._keys, self._slots, self._mask
+        i = self._find(h0, h1)
+        if slots[i] < 0:
+            return
+        # shift the following entries of the probe sequence back instead of leaving
+        # a tombstone, so that lookups never go beyond the first empty slot
+        j = i
+        while True:
+            j = (j + 1) & mask
+            if slots[j] < 0:
+                break
+            home = keys[2 * j] & mask
+            # the entry can fill the gap unless its home is cyclically in (i, j]
+            if not (i < home <= j if i < j else home > i or home <= j):
+                keys[2 * i : 2 * i + 2] = keys[2 * j : 2 * j + 2]
+                slots[i] = slots[j]
+                i = j
+        slots[i] = -1
+
+    def _dtype(self, code):
+        try:
+            return self._dtypes[code]
+        except KeyError:
+            raw = code.to_bytes(8, "little").rstrip(b"\0")
+            dtype = self._dtypes[code] = np.dtype(raw.decode())
+            return dtype
+
+    def get(self, key, default=None):
+        h0, h1 = self._digest(key)
+        with self._lock:
+            record = self._slots[self._find(h0, h1)]
+            if record < 0:
+                self.misses += 1
+                return default
+            base = record * _RECORD_WORDS
+            pos, size, code, ndim = self._records[base + 2 : base + 6].tolist()
+            shape = self._records[base + 6 : base + 6 + ndim].tolist()
+            start = pos % self.maxsize
+            raw = self._arena[start : start + size]
+            value = raw.view(self._dtype(code)).reshape(shape).copy()
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Publish a copy of ``value`` under ``key``. Always returns False since the
+        cache never hands out ``value`` itself (see :meth:`SampleCache.put`)
+        """
+        if (
+            not isinstance(value, np.ndarray)
+            or value.dtype.hasobject
+            or value.ndim > _MAX_NDIM
+            or not 0 < value.nbytes <= self.maxsize
+        ):
+            return False
+        h0, h1 = self._digest(key)
+        value = np.ascontiguousarray(value)
+        size = value.nbytes
+        records = self._records
+        with self._lock:
+            if self._slots[self._find(h0, h1)] >= 0:
+                return False  # another process published it already
+            pos, head, count = self._state.tolist()
+            if pos % self.maxsize + size > self.maxsize:
+                # doesn't fit before the end of the arena, wrap around
+                pos += self.maxsize - pos % self.maxsize
+            # evict the oldest samples until the region being written is free
+            while count:
+                base = head * _RECORD_WORDS
+                if count < self.max_entries and (
+                    records[base + 2] >= pos + size - self.maxsize
+                ):
+                    break
+                self._remove(records[base], records[base + 1])
+                head = (head + 1) % self.max_entries
+                count -= 1
+            start = pos % self.maxsize
+            self._arena[start : start + size] = value.reshape(-1).view(np.uint8)
+            record = (head + count) % self.max_entries
+            base = record * _RECORD_WORDS
+            shape = list(value.shape) + [0] * (_MAX_NDIM - value.ndim)
+            words = [h0, h1, pos, size, _dtype_code(value.dtype), value.ndim, *shape]
+            records[base : base + _RECORD_WORDS] = array("Q", words)
+            # evictions could have moved the empty slot the key probes to
+            slot = self._find(h0, h1)
+            self._keys[2 * slot : 2 * slot + 2] = array("Q", [h0, h1])
+            self._slots[slot] = record
+            self._state[:] = array("q", [pos + size, head, count + 1])
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._slots[:] = array("q", [-1]) * len(self._slots)
+            self._state[:] = array("q", [0] * _STATE_WORDS)
+
+    def __len__(self):
+        return self._state[2]
+
+    def __contains__(self, key):
+        h0, h1 = self._digest(key)
+        with self._lock:
+            return self._slots[self._find(h0, h1)] >= 0
+
+    @property
+    def currsize(self):
+        with self._lock:
+            _, head, count = self._state.tolist()
+            records = ((head + i) % self.max_entries for i in range(count))
+            return sum(self._records[r * _RECORD_WORDS + 3] for r in records)
+
+    def close(self):
+        """
+        Detach from the shared memory. The creator process also frees the memory
+        and hence the cache shouldn't be used by any other process after that
+        """
+        # views into the buffers must be gone before the shared memory can close
+        del self._arena
+        for view in (self._state, self._keys, self._slots, self._records):
+            view.release()
+        self._arena_shm.close()
+        self._index_shm.close()
+        # forked children inherit the object as it is and hence the pid check
+        if os.getpid() == self._owner_pid:
+            self._arena_shm.unlink()
+            self._index_shm.unlink()
@@ -1,4 +1,249 @@
+import time
+from itertools import groupby, islice
+
+import numpy as np
+from hangar.checkout import WriterCheckout
 from stockroom import parser
+from stockroom.storages.index import ColumnIndex
+from stockroom.storages.stats import (
+    add_samples,
+    empty_stats,
+    is_array_column,
+    public_stats,
+)
+from stockroom.utils import NoLock, staged_diff, synchronized
+
+
+def _spec_location(spec):
+    # sorting samples by their location lets backends read each file sequentially
+    index = getattr(spec, "dataset_idx", None)
+    if index is None:
+        index = getattr(spec, "collection_idx", getattr(spec, "row_idx", 0))
+    return (
+        spec.backend,
+        getattr(spec, "uid", ""),
+        getattr(spec, "dataset", ""),
+        int(index),
+    )
+
+
+def _iter_samples(column, keys):
+    # (position, sample) of each key, in storage order where the backend allows
+    try:
+        samples, backends = column._samples, column._be_fs
+    except AttributeError:
+        # not a column whose internals are known, read through the column
+        yield from ((i, column[key]) for i, key in enumerate(keys))
+        return
+    specs = [(i, samples[key]) for i, key in enumerate(keys)]
+    specs.sort(key=lambda x: _spec_location(x[1]))
+    for backend, group in groupby(specs, key=lambda x: x[1].backend):
+        handle = backends[backend]
+        for i, spec in group:
+            yield i, handle.read_data(spec)
+
+
+def _stack(column, keys, samples, out=None):
+    # samples are (position, sample) pairs in any order
+    for i, sample in samples:
+        if out is None:
+            out = np.empty((len(keys), *sample.shape), dtype=sample.dtype)
+        elif sample.shape != out.shape[1:]:
+            raise ValueError(
+                f"Cannot stack samples of different shapes. Sample "
+                f"{keys[i]} has shape {sample.shape} but expected "
+                f"{out.shape[1:]}"
+            )
+        out[i] = sample
+    if out is None:
+        out = np.empty((0, *column.shape), dtype=column.dtype)
+    return out
+
+
+def read_samples(column, keys, out=None):
+    """
+    Read multiple samples from a hangar column into one array. Samples are grouped
+    by the backend file they are stored in and each group is read in storage order.
+    Samples of str and nested columns can't be stacked and are read one by one.
+    Columns of a data storage with a sample cache (see :class:`Data`) are read
+    through the cache.
+
+    Parameters
+    ----------
+    column : hangar column
+        Column to read from
+    keys : Iterable[Union[str, int]]
+        Sample keys to fetch. Order of the keys is preserved in the output
+    out : Optional[np.ndarray]
+        Preallocated array of shape ``(len(keys), *sample_shape)`` to read into. A new
+        array is allocated if not passed
+
+    Returns
+    -------
+    Union[np.ndarray, list]
+        Array of shape ``(len(keys), *sample_shape)``, or a list of the samples for
+        str and nested columns
+    """
+    keys = list(keys)
+    if isinstance(column, _CachedColumn):
+        return column.read_many(keys, out)
+    if not is_array_column(column):
+        return [column[key] for key in keys]
+    return _stack(column, keys, _iter_samples(column, keys), out)
+
+
+class _CachedColumn:
+    """
+    Read-only view over a hangar column that reads samples through a
+    :class:`stockroom.storages.cache.SampleCache`
+    """
+
+    def __init__(self, column, cache, commit):
+        self.column = column
+        self.cache = cache
+        self.commit = commit
+
+    def __getattr__(self, item):
+        return getattr(self.column, item)
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        # __getattr__ would recurse while unpickling, before the column is set
+        self.__dict__.update(state)
+
+    def _cache_key(self, key):
+        return (self.commit, self.column.column, key)
+
+    def _put(self, key, value):
+        if self.cache.put(self._cache_key(key), value) and isinstance(
+            value, np.ndarray
+        ):
+            # the same object is handed out for every hit
+            value.flags.writeable = False
+        return value
+
+    def __getitem__(self, key):
+        value = self.cache.get(self._cache_key(key))
+        if value is None:
+            value = self._put(key, self.column[key])
+        return value
+
+    def read_many(self, keys, out=None):
+        """
+        :func:`read_samples` through the cache. The samples that are not in the
+        cache are read together, in one grouped read
+        """
+        keys = list(keys)
+        values = [self.cache.get(self._cache_key(key)) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            samples = read_samples(self.column, [keys[i] for i in missing])
+            for i, sample in zip(missing, samples):
+                if isinstance(sample, np.ndarray):
+                    # a view would keep the whole batch alive in the cache
+                    sample = sample.copy()
+                values[i] = self._put(keys[i], sample)
+        if not is_array_column(self.column):
+            return values
+        return _stack(self.column, keys, enumerate(values), out)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.column)
+
+    def __contains__(self, key):
+        return key in self.column
+
+    def __iter__(self):
+        return iter(self.column)
+
+
+class _SynchronizedColumn:
+    """
+    Column of a write enabled stock object that takes the lock of the storage for
+    reading and writing samples, so that writes made through it wait for an in
+    flight asynchronous commit (see :meth:`stockroom.StockRoom.commit_async`)
+    """
+
+    def __init__(self, column, lock):
+        self.column = column
+        self._lock = lock
+
+    def __getattr__(self, item):
+        if item in ("column", "_lock"):
+            # not set yet, while unpickling
+            raise AttributeError(item)
+        return getattr(self.column, item)
+
+    @synchronized
+    def __getitem__(self, key):
+        return self.column[key]
+
+    @synchronized
+    def __setitem__(self, key, value):
+        self.column[key] = value
+
+    @synchronized
+    def __delitem__(self, key):
+        del self.column[key]
+
+    @synchronized
+    def update(self, *args, **kwargs):
+        self.column.update(*args, **kwargs)
+
+    @synchronized
+    def pop(self, key):
+        return self.column.pop(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.column)
+
+    def __contains__(self, key):
+        return key in self.column
+
+    def __iter__(self):
+        return iter(self.column)
+
+
+class IngestReport:
+    """
+    Progress and throughput of :meth:`Data.ingest`. Updated after every batch, the
+    callback passed to :meth:`Data.ingest` gets the same object each time
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.batches = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    @property
+    def samples_per_second(self):
+        return self.samples / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.nbytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return (
+            f"IngestReport(samples={self.samples}, batches={self.batches}, "
+            f"nbytes={self.nbytes}, seconds={self.seconds:.3f}, "
+            f"samples_per_second={self.samples_per_second:.1f})"
+        )
 
 
 class Data:
@@ -20,26 +265,430 @@ class Data:
     >>> stock = StockRoom()
     >>> stock.data['column1']['sample1'] = np.arange(20).reshape(5, 4)
     >>> sample = stock.data['column1']['sample5']
+
+    For reading or writing a large number of samples, :meth:`Data.get_many` and
+    :meth:`Data.set_many` avoid the per-key overhead
+
+    >>> batch = stock.data.get_many('column1', ['sample1', 'sample5'])
+    >>> stock.data.set_many('column1', {'sample6': arr6, 'sample7': arr7})
+
+    Read-only stock objects can keep the samples read from the data storage in a
+    bounded LRU cache (see :class:`stockroom.storages.cache.SampleCache`) by setting
+    ``data_cache_size`` while creating the :class:`stockroom.StockRoom` object.
+    Arrays kept in the cache are read-only since every hit returns the same object.
+    The cache is cleared when the stock head moves to a new commit
+
+    >>> stock = StockRoom(data_cache_size=2 ** 30)  # 1 GB
+    >>> sample = stock.data['column1']['sample5']
+    >>> stock.data.cache.hits, stock.data.cache.misses
+
+    If the stock object is passed to other processes, such as torch dataloader
+    workers, ``shared_data_cache=True`` makes all of them share one cache in shared
+    memory (see :class:`stockroom.storages.cache.SharedSampleCache`)
+
+    >>> stock = StockRoom(data_cache_size=2 ** 30, shared_data_cache=True)
+
+    Statistics of the columns, such as the number of samples, shapes, dtype and size,
+    are kept up to date at every commit and read with :meth:`Data.stats`. Only the
+    columns written through the storage since the last commit, including those
+    fetched with ``stock.data[column]`` from a write enabled stock object, are looked
+    at. Writes made directly on the hangar checkout (``stock.accessor``) to columns
+    that are already in the manifest aren't picked up
+
+    >>> stock.data.stats('column1')['count']
     """
 
-    def __init__(self, accessor):
+    def __init__(self, accessor, cache=None, index=None):
+        self.cache = cache
+        self.statskey = parser.data_statskey()
+        self._value_stats = set()
+        # data columns written to since the last commit
+        self._dirty = set()
+        self._bind(accessor, index)
+
+    def _bind(self, accessor, index=None, lock=None):
+        # point the storage to another checkout
         self.accessor = accessor
+        self.index = ColumnIndex(accessor) if index is None else index
+        self._lock = NoLock() if lock is None else lock
+        if (
+            self.cache is None
+            or accessor is None
+            or isinstance(accessor, WriterCheckout)
+        ):
+            self._commit = None
+        else:
+            self._commit = accessor.commit_hash
 
     def __getattr__(self, item):
         # TODO: guard for non-allowed
         return getattr(self.accessor, item)
 
+    @synchronized
     def __setitem__(self, key, value):
-        self.accessor[key] = value
+        if isinstance(key, tuple):
+            # hangar checkouts don't take item assignment, unlike their columns
+            column, sample = key
+            self.accessor.columns[column][sample] = value
+        else:
+            column = key
+            self.accessor[key] = value
+        self._dirty.add(column)
 
+    @synchronized
     def __getitem__(self, key):
-        return self.accessor[key]
+        if self._commit is None:
+            if not isinstance(key, tuple) and isinstance(self.accessor, WriterCheckout):
+                # the column can be written to through the returned handle
+                self._dirty.add(key)
+                return _SynchronizedColumn(self.accessor[key], self._lock)
+            return self.accessor[key]
+        if isinstance(key, tuple):
+            if len(key) != 2:
+                return self.accessor[key]
+            column, sample = key
+            return _CachedColumn(self.accessor[column], self.cache, self._commit)[
+                sample
+            ]
+        return _CachedColumn(self.accessor[key], self.cache, self._commit)
 
-    def keys(self):
-        return tuple(
-            (
-                keys
-                for keys in self.accessor.keys()
-                if not keys.startswith(parser.PREFIX)
+    @synchronized
+    def get_many(self, column, keys):
+        """
+        Fetch multiple samples from a column in one go and return them stacked as one
+        array. Samples are grouped by the backend file they are stored in and each
+        group is read in storage order, instead of going through the column accessor
+        once per key.
+
+        Parameters
+        ----------
+        column : str
+            Name of the column
+        keys : Iterable[Union[str, int]]
+            Sample keys to fetch. Order of the keys is preserved in the output
+
+        Returns
+        -------
+        Union[np.ndarray, list]
+            Array of shape ``(len(keys), *sample_shape)``, or a list of the samples
+            for str and nested columns
+        """
+        return read_samples(self.accessor.columns[column], keys)
+
+    @synchronized
+    def set_many(self, column, data, keys=None):
+        """
+        Write multiple samples to a column in one go. All the samples are validated
+        first and then written within a single column transaction.
+
+        Parameters
+        ----------
+        column : str
+            Name of the column
+        data : Union[dict, np.ndarray]
+            Either a dictionary of sample keys to samples or an array where each item
+            along the first axis is a sample
+        keys : Optional[Iterable[Union[str, int]]]
+            Sample keys used if ``data`` is an array. Defaults to ``0 ... len(data)``.
+            There must be as many keys as samples
+        """
+        if not isinstance(data, dict):
+            keys = range(len(data)) if keys is None else list(keys)
+            if len(keys) != len(data):
+                raise ValueError(
+                    f"Got {len(keys)} keys for {len(data)} samples of column {column}"
+                )
+            # asarray to get 0-d arrays, not numpy scalars, from 1-d arrays
+            data = {key: np.asarray(value) for key, value in zip(keys, data)}
+        self.accessor.columns[column].update(data)
+        self._dirty.add(column)
+
+    @synchronized
+    def declare_columns(self, columns):
+        """
+        Create multiple data columns up front, in one go. Creating a column requires
+        leaving and re-entering the checkout context and hence creating all of them
+        together is much cheaper than creating them one by one in between writes.
+        Columns that already exist are skipped.
+
+        Parameters
+        ----------
+        columns : dict
+            Column names to either a prototype array or the keyword arguments of
+            hangar's ``add_ndarray_column`` such as ``shape``, ``dtype``,
+            ``variable_shape`` and ``backend``
+
+        Examples
+        --------
+        >>> stock.data.declare_columns({
+        ...     'image': np.zeros((3, 32, 32), dtype=np.float32),
+        ...     'label': {'shape': (), 'dtype': np.int64},
+        ... })
+        """
+        col_args = []
+        for name, spec in columns.items():
+            if name in self.index:
+                continue
+            if isinstance(spec, np.ndarray):
+                spec = {"prototype": spec}
+            col_args.append(("add_ndarray_column", {"name": name, **spec}))
+        self.index.create_columns(col_args)
+
+    def ingest(self, columns, iterable, batch_size=256, start=None, callback=None):
+        """
+        Write the samples yielded by any iterable, such as a generator of unknown
+        length, to data columns. Items are taken from the iterable ``batch_size`` at a
+        time and each batch is written before the next one is taken, so that no more
+        than one batch is held in memory. Columns that don't exist yet are created
+        from the first batch, with the dtype and shape of its samples. If the shapes
+        of the samples in the first batch differ, the column is created with variable
+        shape and the largest of the shapes as the maximum. Pass the spec of the
+        column explicitly if later samples can be larger than that.
+
+        Parameters
+        ----------
+        columns : Union[str, Sequence[str], dict]
+            Name of the column if each item is one sample, or names of the columns if
+            each item is a tuple (or a dict keyed by the column names) of samples. A
+            dict can map the names to the spec of the column, as in
+            :meth:`Data.declare_columns`, or to None for inferring it
+        iterable : Iterable
+            Items to ingest
+        batch_size : int
+            Number of items written in one go
+        start : Optional[int]
+            Key of the first item. The keys of the rest of the items follow it. By
+            default, one more than the largest integer key in the columns, which
+            appends the items to the columns without overwriting any sample
+        callback : Optional[Callable[[IngestReport], None]]
+            Called after each batch, for showing progress
+
+        Returns
+        -------
+        IngestReport
+            Number of samples, batches and bytes written and the time it took
+
+        Examples
+        --------
+        >>> def read_images(paths):
+        ...     for path in paths:
+        ...         yield load_image(path), label_from(path)
+        >>> report = stock.data.ingest(['image', 'label'], read_images(paths))
+        >>> report.samples_per_second
+        """
+        if not isinstance(self.accessor, WriterCheckout):
+            raise PermissionError(
+                "Ingesting data requires a write enabled stock object"
             )
+        single = isinstance(columns, str)
+        if single:
+            specs = {columns: None}
+        elif isinstance(columns, dict):
+            specs = dict(columns)
+        else:
+            specs = dict.fromkeys(columns)
+        names = list(specs)
+
+        report = IngestReport()
+        began = time.perf_counter()
+        iterator = iter(iterable)
+        key = start
+        while True:
+            items = list(islice(iterator, batch_size))
+            if not items:
+                break
+            batch = self._columnize(names, items, single)
+            if report.batches == 0:
+                self._create_ingest_columns(specs, batch)
+                if key is None:
+                    key = self._next_key(names)
+            report.nbytes += self._write_batch(batch, key)
+            key += len(items)
+            report.samples += len(items)
+            report.batches += 1
+            report.seconds = time.perf_counter() - began
+            if callback is not None:
+                callback(report)
+        return report
+
+    @synchronized
+    def _next_key(self, names):
+        # after the largest integer key of the columns rather than their length, which
+        # would overwrite samples if the keys have gaps
+        keys = (
+            key
+            for name in names
+            for key in self.accessor.columns[name].keys()
+            if isinstance(key, int)
         )
+        return max(keys, default=-1) + 1
+
+    @staticmethod
+    def _columnize(names, items, single):
+        batch = {name: [] for name in names}
+        for item in items:
+            if single:
+                item = (item,)
+            elif isinstance(item, dict):
+                item = tuple(item[name] for name in names)
+            elif len(item) != len(names):
+                raise ValueError(
+                    f"Expected {len(names)} samples per item, one for each of the "
+                    f"columns {names}, but got {len(item)}"
+                )
+            for name, sample in zip(names, item):
+                batch[name].append(np.asarray(sample))
+        return batch
+
+    @synchronized
+    def _create_ingest_columns(self, specs, batch):
+        declared, col_args = {}, []
+        for name, spec in specs.items():
+            if name in self.index:
+                continue
+            if spec is not None:
+                declared[name] = spec
+                continue
+            samples = batch[name]
+            shapes = {sample.shape for sample in samples}
+            if len({len(shape) for shape in shapes}) > 1:
+                raise ValueError(
+                    f"Cannot infer the shape of column {name} from samples with "
+                    f"different number of dimensions"
+                )
+            kwargs = {"name": name, "dtype": np.result_type(*samples)}
+            if len(shapes) == 1:
+                kwargs["shape"] = samples[0].shape
+            else:
+                kwargs["shape"] = tuple(max(dims) for dims in zip(*shapes))
+                kwargs["variable_shape"] = True
+            col_args.append(("add_ndarray_column", kwargs))
+        self.index.create_columns(col_args)
+        if declared:
+            self.declare_columns(declared)
+
+    @synchronized
+    def _write_batch(self, batch, start):
+        nbytes = 0
+        for name, samples in batch.items():
+            column = self.accessor.columns[name]
+            data = {}
+            for i, sample in enumerate(samples):
+                # python scalars and lists come as the default numpy dtypes
+                sample = sample.astype(column.dtype, casting="same_kind", copy=False)
+                data[start + i] = sample
+                nbytes += sample.nbytes
+            column.update(data)
+        self._dirty.update(batch)
+        return nbytes
+
+    def enable_value_stats(self, *columns):
+        """
+        Keep the minimum, maximum and mean of the values of ``columns`` in the stats
+        manifest, starting with the next commit. Unlike the rest of the statistics,
+        these require reading the samples. It's done once for the existing samples
+        and then only for the samples added in each commit, unless samples are
+        deleted or replaced
+        """
+        if not isinstance(self.accessor, WriterCheckout):
+            raise PermissionError(
+                "Value statistics require a write enabled stock object"
+            )
+        self._value_stats.update(columns)
+
+    def _stats_column_args(self):
+        if self.statskey in self.index:
+            return []
+        return [("add_str_column", {"name": self.statskey})]
+
+    def _read_manifest(self):
+        if self.statskey not in self.index:
+            return {}
+        return {
+            name: parser.destringify_stats(value)
+            for name, value in self.accessor.columns[self.statskey].items()
+        }
+
+    @synchronized
+    def stats(self, column=None):
+        """
+        Statistics of the data columns as of the last commit, read from the stats
+        manifest without going through the samples of the columns. Columns committed
+        before the manifest existed, or created after the last commit, are summarized
+        on the fly from their sample specs.
+
+        Parameters
+        ----------
+        column : Optional[str]
+            Name of the column. By default, all the data columns
+
+        Returns
+        -------
+        dict
+            ``count`` (number of samples), ``dtype``, ``shape`` (of the column
+            schema), ``min_shape`` and ``max_shape`` (bounds of the shapes of the
+            samples), ``nbytes`` (total size of the samples) and, if enabled with
+            :meth:`Data.enable_value_stats`, ``min``, ``max`` and ``mean`` of the
+            values. A dictionary of column names to these if ``column`` is not passed
+        """
+        manifest = self._read_manifest()
+        names = self.index.names("data") if column is None else (column,)
+        out = {}
+        for name in names:
+            stats = manifest.get(name)
+            if stats is None:
+                col = self.accessor.columns[name]
+                stats = add_samples(empty_stats(col), col, list(col.keys()))
+            out[name] = public_stats(stats)
+        return out if column is None else out[column]
+
+    @synchronized
+    def _update_stats(self):
+        # bring the stats manifest up to date with the staged changes, right before
+        # a commit. The staged diff, which has to leave the checkout context, is
+        # taken only if data columns were written to. Columns with only added
+        # samples are updated incrementally
+        writer = self.accessor
+        names = self.index.names("data")
+        manifest = self._read_manifest()
+        dirty, self._dirty = self._dirty, set()
+        added, rebuild = {}, set()
+        if not writer.commit_hash:
+            rebuild.update(names)
+        elif dirty.intersection(names):
+            diff = staged_diff(writer)
+            for key in diff.added.samples:
+                added.setdefault(key.column, []).append(key.sample)
+            for key in diff.deleted.samples + diff.mutated.samples:
+                rebuild.add(key.column)
+
+        updates = {}
+        for name in names:
+            stats = manifest.get(name)
+            values = name in self._value_stats or bool(stats and stats["values"])
+            if stats is not None and stats["values"] == values:
+                if name not in added and name not in rebuild:
+                    continue
+                column = writer.columns[name]
+                if name not in rebuild and is_array_column(column):
+                    add_samples(stats, column, added[name])
+                    updates[name] = parser.stringify_stats(stats)
+                    continue
+            column = writer.columns[name]
+            stats = add_samples(
+                empty_stats(column, values), column, list(column.keys())
+            )
+            updates[name] = parser.stringify_stats(stats)
+        removed = [name for name in manifest if name not in names]
+        self._value_stats.clear()
+        if not updates and not removed:
+            return
+
+        self.index.create_columns(self._stats_column_args())
+        manifest_col = writer.columns[self.statskey]
+        manifest_col.update(updates)
+        for name in removed:
+            del manifest_col[name]
+
+    def keys(self):
+        return self.index.names("data")
@@ -1,5 +1,13 @@
+import numbers
+
+import numpy as np
+from hangar.checkout import WriterCheckout
 from stockroom import parser
-from stockroom.utils import clean_create_column
+from stockroom.storages.index import ColumnIndex
+from stockroom.utils import NoLock, synchronized
+
+# Number of (step, value) rows in one chunk of a metric time series
+METRIC_CHUNK_SIZE = 1024
 
 
 class Experiment:
@@ -18,36 +26,230 @@ class Experiment:
     >>> stock.experiment['epochs'] = 1000
     >>> stock.experiment['lr'] = 0.0001
     >>> stock.experiment['optimizer'] = 'adam'
+
+    Multiple tags can be written in one go with :meth:`Experiment.update`. Metrics
+    of each training step are logged with :meth:`Experiment.log` into numeric time
+    series, which are not tags and hence not listed by :meth:`Experiment.keys`
+
+    >>> stock.experiment.update({'epochs': 1000, 'lr': 0.0001, 'optimizer': 'adam'})
+    >>> stock.experiment.log(10, loss=0.31, accuracy=0.87)
+    >>> steps, values = stock.experiment.series('loss', start=0, stop=100)
     """
 
-    def __init__(self, accessor):
+    def __init__(self, accessor, index=None, log_buffer_size=256):
         self.typecaster = {"int": int, "float": float, "str": str}
-        self.accessor = accessor
+        self._bind(accessor, index)
         self.tagkey = parser.tagkey()
         self.tagtypekey = parser.tag_typekey()
+        self.serieskey = parser.metric_serieskey()
+        self.seriesmetakey = parser.metric_metakey()
+        self.log_buffer_size = log_buffer_size
+        self._log_buffer = {}
+        self._buffered = 0
 
-    def __setitem__(self, key, value):
-        writer = self.accessor
-        if isinstance(value, int):
-            value_type = "int"
-        elif isinstance(value, float):
-            value_type = "float"
-        elif isinstance(value, str):
-            value_type = "str"
-        else:
-            raise TypeError("Tag store can accept only ``int``, ``float`` or ``str``")
+    def _bind(self, accessor, index=None, lock=None):
+        # point the storage to another checkout. Buffered metrics must be flushed
+        # before this
+        self.accessor = accessor
+        self.index = ColumnIndex(accessor) if index is None else index
+        self._lock = NoLock() if lock is None else lock
+
+    def _tag_column_args(self):
         column_creation_details = []
-        if self.tagkey not in writer.columns.keys():
+        if self.tagkey not in self.index:
             column_creation_details.append(("add_str_column", {"name": self.tagkey}))
-        if self.tagtypekey not in writer.columns.keys():
+        if self.tagtypekey not in self.index:
             column_creation_details.append(
                 ("add_str_column", {"name": self.tagtypekey})
             )
-        clean_create_column(self.accessor, column_creation_details)
+        return column_creation_details
 
-        writer[self.tagkey][key] = str(value)
-        writer[self.tagtypekey][key] = value_type
+    def _series_column_args(self):
+        column_creation_details = []
+        if self.serieskey not in self.index:
+            kwargs = {
+                "name": self.serieskey,
+                "shape": (METRIC_CHUNK_SIZE, 2),
+                "dtype": np.float64,
+                "variable_shape": True,
+            }
+            column_creation_details.append(("add_ndarray_column", kwargs))
+        if self.seriesmetakey not in self.index:
+            column_creation_details.append(
+                ("add_str_column", {"name": self.seriesmetakey})
+            )
+        return column_creation_details
+
+    def _declaration_args(self):
+        return self._tag_column_args() + self._series_column_args()
+
+    @synchronized
+    def declare_columns(self):
+        """
+        Create the columns for tags and metrics up front, in one go, so that the
+        first :meth:`Experiment.update` or :meth:`Experiment.flush` doesn't have to
+        leave and re-enter the checkout context for creating them
+        """
+        self.index.create_columns(self._declaration_args())
+
+    @staticmethod
+    def _value_type(value):
+        if isinstance(value, int):
+            return "int"
+        elif isinstance(value, float):
+            return "float"
+        elif isinstance(value, str):
+            return "str"
+        raise TypeError("Tag store can accept only ``int``, ``float`` or ``str``")
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    @synchronized
+    def update(self, mapping):
+        """
+        Write multiple tags in one go. The types of all the values are validated before
+        anything is written, the tag columns are created at most once and the values
+        and their types are written with one update call each.
+
+        Parameters
+        ----------
+        mapping : dict
+            Tag names to values. Values can be ``int``, ``float`` or ``str``
+        """
+        values, value_types = {}, {}
+        for key, value in mapping.items():
+            value_types[key] = self._value_type(value)
+            values[key] = str(value)
+        if not values:
+            return
+        self.index.create_columns(self._tag_column_args())
+
+        writer = self.accessor
+        writer[self.tagkey].update(values)
+        writer[self.tagtypekey].update(value_types)
+
+    def log(self, step, **metrics):
+        """
+        Log the metrics of a training step. Each metric is kept as a time series of
+        ``(step, value)`` rows in chunked ``float64`` columns, which can be read back
+        with :meth:`Experiment.series`. Rows are buffered in memory and written
+        once ``log_buffer_size`` of them are collected, on :meth:`Experiment.flush` or
+        before a commit.
+
+        Parameters
+        ----------
+        step : int
+            Training step (or epoch) the metrics belong to
+        **metrics
+            Metric names to values. Values can be any real number, including numpy
+            scalars
+        """
+        if not isinstance(self.accessor, WriterCheckout):
+            raise PermissionError(
+                "Logging metrics requires a write enabled stock object"
+            )
+        for name, value in metrics.items():
+            if not isinstance(value, numbers.Real):
+                raise TypeError(f"Metric {name} is not a real number")
+        for name, value in metrics.items():
+            self._log_buffer.setdefault(name, []).append((step, value))
+        self._buffered += len(metrics)
+        if self._buffered >= self.log_buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the metrics buffered by :meth:`Experiment.log`. The last chunk of each
+        metric is filled up before new chunks are started
+        """
+        if self._log_buffer:
+            self._write_series(self._take_buffer())
+
+    def _take_buffer(self):
+        buffer, self._log_buffer, self._buffered = self._log_buffer, {}, 0
+        return buffer
+
+    @synchronized
+    def _write_series(self, buffer):
+        self.index.create_columns(self._series_column_args())
+
+        writer = self.accessor
+        series_col = writer[self.serieskey]
+        meta_col = writer[self.seriesmetakey]
+        samples, meta = {}, {}
+        for name, rows in buffer.items():
+            rows = np.array(rows, dtype=np.float64)
+            chunks = parser.destringify_chunks(meta_col.get(name, ""))
+            if chunks and chunks[-1][2] < METRIC_CHUNK_SIZE:
+                last = parser.metric_chunkkey(name, len(chunks) - 1)
+                rows = np.concatenate([series_col[last], rows])
+                chunks.pop()
+            for start in range(0, len(rows), METRIC_CHUNK_SIZE):
+                chunk = rows[start : start + METRIC_CHUNK_SIZE]
+                samples[parser.metric_chunkkey(name, len(chunks))] = chunk
+                steps = chunk[:, 0]
+                chunks.append((int(steps.min()), int(steps.max()), len(chunk)))
+            meta[name] = parser.stringify_chunks(chunks)
+        series_col.update(samples)
+        meta_col.update(meta)
+
+    @synchronized
+    def series(self, name, start=None, stop=None):
+        """
+        Read the time series of a metric logged with :meth:`Experiment.log`. Only the
+        chunks that overlap with the requested range of steps are read.
+
+        Parameters
+        ----------
+        name : str
+            Name of the metric
+        start : Optional[int]
+            First step to include. Defaults to the first logged step
+        stop : Optional[int]
+            Step to stop before (exclusive). Defaults to after the last logged step
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            ``int64`` array of steps, in ascending order, and ``float64`` array of
+            the values logged at those steps
+        """
+        self.flush()
+        reader = self.accessor
+        try:
+            chunks = parser.destringify_chunks(reader[self.seriesmetakey, name])
+        except KeyError:
+            raise KeyError(f"Metric {name} not found")
+        series_col = reader.columns[self.serieskey]
+        rows = [
+            series_col[parser.metric_chunkkey(name, i)]
+            for i, (first, last, _) in enumerate(chunks)
+            if (start is None or last >= start) and (stop is None or first < stop)
+        ]
+        rows = np.concatenate(rows) if rows else np.empty((0, 2), dtype=np.float64)
+        steps = rows[:, 0].astype(np.int64)
+        mask = np.ones(len(steps), dtype=bool)
+        if start is not None:
+            mask &= steps >= start
+        if stop is not None:
+            mask &= steps < stop
+        steps, values = steps[mask], rows[mask, 1]
+        order = np.argsort(steps, kind="stable")
+        return steps[order], values[order]
+
+    @synchronized
+    def metrics(self):
+        """
+        Names of the metrics logged with :meth:`Experiment.log`
+        """
+        self.flush()
+        try:
+            return tuple(self.accessor[self.seriesmetakey].keys())
+        except KeyError:
+            return tuple()
 
+    @synchronized
     def __getitem__(self, key):
         reader = self.accessor
         try:
@@ -63,6 +265,7 @@ class Experiment:
                 f"read the data type {value_type}"
             )
 
+    @synchronized
     def keys(self):
         try:
             return tuple(self.accessor[self.tagkey].keys())
@@ -0,0 +1,119 @@
+from stockroom import parser
+from stockroom.utils import clean_create_column, columns_version
+
+
+class ColumnIndex:
+    """
+    Index of the columns of a checkout that maps each column name to the kind of
+    storage it belongs to and its owner (see :func:`stockroom.parser.column_kind`).
+    The index is built once per checkout on first use and kept up to date by creating
+    columns through :meth:`ColumnIndex.create_columns`. Storages use it to answer
+    membership and listing queries instead of going through all the column names of
+    the repository every time.
+
+    Note
+    ----
+    The index rebuilds itself on the next lookup if columns are created or deleted
+    with :func:`stockroom.utils.clean_create_column` or if the number of columns
+    changes, which is all it checks for being constant time. Dropping and creating
+    a column directly on the hangar checkout, without the helper, isn't noticed
+
+    Examples
+    --------
+    >>> index = ColumnIndex(stock.accessor)
+    >>> index.kind('_STKM--_resnet--_float32')
+    'model'
+    >>> index.owners('model')
+    ('resnet',)
+    """
+
+    def __init__(self, accessor):
+        self.accessor = accessor
+        self._kinds = {}
+        self._members = {}
+        self._built = False
+        self._version = None
+
+    def _add(self, name):
+        kind, owner = parser.column_kind(name)
+        self._kinds[name] = kind
+        self._members.setdefault(kind, {})[name] = owner
+
+    def _remove(self, name):
+        kind = self._kinds.pop(name, None)
+        if kind is not None:
+            del self._members[kind][name]
+
+    def _ensure(self):
+        columns = self.accessor.columns
+        version = columns_version(self.accessor)
+        if (
+            not self._built
+            or version != self._version
+            or len(columns) != len(self._kinds)
+        ):
+            self._kinds, self._members = {}, {}
+            for name in columns.keys():
+                self._add(name)
+            self._built = True
+            self._version = version
+
+    def __contains__(self, name):
+        self._ensure()
+        return name in self._kinds
+
+    def __len__(self):
+        self._ensure()
+        return len(self._kinds)
+
+    def kind(self, name):
+        """
+        Kind of the storage the column ``name`` belongs to or None if the column
+        doesn't exist
+        """
+        self._ensure()
+        return self._kinds.get(name)
+
+    def names(self, kind):
+        """
+        Names of all the columns of ``kind``
+        """
+        self._ensure()
+        return tuple(self._members.get(kind, ()))
+
+    def owners(self, kind):
+        """
+        Owners of the columns of ``kind``, i.e the model names for ``"model"`` and the
+        column names for ``"data"``, without duplicates
+        """
+        self._ensure()
+        return tuple(dict.fromkeys(self._members.get(kind, {}).values()))
+
+    def items(self, kind):
+        """
+        Pairs of column name and owner of all the columns of ``kind``
+        """
+        self._ensure()
+        return tuple(self._members.get(kind, {}).items())
+
+    def create_columns(self, col_details):
+        """
+        Create (or delete) columns on the checkout with
+        :func:`stockroom.utils.clean_create_column` and update the index with them
+
+        Parameters
+        ----------
+        col_details : Sequence[Tuple[str, dict]]
+            Name of the checkout method and its keyword arguments for each column
+        """
+        if not col_details:
+            return
+        self._ensure()
+        clean_create_column(self.accessor, col_details)
+        for fn_name, kwargs in col_details:
+            if fn_name == "columns.delete":
+                self._remove(kwargs["column"])
+            else:
+                self._add(kwargs["name"])
+        # already up to date with the changes made above
+        self._version = columns_version(self.accessor)
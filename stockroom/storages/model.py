@@ -1,23 +1,154 @@
+import functools
 import warnings
+from collections.abc import Mapping
 
 import numpy as np
 from stockroom import parser
-from stockroom.utils import LazyLoader, clean_create_column
+from stockroom.storages.index import ColumnIndex
+from stockroom.utils import (
+    LazyLoader,
+    NoLock,
+    layer_digest,
+    memmap_sample,
+    synchronized,
+)
 
 torch = LazyLoader("torch", globals(), "torch")
 tf = LazyLoader("tf", globals(), "tensorflow")
 
+# Maximum number of elements in one sample of the shared layer columns. Larger layers
+# are split into multiple samples
+LAYER_CHUNK_SIZE = 2**26
+
+
+# Precisions a model can be stored in, see Model.save
+STORE_DTYPES = ("float16", "bfloat16", "int8-per-channel")
+_FLOAT_DTYPES = ("float16", "bfloat16", "float32", "float64")
+
+
+def _read_sample(column, key, mmap):
+    if mmap:
+        sample = memmap_sample(column, key)
+        if sample is not None:
+            return sample
+    return column[key]
+
+
+def _to_numpy(value):
+    """
+    Array of a layer and the name of its dtype. numpy has no bfloat16 and hence such
+    layers are kept as their raw bits in ``uint16`` arrays
+    """
+    if hasattr(value, "numpy") and str(value.dtype) == "torch.bfloat16":
+        return value.view(torch.int16).numpy().view(np.uint16), "bfloat16"
+    array = value.numpy() if hasattr(value, "numpy") else np.asarray(value)
+    if array.dtype.name == "bfloat16":  # from ml_dtypes, used by keras
+        return array.view(np.uint16), "bfloat16"
+    return array, array.dtype.name
+
+
+def _to_bfloat16(array):
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    # round to nearest even, NaNs are kept as quiet NaNs
+    rounded = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+    # ascontiguousarray makes 0-d arrays 1-d
+    bits = np.where(np.isnan(array), 0x7FC0, rounded.reshape(np.shape(array)))
+    return bits.astype(np.uint16)
+
+
+def _from_bfloat16(bits):
+    # shifting a 0-d array gives a scalar, which can't be viewed as float32
+    shifted = bits.astype(np.uint32).reshape(-1) << 16
+    return shifted.view(np.float32).reshape(bits.shape)
+
+
+def _stored_dtype(dtype, store_dtype):
+    if store_dtype is None or dtype not in _FLOAT_DTYPES or dtype == store_dtype:
+        return "uint16" if dtype == "bfloat16" else dtype
+    return {"float16": "float16", "bfloat16": "uint16", "int8-per-channel": "int8"}[
+        store_dtype
+    ]
+
+
+def _encode(array, dtype, store_dtype):
+    """
+    Cast a layer of the dtype ``dtype`` to ``store_dtype``. Returns the array to
+    store and, for int8, the scale of each channel. Only floating point layers are
+    cast
+    """
+    if store_dtype is None or dtype not in _FLOAT_DTYPES or dtype == store_dtype:
+        return array, None
+    if dtype == "bfloat16":
+        array = _from_bfloat16(array)
+    if store_dtype == "float16":
+        return array.astype(np.float16), None
+    if store_dtype == "bfloat16":
+        return _to_bfloat16(array), None
+    # symmetric quantization with one scale per output channel (the first axis)
+    num_channels = array.shape[0] if array.ndim > 1 else 1
+    # sizes are explicit since -1 can't be inferred for layers of size zero
+    channels = array.reshape(num_channels, array.size // max(num_channels, 1))
+    if channels.size:
+        scales = np.abs(channels).max(axis=1).astype(np.float32) / 127
+    else:
+        scales = np.ones(len(channels), dtype=np.float32)
+    scales[scales == 0] = 1
+    quantized = np.rint(channels / scales[:, None]).clip(-127, 127)
+    return quantized.astype(np.int8).reshape(array.shape), scales
+
+
+def _decode(array, dtype, store_dtype, scales, restore_dtype):
+    """
+    Inverse of :func:`_encode`. Returns the array and the name of its dtype. Layers
+    stored in half precision are returned as they are stored unless
+    ``restore_dtype``. Quantized layers are always dequantized to the original dtype
+    """
+    if store_dtype is None or dtype not in _FLOAT_DTYPES or dtype == store_dtype:
+        return array, dtype
+    if store_dtype == "int8-per-channel":
+        # layers without channels have no scales, which are read back as None
+        scales = np.array(scales or [], dtype=np.float32)
+        size = array.size // max(len(scales), 1)
+        channels = array.reshape(len(scales), size).astype(np.float32)
+        array = (channels * scales[:, None]).reshape(array.shape)
+    elif not restore_dtype:
+        return array, store_dtype
+    elif store_dtype == "bfloat16":
+        array = _from_bfloat16(array)
+    if dtype == "bfloat16":
+        return _to_bfloat16(array), dtype
+    return array.astype(dtype), dtype
+
+
+def _loaded_dtype(dtype, store_dtype, restore_dtype):
+    # dtype of a layer as returned by _decode, without reading the layer
+    half = store_dtype in ("float16", "bfloat16") and dtype in _FLOAT_DTYPES
+    return store_dtype if half and not restore_dtype else dtype
+
+
+def _to_tensor(array, dtype):
+    if dtype == "bfloat16":
+        return torch.from_numpy(array.view(np.int16)).view(torch.bfloat16)
+    return torch.from_numpy(array)
+
 
 class Model:
     """
     Model class utilizes hangar columns to store pieces of a model and use hangar
     metadata to store the information required to collate it back to a model. Currently,
     it supports ``keras.Model`` and ``torch.nn.Module`` models. ModelStore instance,
-    on :meth:`stockroom.storages.Model.save_weights` creates few columns (one column for
-    each data type) to store the weights and create one column specifically to store the
-    shape of each layer. This shape column is needed because the weights of each layer
-    would be flattened before saving. This is essential since handling variable shapes
-    and variable ranks are more complex than flattening and reshaping-back the weights.
+    on :meth:`stockroom.storages.Model.save` creates few columns (one column for
+    each data type) to store the weights. The weights of each layer are flattened
+    before saving and the shape of each layer is kept in the metadata. This is essential
+    since handling variable shapes and variable ranks are more complex than flattening
+    and reshaping-back the weights. The names of the columns depend only on the model
+    name and the data types, and hence changing the architecture of a model doesn't
+    create a new set of columns. A registry of all the models and their columns is
+    kept in one column, which makes listing the models a single lookup.
+    Alternatively, a model can be saved in the "packed" layout (see :meth:`Model.save`)
+    where all the layers of one data type live in a single contiguous buffer, or in
+    the "shared" layout where layers are stored in content addressed columns that are
+    shared across all the models and hence identical layers are stored only once.
 
     Examples
     --------
@@ -28,130 +159,778 @@ class Model:
     >>> tf_model = tf.Keras.Sequential()
     >>> tf_model.add(tf.layers.Dense(64, activation='relu'))
     >>> stock.model['tf_model'] = tf_model.get_weights()
+    >>> stock.model.save('packed_model', torch_model.state_dict(), packed=True)
+    >>> stock.model.save('finetuned_model', torch_model.state_dict(), dedup=True)
+    >>> encoder_weights = stock.model.open('torch_model').select('encoder.')
 
     But if you can make it easy by calling special functions that knows how to fetch
     weights from the model or how to put weights back to model. Checkout :meth:`Model.save_weights`
     & :meth:`Model.load_weights` for more details
     """
 
-    def __init__(self, accessor):
+    def __init__(self, accessor, index=None):
+        self._bind(accessor, index)
+
+    def _bind(self, accessor, index=None, lock=None):
+        # point the storage to another checkout
         self.accessor = accessor
+        self.index = ColumnIndex(accessor) if index is None else index
+        self._lock = NoLock() if lock is None else lock
 
     def __setitem__(self, name, weights):
+        self.save(name, weights)
+
+    def __getitem__(self, name):
+        return self.load(name)
+
+    def save(
+        self,
+        name,
+        weights,
+        packed=False,
+        dedup=False,
+        backend=None,
+        store_dtype=None,
+    ):
+        """
+        Save the weights of a model under ``name``. ``stock.model[name] = weights`` is
+        a shortcut to this function with default arguments.
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+        weights : Union[dict, list]
+            ``state_dict`` of a torch model or the output of ``get_weights`` of a
+            keras model
+        packed : bool
+            If True, all the layers of the same data type are concatenated into
+            one contiguous flat buffer and stored as a single sample. The offset
+            and shape of each layer is kept in the metadata. Saving and loading a
+            packed model requires only one read/write per data type instead of two
+            per layer which is significantly faster for models with large number
+            of layers
+        dedup : bool
+            If True, each layer is stored in a column shared by all the models (one
+            column per data type) with the digest of the layer as the key. Models
+            only keep the digests in the metadata. Layers that are already stored,
+            for instance the frozen backbone of another fine-tuned variant, are not
+            written again. Cannot be used along with ``packed``
+        backend : Optional[str]
+            Hangar backend code to use for the weight columns if they are being
+            created. Use ``"10"`` (uncompressed numpy memmap) for models that need to
+            be loaded with ``mmap=True``. By default, hangar decides the backend
+        store_dtype : Optional[str]
+            Precision to store the floating point layers in, one of ``"float16"``,
+            ``"bfloat16"`` or ``"int8-per-channel"`` (symmetric quantization with
+            one scale per output channel, kept in the metadata). Halves or quarters
+            the size of the checkpoint. The original dtypes are kept in the metadata
+            for :meth:`Model.load` to cast back to. By default, layers are stored
+            as they are, including bfloat16 tensors
+
+        Note
+        ----
+        A digest of each layer is kept in the metadata. If a model with the same name
+        exists in the staging area, only the layers whose digest changed are written
+        again (for the packed layout, only the buffers of the data types that have a
+        changed layer). This makes frequent checkpointing of a model with mostly
+        frozen layers cheap
+        """
+        self._prepare_save(name, weights, packed, dedup, backend, store_dtype)()
+
+    def _prepare_save(
+        self,
+        name,
+        weights,
+        packed=False,
+        dedup=False,
+        backend=None,
+        store_dtype=None,
+    ):
+        """
+        Do the part of :meth:`Model.save` that doesn't touch the checkout, i.e.
+        converting, casting and hashing the layers, without holding the lock of the
+        storage. Returns the function that writes the prepared layers
+        """
         if isinstance(weights, dict):
-            layers = weights.keys()
-            weights = [x.numpy() for x in weights.values()]
+            layers = list(weights.keys())
+            weights = weights.values()
             library = "torch"
-            library_version = torch.__version__
+            library_version = str(torch.__version__)
         elif isinstance(weights, list):
             library = "tf"
             layers = None
-            library_version = tf.__version__
+            library_version = str(tf.__version__)
         else:
             raise TypeError("Unknown type. Weights has to be a dict or list")
-        longest = max([len(x.reshape(-1)) for x in weights])
+        if store_dtype is not None and store_dtype not in STORE_DTYPES:
+            raise ValueError(f"store_dtype has to be one of {STORE_DTYPES}")
+        layout = self._layout(packed, dedup)
+        converted = [_to_numpy(w) for w in weights]
+        weights = [w for w, _ in converted]
+        orig_dtypes = [dtype for _, dtype in converted]
+        encoded = [_encode(w, d, store_dtype) for w, d in zip(weights, orig_dtypes)]
+        weights = [w for w, _ in encoded]
+        digests = [layer_digest(w) for w in weights]
+        meta = {
+            "library": library,
+            "libraryVersion": library_version,
+            "layers": layers,
+            "origDtypes": orig_dtypes,
+            "storeDtype": store_dtype,
+            "scales": [scales for _, scales in encoded],
+            "digests": digests,
+        }
+        return functools.partial(self._write, name, weights, meta, layout, backend)
+
+    @synchronized
+    def _write(self, name, weights, meta, layout, backend):
+        digests, store_dtype = meta["digests"], meta["storeDtype"]
         dtypes = [w.dtype.name for w in weights]
+        previous = self._stored_digests(name)
+        if layout == "shared":
+            columns, writes = self._save_shared(name, weights, dtypes, backend, digests)
+        elif layout == "packed":
+            columns, writes = self._save_packed(
+                name, weights, dtypes, backend, digests, previous
+            )
+        else:
+            columns, writes = self._save_layered(
+                name, weights, dtypes, backend, digests, previous
+            )
+        self._write_samples(writes)
+
+        metacol = self.accessor[parser.model_metakey(name)]
+        metacol["library"] = meta["library"]
+        metacol["libraryVersion"] = meta["libraryVersion"]
+        metacol["dtypes"] = parser.stringify(dtypes)
+        metacol["numLayers"] = str(len(weights))
+        metacol["layers"] = parser.stringify(meta["layers"])
+        metacol["shapes"] = parser.stringify_shapes([w.shape for w in weights])
+        if "longest" in metacol:
+            # saved by an older version of stockroom
+            del metacol["longest"]
+        quantized = store_dtype == "int8-per-channel"
+        metacol["origDtypes"] = parser.stringify(meta["origDtypes"])
+        if store_dtype is not None:
+            metacol["storeDtype"] = store_dtype
+        if quantized:
+            metacol["scales"] = parser.stringify_scales(meta["scales"])
+        for key, stale in (
+            ("storeDtype", store_dtype is None),
+            ("scales", not quantized),
+        ):
+            # left behind by an earlier save in another precision
+            if stale and key in metacol:
+                del metacol[key]
+        metacol["digests"] = parser.stringify(digests)
+        self._register(name, [parser.model_metakey(name), *columns])
+
+    def _scan_models(self):
+        """
+        Find the models and their columns by going through all the columns in the
+        repository. Used only if the registry doesn't exist yet
+        """
+        models = {}
+        for key, name in self.index.items("model"):
+            models.setdefault(name, []).append(key)
+        return models
+
+    def _register(self, name, columns):
+        registry = self.accessor[parser.model_registrykey()]
+        if not len(registry):
+            # models saved before the registry existed
+            legacy = self._scan_models()
+            registry.update({k: parser.stringify(v) for k, v in legacy.items()})
+        registry[str(name)] = parser.stringify(columns)
+
+    def _stored_digests(self, name):
+        """
+        Returns the layout details and per layer digests of the model ``name`` as it
+        is in the staging area or None if it's not saved or saved without digests
+        """
+        try:
+            metacol = self.accessor.columns[parser.model_metakey(name)]
+        except KeyError:
+            return None
+        if "digests" not in metacol:
+            return None
+        return {
+            "layout": metacol.get("layout", "layered"),
+            "dtypes": parser.destringify(metacol["dtypes"]),
+            "digests": parser.destringify(metacol["digests"]),
+        }
+
+    def _invalidate_digests(self, name):
+        # digests are written back only after all the layers are written and hence a
+        # failed save can't leave behind digests that doesn't match the stored layers
+        metacol = self.accessor[parser.model_metakey(name)]
+        if "digests" in metacol:
+            del metacol["digests"]
+
+    def _metacol_creation_args(self, name):
+        col_args = []
+        for key in (parser.model_metakey(name), parser.model_registrykey()):
+            if key not in self.index:
+                col_args.append(("add_str_column", {"name": key}))
+        return col_args
+
+    def _column_args(self, name, sizes, dtypes, layout, backend):
+        """
+        Creation arguments of the columns that are missing (or too small) for saving
+        the model ``name`` with layers of ``sizes`` and ``dtypes`` in ``layout``,
+        along with the names of the weight columns of the model
+        """
+        col_args = self._metacol_creation_args(name)
+        if layout == "shared":
+            keys = []
+            for dtype in dict.fromkeys(dtypes):
+                key = parser.model_layerkey(dtype)
+                keys.append(key)
+                if key not in self.index:
+                    kwargs = {
+                        "name": key,
+                        "shape": LAYER_CHUNK_SIZE,
+                        "dtype": np.dtype(dtype),
+                        "variable_shape": True,
+                        "backend": backend,
+                    }
+                    col_args.append(("add_ndarray_column", kwargs))
+            return col_args, keys
+
+        # packed buffers hold all the layers of a data type, layered columns only one
+        required = {}
+        for size, dtype in zip(sizes, dtypes):
+            if layout == "packed":
+                required[dtype] = required.get(dtype, 0) + size
+            else:
+                required[dtype] = max(required.get(dtype, 0), size)
+        keyfn = parser.model_packedkey if layout == "packed" else parser.modelkey
+        keys = []
+        for dtype, size in required.items():
+            keys.append(keyfn(name, dtype))
+            col_args.extend(self._weight_column_args(keys[-1], size, dtype, backend))
+        return col_args, keys
+
+    def _weight_column_args(self, key, size, dtype, backend):
+        """
+        Column creation arguments for a weight column that should hold samples of
+        ``size`` elements. An existing column that is too small is deleted and created
+        again. The maximum shape is rounded up to the next power of two so that a
+        growing model recreates its columns only a handful of times
+        """
+        columns = self.accessor.columns
+        col_args = []
+        if key in self.index:
+            if columns[key].shape[0] >= size:
+                return col_args
+            col_args.append(("columns.delete", {"column": key}))
+        kwargs = {
+            "name": key,
+            "shape": 1 << max(size - 1, 0).bit_length(),
+            "dtype": np.dtype(dtype),
+            "variable_shape": True,
+            "backend": backend,
+        }
+        col_args.append(("add_ndarray_column", kwargs))
+        return col_args
+
+    @staticmethod
+    def _snapshot(weights):
+        """
+        Copy of the weights that the training loop can't modify anymore
+        """
+        if isinstance(weights, dict):
+            return {k: v.detach().cpu().clone() for k, v in weights.items()}
+        elif isinstance(weights, list):
+            return [np.array(w, copy=True) for w in weights]
+        raise TypeError("Unknown type. Weights has to be a dict or list")
+
+    @staticmethod
+    def _layout(packed, dedup):
+        if packed and dedup:
+            raise ValueError("Cannot save a model both packed and deduplicated")
+        return "shared" if dedup else "packed" if packed else "layered"
+
+    @staticmethod
+    def _spec_layers(spec, store_dtype=None):
+        """
+        Shape and the data type each layer of a model spec is stored in
+        """
+        if isinstance(spec, dict):
+            values = spec.values()
+        elif isinstance(spec, list):
+            values = spec
+        else:
+            raise TypeError("Unknown type. Model spec has to be a dict or list")
+        shapes, dtypes = [], []
+        for value in values:
+            if isinstance(value, tuple):
+                shape, dtype = value
+                dtype = dtype if dtype == "bfloat16" else np.dtype(dtype).name
+            else:
+                # torch tensors need to be converted for getting the numpy dtype
+                value, dtype = _to_numpy(value)
+                shape = value.shape
+            shapes.append(tuple(shape))
+            dtypes.append(_stored_dtype(dtype, store_dtype))
+        return shapes, dtypes
+
+    def _declaration_args(
+        self, name, spec, packed=False, dedup=False, backend=None, store_dtype=None
+    ):
+        layout = self._layout(packed, dedup)
+        shapes, dtypes = self._spec_layers(spec, store_dtype)
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        return self._column_args(name, sizes, dtypes, layout, backend)[0]
+
+    @synchronized
+    def declare(
+        self, name, spec, packed=False, dedup=False, backend=None, store_dtype=None
+    ):
+        """
+        Create all the columns needed for saving the model ``name`` up front, in one
+        go. Columns are otherwise created on the first :meth:`Model.save`, which
+        requires leaving and re-entering the checkout context. Saving a model that
+        fits in the declared columns doesn't create any column.
+        :meth:`stockroom.StockRoom.declare_model` declares the experiment columns as
+        well.
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+        spec : Union[dict, list]
+            ``state_dict`` of a torch model, output of ``get_weights`` of a keras
+            model or a dict/list of ``(shape, dtype)`` of each layer
+        packed : bool
+            Declare the columns of the packed layout (see :meth:`Model.save`)
+        dedup : bool
+            Declare the columns of the shared layout (see :meth:`Model.save`)
+        backend : Optional[str]
+            Hangar backend code for the weight columns
+        store_dtype : Optional[str]
+            Precision the model will be saved in (see :meth:`Model.save`)
+        """
+        self.index.create_columns(
+            self._declaration_args(name, spec, packed, dedup, backend, store_dtype)
+        )
+
+    def _save_layered(self, name, weights, dtypes, backend, digests, previous):
         writer = self.accessor
-        metakey = parser.model_metakey(name)
 
         # ---------- Create columns if doesn't exist -----------------
+        new_col_args, columns = self._column_args(
+            name, [w.size for w in weights], dtypes, "layered", backend
+        )
+        created = {kw["name"] for fn, kw in new_col_args if fn == "add_ndarray_column"}
+        self.index.create_columns(new_col_args)
+        # ---------------------------------------------------------
+
+        unchanged = set()
+        if previous and previous["layout"] == "layered":
+            old = zip(previous["dtypes"], previous["digests"])
+            new = zip(dtypes, digests)
+            unchanged = {
+                i
+                for i, (x, y) in enumerate(zip(old, new))
+                if x == y and parser.modelkey(name, y[0]) not in created
+            }
+        self._invalidate_digests(name)
+
+        writes = [
+            (parser.modelkey(name, dtypes[i]), i, w.reshape(-1))
+            for i, w in enumerate(weights)
+            if i not in unchanged
+        ]
 
-        new_col_args = []
+        metacol = writer[parser.model_metakey(name)]
+        metacol["layout"] = "layered"
+        return columns, writes
 
-        if metakey not in writer.columns.keys():
-            new_col_args.append(("add_str_column", {"name": metakey}))
+    def _save_packed(self, name, weights, dtypes, backend, digests, previous):
+        writer = self.accessor
+        offsets = []
+        grouped = {}
+        for w, dtype in zip(weights, dtypes):
+            group = grouped.setdefault(dtype, [])
+            offsets.append(sum(x.size for x in group))
+            group.append(w)
+        new_col_args, columns = self._column_args(
+            name, [w.size for w in weights], dtypes, "packed", backend
+        )
+        created = {kw["name"] for fn, kw in new_col_args if fn == "add_ndarray_column"}
+        self.index.create_columns(new_col_args)
 
-        shapeKey = parser.model_shapekey(name, str(longest))
-        if shapeKey not in writer.columns.keys():
-            shape_typ = np.array(1).dtype  # C long = int32 in win64; int64 elsewhere
-            kwargs = {
-                "name": shapeKey,
-                "shape": 10,
-                "dtype": shape_typ,
-                "variable_shape": True,
+        # a buffer is rewritten only if any of the layers in it has changed
+        unchanged = set()
+        if previous and previous["layout"] == "packed":
+            old_groups, new_groups = {}, {}
+            for dtype, digest in zip(previous["dtypes"], previous["digests"]):
+                old_groups.setdefault(dtype, []).append(digest)
+            for dtype, digest in zip(dtypes, digests):
+                new_groups.setdefault(dtype, []).append(digest)
+            unchanged = {
+                k
+                for k, v in new_groups.items()
+                if old_groups.get(k) == v
+                and parser.model_packedkey(name, k) not in created
             }
-            new_col_args.append(("add_ndarray_column", kwargs))
-        being_created = set()
-        for i, w in enumerate(weights):
-            modelKey = parser.modelkey(name, str(longest), dtypes[i])
-            if modelKey not in writer.columns.keys() and modelKey not in being_created:
-                being_created.add(modelKey)
-                dtype = np.dtype(dtypes[i])
-                kwargs = {
-                    "name": modelKey,
-                    "shape": longest,
-                    "dtype": dtype,
-                    "variable_shape": True,
-                }
-                new_col_args.append(("add_ndarray_column", kwargs))
-        if new_col_args:
-            clean_create_column(self.accessor, new_col_args)
-        # ---------------------------------------------------------
+        self._invalidate_digests(name)
 
-        metacol = writer[metakey]
-        metacol["library"] = library
-        metacol["libraryVersion"] = library_version
-        metacol["longest"] = str(longest)
-        metacol["dtypes"] = parser.stringify(dtypes)
-        metacol["numLayers"] = str(len(weights))
-        metacol["layers"] = parser.stringify(layers)
+        writes = [
+            (
+                parser.model_packedkey(name, dtype),
+                0,
+                np.concatenate([w.reshape(-1) for w in group]),
+            )
+            for dtype, group in grouped.items()
+            if dtype not in unchanged
+        ]
 
-        shape_col = writer.columns[shapeKey]
-        for i, w in enumerate(weights):
-            model_col = writer.columns[parser.modelkey(name, longest, dtypes[i])]
-            model_col[i] = w.reshape(-1)
+        metacol = writer[parser.model_metakey(name)]
+        metacol["layout"] = "packed"
+        metacol["offsets"] = parser.stringify([str(x) for x in offsets])
+        return columns, writes
 
-            if w.shape:
-                shape_col[i] = np.array(w.shape)
-            else:
-                # C long = int32 in win64; int64 elsewhere
-                shape_typ = np.array(1).dtype
-                shape_col[i] = np.array(()).astype(shape_typ)
+    def _save_shared(self, name, weights, dtypes, backend, digests):
+        writer = self.accessor
+        new_col_args, columns = self._column_args(
+            name, [w.size for w in weights], dtypes, "shared", backend
+        )
+        self.index.create_columns(new_col_args)
+        self._invalidate_digests(name)
 
-    def __getitem__(self, name):
-        reader = self.accessor
+        writes, queued = [], set()
+        for w, dtype, digest in zip(weights, dtypes, digests):
+            colname = parser.model_layerkey(dtype)
+            layer_col = writer.columns[colname]
+            flat = w.reshape(-1)
+            for i, start in enumerate(range(0, max(flat.size, 1), LAYER_CHUNK_SIZE)):
+                key = f"{digest}-{i}"
+                # content addressed, an existing key means the same data is stored
+                if key not in layer_col and (colname, key) not in queued:
+                    queued.add((colname, key))
+                    writes.append(
+                        (colname, key, flat[start : start + LAYER_CHUNK_SIZE])
+                    )
+
+        metacol = writer[parser.model_metakey(name)]
+        metacol["layout"] = "shared"
+        return columns, writes
+
+    def _write_samples(self, writes):
+        # ``(column name, key, array)`` samples, written (and hashed by hangar) on
+        # the calling thread
+        columns = {colname: self.accessor.columns[colname] for colname, _, _ in writes}
+        for colname, key, value in writes:
+            columns[colname][key] = value
+
+    @synchronized
+    def open(self, name, mmap=False, restore_dtype=False):
+        """
+        Open the model saved as ``name`` without loading its weights. The returned
+        :class:`ModelView` lists the layers along with their shapes and dtypes right
+        away, from the metadata, and reads a layer only when it's accessed. Use it
+        for inspecting a model or for loading only a part of it
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+        mmap : bool
+            See :meth:`Model.load`
+        restore_dtype : bool
+            See :meth:`Model.load`
+
+        Returns
+        -------
+        ModelView
+            Read-only mapping from the layer names (indices for keras models) to
+            the weights
+
+        Examples
+        --------
+        >>> view = stock.model.open('resnet')
+        >>> view.shapes['fc.weight']
+        (1000, 2048)
+        >>> fc_weight = view['fc.weight']
+        >>> model.load_state_dict(view.select('encoder.'), strict=False)
+        """
+        meta = self._read_meta(name)
+        library, library_version = meta["library"], meta["libraryVersion"]
+        installed = torch.__version__ if library == "torch" else tf.__version__
+        if installed != library_version:
+            framework = "PyTorch" if library == "torch" else "Tensorflow"
+            warnings.warn(
+                f"{framework} version used while storing the model "
+                f"({library_version}) is not same as the one installed "
+                f"in the current environment. i.e {installed}"
+            )
+        return ModelView(self, meta, mmap, restore_dtype)
+
+    @synchronized
+    def load(self, name, mmap=False, restore_dtype=False):
+        """
+        Load the weights of the model saved as ``name``. ``stock.model[name]`` is a
+        shortcut to this function with default arguments. See :meth:`Model.open` for
+        loading the layers one at a time
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+        mmap : bool
+            If True, weights are returned as read-only views of memory-mapped backend
+            files instead of being read into memory, wherever the backend allows it
+            (see :func:`stockroom.utils.memmap_sample`). Multiple processes loading
+            the same model share the same pages. Save the model with
+            ``backend="10"``, preferably with ``packed=True``, to make use of this.
+            Such weights must not be modified in place: writing to the returned
+            arrays raises and writing to tensors built on them (torch warns about
+            this) is undefined behaviour. ``clone()`` a tensor, or load the model
+            without ``mmap``, before modifying it, e.g. with an optimizer
+        restore_dtype : bool
+            If True, layers saved with a ``store_dtype`` of half precision are cast
+            back to the dtype they had when saved. Otherwise, they are returned in
+            the precision they are stored in. Quantized layers are always
+            dequantized to the original dtype. numpy has no bfloat16 and hence such
+            layers of keras models are returned as float32
+
+        Returns
+        -------
+        Union[dict, list]
+            A ``state_dict`` of torch tensors for torch models or a list of numpy
+            arrays for keras models
+        """
+        return self.open(name, mmap, restore_dtype).select()
+
+    def _read_meta(self, name):
+        """
+        Everything needed for reading the layers of the model ``name``, parsed from
+        its metadata
+        """
         try:
-            metakey = parser.model_metakey(name)
-            metacol = reader.columns[metakey]
+            metacol = self.accessor.columns[parser.model_metakey(name)]
         except KeyError:
             raise KeyError(f"Model with key {name} not found")
-        library = metacol["library"]
-        library_version = metacol["libraryVersion"]
-        longest = int(metacol["longest"])
-        dtypes = parser.destringify(metacol["dtypes"])
-        num_layers = int(metacol["numLayers"])
-        layers = parser.destringify(metacol["layers"])
-
-        shapeKey = parser.model_shapekey(name, longest)
-        shape_col = reader.columns[shapeKey]
-        weights = []
-        for i in range(num_layers):
-            modelKey = parser.modelkey(name, longest, dtypes[i])
-            col = reader.columns[modelKey]
-            w = col[i].reshape(np.array(shape_col[i]))
-            weights.append(w)
-        if library == "torch":
-            if torch.__version__ != library_version:
-                warnings.warn(
-                    f"PyTorch version used while storing the model "
-                    f"({library_version}) is not same as the one installed "
-                    f"in the current environment. i.e {torch.__version__}"
-                )
-            return {layers[i]: torch.from_numpy(weights[i]) for i in range(num_layers)}
+        meta = dict(metacol.items())
+        num_layers = int(meta["numLayers"])
+        dtypes = parser.destringify(meta["dtypes"])
+        if "longest" in meta:
+            layout = "legacy"
+            shape_col = self.accessor.columns[
+                parser.legacy_model_shapekey(name, int(meta["longest"]))
+            ]
+            shapes = [tuple(int(x) for x in shape_col[i]) for i in range(num_layers)]
+        else:
+            layout = meta.get("layout", "layered")
+            shapes = parser.destringify_shapes(meta["shapes"], num_layers)
+        if "scales" in meta:
+            scales = parser.destringify_scales(meta["scales"], num_layers)
+        else:
+            scales = [None] * num_layers
+        meta.update(
+            name=name,
+            layout=layout,
+            numLayers=num_layers,
+            layers=parser.destringify(meta["layers"]),
+            dtypes=dtypes,
+            origDtypes=parser.destringify(meta.get("origDtypes", "")) or dtypes,
+            storeDtype=meta.get("storeDtype", None),
+            shapes=[tuple(shape) for shape in shapes],
+            scales=scales,
+        )
+        for key in ("offsets", "digests"):
+            if key in meta:
+                meta[key] = parser.destringify(meta[key])
+        return meta
 
+    @synchronized
+    def _read_layers(self, meta, indices, mmap, restore_dtype, buffers, accessor=None):
+        """
+        Read, decode and convert the layers at ``indices`` of the model described by
+        ``meta`` (see :meth:`Model._read_meta`) from ``accessor``, the current
+        checkout by default. The buffers of packed models are read once and kept in
+        ``buffers``
+        """
+        columns = (self.accessor if accessor is None else accessor).columns
+        layers = []
+        for i in indices:
+            array = self._read_layer(meta, i, mmap, buffers, columns)
+            array, dtype = _decode(
+                array,
+                meta["origDtypes"][i],
+                meta["storeDtype"],
+                meta["scales"][i],
+                restore_dtype,
+            )
+            if meta["library"] == "torch":
+                layers.append(_to_tensor(array, dtype))
+            else:
+                layers.append(_from_bfloat16(array) if dtype == "bfloat16" else array)
+        return layers
+
+    def _read_layer(self, meta, i, mmap, buffers, columns):
+        name, layout = meta["name"], meta["layout"]
+        dtype, shape = meta["dtypes"][i], meta["shapes"][i]
+        if layout == "legacy":
+            # models saved by older versions of stockroom with a shape column
+            col = columns[parser.legacy_modelkey(name, int(meta["longest"]), dtype)]
+            return _read_sample(col, i, mmap).reshape(shape)
+        if layout == "packed":
+            if dtype not in buffers:
+                col = columns[parser.model_packedkey(name, dtype)]
+                buffers[dtype] = _read_sample(col, 0, mmap)
+            offset = int(meta["offsets"][i])
+            # slicing the buffer gives a view, no copy is made here
+            return buffers[dtype][offset : offset + int(np.prod(shape))].reshape(shape)
+        if layout == "shared":
+            digest = meta["digests"][i]
+            layer_col = columns[parser.model_layerkey(dtype)]
+            num_chunks = max(-(-int(np.prod(shape)) // LAYER_CHUNK_SIZE), 1)
+            chunks = [
+                _read_sample(layer_col, f"{digest}-{j}", mmap)
+                for j in range(num_chunks)
+            ]
+            flat = chunks[0] if num_chunks == 1 else np.concatenate(chunks)
+            return flat.reshape(shape)
+        col = columns[parser.modelkey(name, dtype)]
+        return _read_sample(col, i, mmap).reshape(shape)
+
+    @synchronized
+    def columns(self, name):
+        """
+        Names of the hangar columns that hold the model ``name``, including the
+        columns shared with other models
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+
+        Returns
+        -------
+        tuple
+            Column names
+        """
+        registrykey = parser.model_registrykey()
+        if registrykey in self.index:
+            registry = self.accessor.columns[registrykey]
         else:
-            if tf.__version__ != library_version:
-                warnings.warn(
-                    f"Tensorflow version used while storing the model "
-                    f"({library_version}) is not same as the one installed "
-                    f"in the current environment. i.e {tf.__version__}"
-                )
-            return weights
+            registry = {k: parser.stringify(v) for k, v in self._scan_models().items()}
+        try:
+            return tuple(parser.destringify(registry[str(name)]))
+        except KeyError:
+            raise KeyError(f"Model with key {name} not found")
 
+    @synchronized
     def keys(self):
-        out = set()
-        for key in self.accessor.keys():
-            if key.startswith(f"{parser.PREFIX}M"):
-                # second element is name
-                out.add(key.split(parser.SEP)[1])
-        return tuple(out)
+        registrykey = parser.model_registrykey()
+        if registrykey in self.index:
+            return tuple(self.accessor.columns[registrykey].keys())
+        # repository doesn't have a registry yet
+        return tuple(self._scan_models())
+
+
+class ModelView(Mapping):
+    """
+    Read-only mapping from the layer names of a model (indices of the layers for
+    keras models) to the weights, returned by :meth:`Model.open`. The names, shapes
+    and dtypes of the layers come from the metadata and hence are available right
+    away. A layer is read from the repository only when it's accessed and it's read
+    again on every access. All the layers of one data type are stored as one buffer
+    in packed models, which is read on the first access and kept by the view.
+
+    The view reads from the checkout it was opened on and raises
+    :class:`PermissionError` once that checkout is closed, i.e after the stock
+    object is closed or is moved to another commit with
+    :meth:`stockroom.StockRoom.update_head` (or ``auto_refresh``). Open the model
+    again for reading it from the new commit
+    """
+
+    def __init__(self, model, meta, mmap=False, restore_dtype=False):
+        self._model = model
+        # pinned, the storage is rebound to the new checkout on a refresh
+        self._accessor = model.accessor
+        self._meta = meta
+        self._mmap = mmap
+        self._restore_dtype = restore_dtype
+        self._buffers = {}
+        self.library = meta["library"]
+        if self.library == "torch":
+            keys = meta["layers"]
+        else:
+            keys = range(meta["numLayers"])
+        self._index = {key: i for i, key in enumerate(keys)}
+        dtypes = [
+            _loaded_dtype(dtype, meta["storeDtype"], restore_dtype)
+            for dtype in meta["origDtypes"]
+        ]
+        if self.library != "torch":
+            # see Model.load
+            dtypes = ["float32" if x == "bfloat16" else x for x in dtypes]
+        self.shapes = dict(zip(self._index, meta["shapes"]))
+        self.dtypes = dict(zip(self._index, dtypes))
+
+    def __getitem__(self, key):
+        try:
+            i = self._index[key]
+        except KeyError:
+            raise KeyError(f"Layer {key} not found in model {self._meta['name']}")
+        return self._read([i])[0]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return f"ModelView({self._meta['name']!r}, {len(self)} layers)"
+
+    def _read(self, indices):
+        try:
+            return self._model._read_layers(
+                self._meta,
+                indices,
+                self._mmap,
+                self._restore_dtype,
+                self._buffers,
+                self._accessor,
+            )
+        except PermissionError as e:
+            raise PermissionError(
+                f"Model {self._meta['name']} was opened on a checkout that is closed "
+                "now. Open it again after closing or refreshing the stock object"
+            ) from e
+
+    def select(self, prefix=""):
+        """
+        Load all the layers whose names start with ``prefix``, reading them in one
+        go. With the default prefix, this loads the whole model like
+        :meth:`Model.load`
+
+        Parameters
+        ----------
+        prefix : str
+            Prefix of the layer names, such as ``"encoder."`` for the layers of the
+            ``encoder`` submodule of a torch model. Keras models have no layer
+            names and hence only the default is allowed for them
+
+        Returns
+        -------
+        Union[dict, list]
+            A partial ``state_dict`` for torch models, that can be loaded with
+            ``load_state_dict(..., strict=False)``, or a list of numpy arrays for
+            keras models
+        """
+        if self.library != "torch":
+            if prefix:
+                raise ValueError("Layers of keras models can't be selected by prefix")
+            return self._read(list(self._index.values()))
+        keys = [key for key in self._index if key.startswith(prefix)]
+        return dict(zip(keys, self._read([self._index[key] for key in keys])))
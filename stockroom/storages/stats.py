@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def is_array_column(column):
+    return column.column_type == "ndarray" and column.column_layout == "flat"
+
+
+def empty_stats(column, values=False):
+    """
+    Statistics of ``column`` without any samples, as kept in the stats manifest of
+    the data storage (see :meth:`stockroom.storages.Data.stats`). ``values`` enables
+    the minimum, maximum and mean of the values, which require reading the samples
+    """
+    if is_array_column(column):
+        dtype, shape = np.dtype(column.dtype).name, list(column.shape)
+    else:
+        dtype, shape = getattr(column.dtype, "__name__", str(column.dtype)), None
+    stats = {
+        "count": 0,
+        "dtype": dtype,
+        "shape": shape,
+        "min_shape": None,
+        "max_shape": None,
+        "nbytes": 0,
+        "values": values,
+    }
+    if values:
+        stats.update({"min": None, "max": None, "mean": None, "size": 0})
+    return stats
+
+
+def add_samples(stats, column, keys):
+    """
+    Fold the samples ``keys`` of ``column`` into ``stats``, in place. Shapes and
+    sizes come from the sample specs and the samples are read only for the value
+    statistics. Only the count is kept for columns other than flat ndarray columns
+    """
+    stats["count"] += len(keys)
+    if not is_array_column(column):
+        return stats
+    itemsize = np.dtype(column.dtype).itemsize
+    for key in keys:
+        shape = getattr(column._samples[key], "shape", None)
+        if shape is None:  # backends that don't keep the shape in the spec
+            shape = column[key].shape
+        shape = list(shape)
+        stats["nbytes"] += int(np.prod(shape)) * itemsize
+        if stats["min_shape"] is None:
+            stats["min_shape"], stats["max_shape"] = shape, shape
+        else:
+            stats["min_shape"] = [min(a, b) for a, b in zip(stats["min_shape"], shape)]
+            stats["max_shape"] = [max(a, b) for a, b in zip(stats["max_shape"], shape)]
+        if stats["values"]:
+            _add_values(stats, column[key])
+    return stats
+
+
+def _add_values(stats, value):
+    if value.size == 0:
+        return
+    low, high = value.min().item(), value.max().item()
+    total = value.sum(dtype=np.float64).item()
+    size = stats["size"] + value.size
+    if stats["size"]:
+        stats["min"] = min(stats["min"], low)
+        stats["max"] = max(stats["max"], high)
+        # running mean, without keeping the sum that could lose precision
+        stats["mean"] += (total - stats["mean"] * value.size) / size
+    else:
+        stats["min"], stats["max"], stats["mean"] = low, high, total / size
+    stats["size"] = size
+
+
+def public_stats(stats):
+    """
+    Statistics as returned to the user, with tuples for shapes and numpy dtypes
+    """
+    stats = dict(stats)
+    for key in ("shape", "min_shape", "max_shape"):
+        if stats[key] is not None:
+            stats[key] = tuple(stats[key])
+    stats["dtype"] = str if stats["dtype"] == "str" else np.dtype(stats["dtype"])
+    return stats
@@ -1,7 +1,13 @@
+import functools
+import hashlib
 import importlib
+import os
+import time
 import types
+import weakref
 from pathlib import Path
 
+import numpy as np
 from rich import box
 from rich.console import Console
 from rich.table import Table
@@ -104,6 +110,41 @@ def set_current_head(root: Path, commit: str):
         f.write(commit)
 
 
+class HeadWatcher:
+    """
+    Keeps track of the commit hash in the stock file of the repository at ``root``
+    without reading the file each time. The file is read only if its modification time,
+    size or inode changed since the last read, or if it was modified too recently for
+    the modification time to be trusted on file systems with coarse timestamps.
+
+    Parameters
+    ----------
+    root : Path
+        The stock root path
+    """
+
+    # seconds after a modification during which the file is always read
+    settle_time = 2.0
+
+    def __init__(self, root: Path):
+        self.path = root / "head.stock"
+        self._signature = None
+        self.head = ""
+        self.poll()
+
+    def poll(self) -> str:
+        """
+        Returns the current commit hash, reading the stock file only if it was modified
+        """
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        recent = time.time() - stat.st_mtime < self.settle_time
+        if signature != self._signature or recent:
+            self._signature = signature
+            self.head = get_current_head(self.path.parent)
+        return self.head
+
+
 class LazyLoader(types.ModuleType):
     """
     Lazily import a module, mainly to avoid pulling in large dependencies
@@ -136,13 +177,156 @@ class LazyLoader(types.ModuleType):
         return dir(module)
 
 
+class NoLock:
+    """
+    Context manager that does nothing, used in place of a lock by the storages of
+    read-only stock objects. Unlike an actual lock, it can be pickled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def synchronized(method):
+    """
+    Decorator for storage methods that makes them run while holding the lock of the
+    storage (``self._lock``). Write enabled stock objects share one lock between all
+    the storages and the background commit thread
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# number of times the columns of a checkout were created or deleted by stockroom
+_column_versions = weakref.WeakKeyDictionary()
+
+
+def columns_version(accessor):
+    """
+    Number of times :func:`clean_create_column` changed the columns of ``accessor``.
+    Lets :class:`stockroom.storages.index.ColumnIndex` notice a column that was
+    dropped and created again, which doesn't change the number of columns
+    """
+    return _column_versions.get(accessor, 0)
+
+
 def clean_create_column(accessor, col_details):
     is_conman = accessor._is_conman
     try:
         if is_conman:
             accessor.__exit__()
         for fn_name, kwargs in col_details:
-            getattr(accessor, fn_name)(**kwargs)
+            fn = accessor
+            # dotted names such as "columns.delete" are resolved attribute by attribute
+            for attr in fn_name.split("."):
+                fn = getattr(fn, attr)
+            fn(**kwargs)
+    finally:
+        _column_versions[accessor] = columns_version(accessor) + 1
+        if is_conman:
+            accessor.__enter__()
+
+
+def staged_diff(accessor):
+    """
+    Changes in the staging area of a writer checkout since its last commit (see
+    hangar's ``WriterUserDiff.staged``). Writes made while the checkout is used as a
+    context manager are not visible to the diff until the context exits and hence it
+    is exited and entered again, like :func:`clean_create_column` does
+    """
+    is_conman = accessor._is_conman
+    try:
+        if is_conman:
+            accessor.__exit__()
+        return accessor.diff.staged().diff
     finally:
         if is_conman:
             accessor.__enter__()
+
+
+def staged_status(accessor):
+    """
+    ``"DIRTY"`` if the staging area of a writer checkout has changes since its last
+    commit, ``"CLEAN"`` otherwise. The context is exited and entered again for the
+    same reason as in :func:`staged_diff`
+    """
+    is_conman = accessor._is_conman
+    try:
+        if is_conman:
+            accessor.__exit__()
+        return accessor.diff.status()
+    finally:
+        if is_conman:
+            accessor.__enter__()
+
+
+def memmap_sample(column, key):
+    """
+    Returns a read-only view of the sample stored under ``key`` that is backed by a
+    memory map of the hangar backend file, without copying the data into memory.
+    Only the numpy memmap backend (``"10"``) stores samples uncompressed and hence
+    allows this. ``None`` is returned for samples stored in any other backend and the
+    caller is expected to fall back to the regular read. The same goes for samples
+    whose backend file can't be mapped for any reason.
+
+    Note
+    ----
+    Unlike the regular read, the checksum of the data is not verified since that
+    requires reading the whole sample into memory
+
+    Parameters
+    ----------
+    column : hangar column
+        Column (flat layout) that has the sample
+    key : Union[str, int]
+        Sample key
+
+    Returns
+    -------
+    Optional[np.ndarray]
+        Read-only view of the sample if the backend allows it. None otherwise
+    """
+    try:
+        spec = column._samples[key]
+        if spec.backend != "10":
+            return None
+        handle = column._be_fs[spec.backend]
+        try:
+            fp = handle.Fp[spec.uid]
+        except KeyError:
+            fp = np.load(handle.DATADIR.joinpath(f"{spec.uid}.npy"), mmap_mode="r")
+            handle.rFp[spec.uid] = fp
+        if not isinstance(fp, np.ndarray):
+            # hangar keeps a partial to open the memmap lazily
+            fp = fp()
+            handle.rFp[spec.uid] = fp
+        view = fp[(spec.collection_idx, *[slice(0, x) for x in spec.shape])]
+    except (AttributeError, KeyError, TypeError, IndexError, OSError):
+        # these are hangar internals, a version that lays out the backend
+        # differently gets the regular read
+        return None
+    view = view.view(np.ndarray)
+    view.flags.writeable = False
+    return view
+
+
+def layer_digest(array: np.ndarray) -> str:
+    """
+    blake2b digest of an array that accounts for the data as well as the dtype and
+    shape of the array. Used for detecting the model layers that have changed since
+    the last save and as the key of the layer in the content addressed layer store,
+    shared by all the models, hence a collision resistant hash (the one hangar uses
+    for the samples) rather than a faster one
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(np.ascontiguousarray(array))
+    hasher.update(f"{array.dtype.str}{array.shape}".encode())
+    return hasher.hexdigest()
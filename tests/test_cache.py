@@ -0,0 +1,110 @@
+import multiprocessing
+import timeit
+
+import numpy as np
+import pytest
+from stockroom import StockRoom
+from stockroom.storages.cache import SampleCache, SharedSampleCache
+
+
+def test_lru_eviction():
+    cache = SampleCache(maxsize=100)
+    arr = np.zeros(10, dtype=np.int32)  # 40 bytes
+    cache.put("a", arr)
+    cache.put("b", arr)
+    assert cache.get("a") is arr
+    cache.put("c", arr)
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.currsize == 80
+    cache.put("big", np.zeros(101, dtype=np.uint8))
+    assert "big" not in cache
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def _publish(cache, key, value):
+    cache.put(key, value)
+    cache.close()
+
+
+def _lookup(cache, keys, results):
+    for key in keys:
+        cache.get(key)
+    results.put((cache.hits, cache.misses))
+    cache.close()
+
+
+@pytest.fixture()
+def shared_cache():
+    cache = SharedSampleCache(maxsize=200, max_entries=8)
+    yield cache
+    cache.close()
+
+
+def test_shared_cache_across_processes(shared_cache):
+    arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+    proc = multiprocessing.Process(
+        target=_publish, args=(shared_cache, ("c", "col", 1), arr)
+    )
+    proc.start()
+    proc.join()
+    assert proc.exitcode == 0
+    out = shared_cache.get(("c", "col", 1))
+    assert out.dtype == np.float32
+    assert np.array_equal(out, arr)
+    assert shared_cache.get(("c", "col", 2)) is None
+    assert (shared_cache.hits, shared_cache.misses) == (1, 1)
+
+
+def test_shared_cache_stats_are_per_process(shared_cache):
+    arr = np.arange(4, dtype=np.int64)
+    shared_cache.put("a", arr)
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=_lookup, args=(shared_cache, ["a", "a", "b"], results)
+    )
+    proc.start()
+    assert results.get(timeout=30) == (2, 1)
+    proc.join()
+    assert proc.exitcode == 0
+    # lookups of the other process are not counted here
+    assert (shared_cache.hits, shared_cache.misses) == (0, 0)
+    shared_cache.get("a")
+    assert (shared_cache.hits, shared_cache.misses) == (1, 0)
+
+
+def test_shared_cache_eviction(shared_cache):
+    arr = np.zeros(10, dtype=np.int64)  # 80 bytes
+    shared_cache.put("a", arr)
+    shared_cache.put("b", arr + 1)
+    assert len(shared_cache) == 2
+    # arena is full, write wraps around and evicts "a"
+    shared_cache.put("c", arr + 2)
+    assert "a" not in shared_cache
+    assert np.array_equal(shared_cache.get("b"), arr + 1)
+    assert np.array_equal(shared_cache.get("c"), arr + 2)
+    assert shared_cache.currsize == 160
+    shared_cache.clear()
+    assert len(shared_cache) == 0
+
+
+def test_shared_cache_probing(shared_cache):
+    # 8 entries in a table of 16 slots, evictions shift the probe sequences back
+    for i in range(100):
+        shared_cache.put(i, np.full(2, i, dtype=np.int32))
+        live = range(max(0, i - 7), i + 1)
+        assert len(shared_cache) == len(live)
+        assert i - 8 not in shared_cache
+        assert all(shared_cache.get(key)[0] == key for key in live)
+    assert shared_cache.currsize == 8 * 8
+
+
+def test_shared_cache_hit_is_cheaper_than_a_read(reader_stock):
+    stock = StockRoom(data_cache_size=2**20, shared_data_cache=True)
+    cached, uncached = stock.data["ndcol"], reader_stock.data["ndcol"]
+    assert np.array_equal(cached[1], uncached[1])
+    hit = min(timeit.repeat(lambda: cached[1], number=200, repeat=5))
+    read = min(timeit.repeat(lambda: uncached[1], number=200, repeat=5))
+    assert stock.data.cache.hits >= 1000
+    assert hit < read
+    stock.close()
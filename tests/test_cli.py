@@ -1,4 +1,6 @@
 import inspect
+import subprocess
+import sys
 from pathlib import Path
 
 import numpy as np
@@ -18,6 +20,32 @@ def test_version():
     assert res.stdout == f"stock, version {stockroom.__version__}\n"
 
 
+def test_startup_imports():
+    # regression test for the CLI startup time, see benchmarks/cli_startup.py
+    code = (
+        "import sys\n"
+        "from stockroom.cli import stock\n"
+        "from stockroom.external.importer.utils import importers_dict\n"
+        "try:\n"
+        "    stock(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "assert 'torchvision' in importers_dict\n"
+        "heavy = ('hangar', 'torch', 'torchvision', 'numpy', 'rich')\n"
+        "print(','.join(m for m in heavy if m in sys.modules))\n"
+    )
+    root = Path(__file__).resolve().parents[1]
+    res = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=root,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert res.returncode == 0, res.stderr
+    assert res.stdout.splitlines()[-1] == ""
+
+
 @pytest.mark.filterwarnings("ignore: initializing stock")
 def test_init_repo():
     runner = CliRunner()
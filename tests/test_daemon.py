@@ -0,0 +1,152 @@
+import sys
+import threading
+
+import numpy as np
+import pytest
+import stockroom.cli as cli
+import torch
+from click.testing import CliRunner
+from stockroom import StockRoom
+from stockroom.daemon import WriterClient, WriterDaemon
+from test_model import get_model
+
+
+@pytest.fixture()
+def daemon(repo_with_col):
+    daemon = WriterDaemon(commit_interval=None)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    daemon.ready.wait(5)
+    yield daemon
+    daemon.shutdown()
+    thread.join(5)
+    daemon.stock._repo._env._close_environments()
+
+
+def test_concurrent_clients(daemon):
+    model = get_model()
+
+    def run(rank):
+        with WriterClient(log_buffer_size=4) as client:
+            client[f"rank-{rank}"] = rank
+            for step in range(10):
+                client.log(step, **{f"loss-{rank}": step / 10})
+            client.save_model(f"model-{rank}", model.state_dict())
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    with WriterClient() as client:
+        digest = client.commit("writes from all the ranks")
+        # nothing new to commit
+        assert client.commit() == digest
+
+    stock = StockRoom()
+    assert stock.head == digest
+    assert sorted(stock.experiment.keys()) == ["rank-0", "rank-1", "rank-2"]
+    steps, values = stock.experiment.series("loss-2")
+    assert np.array_equal(steps, np.arange(10))
+    for k, v in stock.model["model-1"].items():
+        assert torch.equal(v, model.state_dict()[k])
+    stock.close()
+
+
+def test_errors_are_raised_by_clients(daemon):
+    with WriterClient() as client:
+        with pytest.raises(TypeError):
+            client["wrongdata"] = b"hi"
+        with pytest.raises(TypeError):
+            client.save_model("model", set())
+        with pytest.raises(RuntimeError, match="ValueError"):
+            client.save_model(
+                "model", get_model().state_dict(), packed=True, dedup=True
+            )
+        # the daemon keeps serving the client after an error
+        client["lr"] = 0.1
+        client.commit()
+
+
+def test_failed_batches(daemon):
+    head = daemon.stock.head
+    client = WriterClient()
+    client["lr"] = 0.1
+    client.log(0, loss=1.0)
+    with pytest.raises(RuntimeError, match="ValueError"):
+        # the tags and metrics are written before the model fails
+        client.save_model("model", get_model().state_dict(), store_dtype="int4")
+    # a failed send keeps the tags and metrics for the next one
+    assert client._tags == {"lr": 0.1} and client._metrics == {"loss": [(0, 1.0)]}
+    with WriterClient() as other:
+        # the partially applied batch is committed
+        digest = other.commit("partial batch")
+    assert digest != head
+    client.commit("resent")
+    assert client._tags == {} and client._metrics == {}
+    client.close()
+    stock = StockRoom()
+    assert stock.experiment["lr"] == 0.1
+    stock.close()
+
+
+def test_unpicklable_errors(daemon, monkeypatch):
+    def fail(payload):
+        raise ValueError(threading.Lock())
+
+    monkeypatch.setattr(daemon, "_apply", fail)
+    with WriterClient() as client:
+        with pytest.raises(RuntimeError, match="ValueError"):
+            client.save_model("model", get_model().state_dict())
+
+
+def test_bfloat16_model(daemon):
+    state_dict = {"weight": torch.randn(3, 4).bfloat16(), "step": torch.tensor(2)}
+    with WriterClient() as client:
+        client.save_model("model", state_dict)
+        client.commit("bfloat16 model")
+    stock = StockRoom()
+    loaded = stock.model["model"]
+    assert loaded["weight"].dtype == torch.bfloat16
+    assert torch.equal(loaded["weight"], state_dict["weight"])
+    assert torch.equal(loaded["step"], state_dict["step"])
+    stock.close()
+
+
+def test_windows_is_not_supported(repo_with_col, monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+    with pytest.raises(RuntimeError, match="Windows"):
+        WriterDaemon()
+
+
+def test_pending_writes_committed_on_shutdown(repo_with_col):
+    daemon = WriterDaemon(commit_interval=None)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    daemon.ready.wait(5)
+    with WriterClient() as client:
+        client["lr"] = 0.1
+    daemon.shutdown()
+    thread.join(5)
+    assert not daemon.socket_path.exists()
+    stock = StockRoom()
+    assert stock.experiment["lr"] == 0.1
+    stock.close()
+    daemon.stock._repo._env._close_environments()
+
+
+def test_no_daemon(repo_with_col):
+    with pytest.raises(ConnectionRefusedError):
+        WriterClient()
+
+
+def test_cli_commit_goes_through_daemon(daemon):
+    with WriterClient() as client:
+        client["epochs"] = 10
+    res = CliRunner().invoke(cli.commit, ["-m", "from the cli"])
+    assert res.exit_code == 0
+    assert "Commit Successful" in res.stdout
+    stock = StockRoom()
+    assert stock.experiment["epochs"] == 10
+    stock.close()
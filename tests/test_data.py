@@ -1,5 +1,8 @@
 import numpy as np
 import pytest
+import stockroom.storages.data as data
+import torch
+from stockroom import StockRoom
 
 
 def test_save_data(writer_stock):
@@ -42,3 +45,207 @@ def test_fetch_non_existing_sample_key(writer_stock):
     col[1] = arr
     with pytest.raises(KeyError):
         col[2]
+
+
+def test_get_set_many(writer_stock):
+    arr = np.arange(60).reshape(3, 4, 5)
+    writer_stock.data.set_many("ndcol", arr)
+    writer_stock.data.set_many("ndcol", {"a": arr[0] + 1, "b": arr[1] + 1})
+    writer_stock.commit("added data")
+    out = writer_stock.data.get_many("ndcol", [2, "b", 0])
+    assert out.shape == (3, 4, 5)
+    assert np.allclose(out[0], arr[2])
+    assert np.allclose(out[1], arr[1] + 1)
+    assert np.allclose(out[2], arr[0])
+    with pytest.raises(KeyError):
+        writer_stock.data.get_many("ndcol", [0, "wrongkey"])
+    with pytest.raises(ValueError):
+        writer_stock.data.set_many("ndcol", arr, keys=["c", "d"])
+    assert "c" not in writer_stock.data["ndcol"]
+
+
+def test_get_many_without_stacking(writer_stock):
+    writer_stock.data.index.create_columns([("add_str_column", {"name": "strcol"})])
+    writer_stock.data.set_many("strcol", {"a": "first", "b": "second"})
+    writer_stock.data.set_many("ndcol", np.arange(40).reshape(2, 4, 5))
+    writer_stock.commit("added data")
+    assert writer_stock.data.get_many("strcol", ["b", "a"]) == ["second", "first"]
+
+    col = writer_stock.data["ndcol"]
+
+    class Column:
+        # a column that doesn't expose the backend internals
+        column_type, column_layout, shape, dtype = "ndarray", "flat", (4, 5), col.dtype
+
+        def __getitem__(self, key):
+            return col[key]
+
+    out = data.read_samples(Column(), [1, 0])
+    assert np.array_equal(out, np.arange(40).reshape(2, 4, 5)[::-1])
+
+
+def test_declare_columns(writer_stock):
+    writer_stock.data.declare_columns(
+        {
+            "ndcol": np.zeros(3),
+            "image": np.zeros((3, 4), dtype=np.float32),
+            "label": {"shape": (), "dtype": np.int64},
+        }
+    )
+    assert sorted(writer_stock.data.keys()) == ["image", "label", "ndcol"]
+    assert writer_stock.data["ndcol"].shape == (4, 5)
+    assert writer_stock.data["image"].dtype == np.float32
+    writer_stock.data.set_many("label", np.arange(3))
+    writer_stock.commit("added labels")
+    assert np.array_equal(writer_stock.data.get_many("label", [0, 1, 2]), [0, 1, 2])
+
+
+def test_data_cache(reader_stock):
+    reader_stock.close()
+    stock = StockRoom(data_cache_size=200)
+    arr = np.arange(20).reshape(4, 5)
+    assert np.allclose(stock.data["ndcol"][1], arr)
+    assert np.allclose(stock.data["ndcol", 1], arr)
+    assert (stock.data.cache.hits, stock.data.cache.misses) == (1, 1)
+    assert not stock.data["ndcol"][1].flags.writeable
+    assert len(stock.data["ndcol"]) == 1
+
+    with stock.enable_write():
+        stock.data["ndcol"][1] = arr + 1
+        stock.data["ndcol"][2] = arr
+    stock.update_head()
+    assert len(stock.data.cache) == 0
+    assert np.allclose(stock.data["ndcol"][1], arr + 1)
+    assert stock.data.cache.currsize == arr.nbytes
+    stock.data["ndcol"][2]
+    # maxsize is 200 bytes and hence the least recently used sample is evicted
+    assert stock.data.cache.currsize == arr.nbytes
+    assert (stock.data.cache.hits, stock.data.cache.misses) == (2, 3)
+    stock._repo._env._close_environments()
+
+    # samples too big for the cache are not shared and hence are writable
+    stock = StockRoom(data_cache_size=100)
+    assert stock.data["ndcol"][1].flags.writeable
+    assert len(stock.data.cache) == 0
+    stock._repo._env._close_environments()
+
+
+def test_ingest(writer_stock):
+    def samples(n):
+        for i in range(n):
+            yield np.full((2, 3), i, dtype=np.float32), i, np.arange(i % 3 + 1)
+
+    reports = []
+    report = writer_stock.data.ingest(
+        ["image", "label", "ragged"], samples(10), batch_size=4, callback=reports.append
+    )
+    assert (report.samples, report.batches) == (10, 3)
+    assert report.nbytes == 10 * (24 + 8) + sum(8 * (i % 3 + 1) for i in range(10))
+    assert len(reports) == 3 and report.samples_per_second > 0
+    assert np.array_equal(writer_stock.data["image", 9], np.full((2, 3), 9))
+    assert writer_stock.data["label"].dtype == np.int64
+    assert writer_stock.data["ragged"].schema_type == "variable_shape"
+    assert np.array_equal(writer_stock.data["ragged", 5], [0, 1, 2])
+
+    # appends to the existing columns, casting python scalars to the column dtype
+    report = writer_stock.data.ingest(
+        {"label": None, "weight": {"shape": (), "dtype": np.float64}},
+        ({"label": i, "weight": i / 2} for i in range(3)),
+    )
+    assert report.samples == 3
+    assert writer_stock.data["label", 12] == 2
+    assert writer_stock.data["weight", 12] == 1.0
+    writer_stock.data.ingest("label", iter([]))
+    assert len(writer_stock.data["label"]) == 13
+
+    with pytest.raises(ValueError):
+        writer_stock.data.ingest(["image", "label"], [(np.zeros((2, 3)),)])
+    with pytest.raises(TypeError):
+        writer_stock.data.ingest("label", [1.5])
+
+
+def test_ingest_after_gaps(writer_stock):
+    col = writer_stock.data["ndcol"]
+    for key in (0, 1, 5):
+        col[key] = np.full((4, 5), key)
+    col["name"] = np.zeros((4, 5), dtype=np.int64)
+    items = (np.full((4, 5), 100 + i) for i in range(4))
+    writer_stock.data.ingest("ndcol", items)
+    # appended after the largest key instead of at len(column) == 4
+    assert writer_stock.data["ndcol", 5][0, 0] == 5
+    assert sorted(k for k in col.keys() if isinstance(k, int)) == [0, 1, 5, 6, 7, 8, 9]
+    assert writer_stock.data["ndcol", 9][0, 0] == 103
+
+
+def test_ingest_with_reader(reader_stock):
+    with pytest.raises(PermissionError):
+        reader_stock.data.ingest("ndcol", [np.zeros((4, 5))])
+
+
+def test_stats(writer_stock, monkeypatch):
+    stock = writer_stock
+    arr = np.arange(20).reshape(4, 5)
+    stock.data.set_many("ndcol", {0: arr, 1: arr + 1})
+    stats = stock.data.stats("ndcol")
+    # not committed yet, summarized on the fly
+    assert (stats["count"], stats["nbytes"]) == (2, 2 * arr.nbytes)
+    stock.commit("two samples")
+    stats = stock.data.stats("ndcol")
+    assert (stats["count"], stats["dtype"], stats["shape"]) == (2, np.int64, (4, 5))
+    assert "min" not in stats
+
+    stock.data.enable_value_stats("ndcol")
+    stock.data.ingest("ragged", [np.arange(3.0), np.arange(5.0)])
+    stock.commit("value stats")
+    stats = stock.data.stats()
+    assert (stats["ndcol"]["min"], stats["ndcol"]["max"]) == (0, 20)
+    assert stats["ndcol"]["mean"] == pytest.approx(10)
+    assert stats["ragged"]["min_shape"] == (3,)
+    assert stats["ragged"]["max_shape"] == (5,)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Statistics computed from scratch")
+
+    # only the added sample is folded in
+    stock.data["ndcol"][2] = arr + 30
+    empty_stats = data.empty_stats
+    monkeypatch.setattr(data, "empty_stats", fail)
+    stock.commit("one more sample")
+    monkeypatch.setattr(data, "empty_stats", empty_stats)
+    stats = stock.data.stats("ndcol")
+    assert (stats["count"], stats["max"]) == (3, 49)
+    assert stats["mean"] == pytest.approx((9.5 + 10.5 + 39.5) / 3)
+
+    # deletions rebuild the statistics of the column
+    del stock.data["ndcol"][2]
+    stock.commit("deleted a sample")
+    stock.close()
+    stock = StockRoom()
+    stats = stock.data.stats("ndcol")
+    assert (stats["count"], stats["max"]) == (2, 20)
+    assert stock.data.stats("ragged")["count"] == 2
+    with pytest.raises(KeyError):
+        stock.data.stats("wrongcol")
+    stock.close()
+
+
+def test_stats_untouched_by_model_commits(writer_stock, monkeypatch):
+    stock = writer_stock
+    stock.data.set_many("ndcol", {0: np.arange(20).reshape(4, 5)})
+    stock.commit("data")
+    manifest = dict(stock.accessor.columns[stock.data.statskey].items())
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Data columns looked at in a commit without data")
+
+    monkeypatch.setattr(data, "staged_diff", fail)
+    monkeypatch.setattr(data, "add_samples", fail)
+    # reading a column doesn't mark it as written
+    assert stock.data["ndcol", 0].shape == (4, 5)
+    stock.model["model"] = {"weight": torch.ones(2, 3)}
+    stock.experiment["lr"] = 0.1
+    stock.commit("model only")
+    assert dict(stock.accessor.columns[stock.data.statskey].items()) == manifest
+    with pytest.raises(AssertionError):
+        stock.data["ndcol"][1] = np.zeros((4, 5), dtype=np.int64)
+        stock.commit("data again")
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from stockroom import StockDataset, StockIterableDataset, StockRoom
+from torch.utils.data import DataLoader
+
+
+@pytest.fixture()
+def dataset_stock(writer_stock):
+    arr = np.arange(20).reshape(4, 5)
+    writer_stock.data.set_many("ndcol", np.stack([arr + i for i in range(10)]))
+    writer_stock.commit("added data")
+    writer_stock.close()
+    stock = StockRoom()
+    yield stock
+    stock._repo._env._close_environments()
+
+
+def test_map_style_dataset(dataset_stock):
+    dataset = StockDataset(dataset_stock, ["ndcol"])
+    assert len(dataset) == 10
+    (sample,) = dataset[3]
+    assert torch.equal(sample, torch.arange(20).reshape(4, 5) + 3)
+    loader = DataLoader(dataset, batch_size=4)
+    batches = list(loader)
+    assert [len(b[0]) for b in batches] == [4, 4, 2]
+    assert torch.equal(batches[1][0][0], torch.arange(20).reshape(4, 5) + 4)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_iterable_dataset(dataset_stock, num_workers):
+    dataset = StockIterableDataset(dataset_stock, ["ndcol"], batch_size=3, prefetch=1)
+    assert len(dataset) == 4
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    seen = torch.cat([batch for (batch,) in loader])
+    assert seen.shape == (10, 4, 5)
+    # each worker reads a disjoint set of batches
+    assert sorted(seen[:, 0, 0].tolist()) == list(range(10))
+
+
+def test_iterable_dataset_shuffle(dataset_stock):
+    dataset = StockIterableDataset(
+        dataset_stock, ["ndcol"], batch_size=4, shuffle=True, drop_last=True
+    )
+    first = torch.cat([batch for (batch,) in dataset])
+    assert first.shape == (8, 4, 5)
+    assert torch.equal(first, torch.cat([batch for (batch,) in dataset]))
+    dataset.set_epoch(1)
+    assert not torch.equal(first, torch.cat([batch for (batch,) in dataset]))
+
+
+def test_dataset_reads_through_cache(dataset_stock):
+    stock = StockRoom(data_cache_size=2**20)
+    dataset = StockDataset(stock, ["ndcol"])
+    (sample,) = dataset[3]
+    assert (stock.data.cache.hits, stock.data.cache.misses) == (0, 1)
+    # the cached sample is read-only, the tensor must not share it
+    sample += 1
+    assert torch.equal(dataset[3][0], torch.arange(20).reshape(4, 5) + 3)
+    assert stock.data.cache.hits == 1
+
+    batch = dataset.__getitems__([3, 4, 5])
+    assert (stock.data.cache.hits, stock.data.cache.misses) == (2, 3)
+    assert torch.equal(batch[2][0], torch.arange(20).reshape(4, 5) + 5)
+
+    iterable = StockIterableDataset(stock, ["ndcol"], batch_size=5, prefetch=0)
+    seen = torch.cat([batch for (batch,) in iterable])
+    assert sorted(seen[:, 0, 0].tolist()) == list(range(10))
+    assert (stock.data.cache.hits, stock.data.cache.misses) == (5, 10)
+    stock._repo._env._close_environments()
@@ -1,4 +1,7 @@
+import numpy as np
 import pytest
+from stockroom import StockRoom, parser
+from stockroom.storages import experiment
 
 
 def test_basic(writer_stock):
@@ -18,3 +21,76 @@ def test_basic(writer_stock):
 def test_save_string(writer_stock):
     with pytest.raises(TypeError):
         writer_stock.experiment["wrongdata"] = bytes("hi")
+
+
+def test_update(writer_stock):
+    writer_stock.experiment.update({"lr": 0.01, "epochs": 500, "optimizer": "adam"})
+    writer_stock.commit("Saved tags")
+    assert writer_stock.experiment.keys() == ("lr", "epochs", "optimizer")
+    assert writer_stock.experiment["epochs"] == 500
+
+    # nothing is written if any of the values is invalid
+    with pytest.raises(TypeError):
+        writer_stock.experiment.update({"momentum": 0.9, "wrongdata": b"hi"})
+    assert "momentum" not in writer_stock.experiment.keys()
+
+
+def test_log(writer_stock):
+    writer_stock.experiment.log_buffer_size = 4
+    writer_stock.experiment.log(0, loss=1.5, accuracy=0.5)
+    assert writer_stock.experiment._buffered == 2
+    writer_stock.experiment.log(1, loss=1.0, accuracy=np.float32(0.75))
+    assert writer_stock.experiment._buffered == 0
+    writer_stock.experiment.log(2, loss=0.5)
+    writer_stock.commit("Logged metrics")
+
+    assert writer_stock.experiment.keys() == tuple()
+    assert sorted(writer_stock.experiment.metrics()) == ["accuracy", "loss"]
+    steps, values = writer_stock.experiment.series("loss")
+    assert steps.dtype == np.int64 and values.dtype == np.float64
+    assert np.array_equal(steps, [0, 1, 2])
+    assert np.array_equal(values, [1.5, 1.0, 0.5])
+    with pytest.raises(TypeError):
+        writer_stock.experiment.log(3, optimizer="adam")
+    with pytest.raises(KeyError):
+        writer_stock.experiment.series("wrongname")
+
+
+def test_log_with_reader(reader_stock):
+    with pytest.raises(PermissionError):
+        reader_stock.experiment.log(0, loss=1.0)
+    assert reader_stock.experiment.metrics() == ()
+
+
+def test_close_after_failed_flush(writer_stock, monkeypatch):
+    writer_stock.experiment.log(0, loss=1.0)
+
+    def fail(buffer):
+        raise RuntimeError("flush failed")
+
+    monkeypatch.setattr(writer_stock.experiment, "_write_series", fail)
+    with pytest.raises(RuntimeError):
+        writer_stock.close()
+    # the writer lock is released
+    StockRoom(enable_write=True).close()
+
+
+def test_series_range(writer_stock, monkeypatch):
+    monkeypatch.setattr(experiment, "METRIC_CHUNK_SIZE", 4)
+    for step in range(10):
+        writer_stock.experiment.log(step, loss=step / 10)
+        if step % 3 == 0:
+            # partially filled chunks are filled up on the next flush
+            writer_stock.experiment.flush()
+    writer_stock.commit("Logged metrics")
+
+    chunks = writer_stock.accessor[parser.metric_metakey(), "loss"]
+    assert parser.destringify_chunks(chunks) == [(0, 3, 4), (4, 7, 4), (8, 9, 2)]
+
+    steps, values = writer_stock.experiment.series("loss", 3, 9)
+    assert np.array_equal(steps, np.arange(3, 9))
+    assert np.allclose(values, np.arange(3, 9) / 10)
+    steps, values = writer_stock.experiment.series("loss", start=8)
+    assert np.array_equal(steps, [8, 9])
+    steps, values = writer_stock.experiment.series("loss", stop=0)
+    assert len(steps) == len(values) == 0
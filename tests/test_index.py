@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+from stockroom import parser
+from stockroom.storages.index import ColumnIndex
+from stockroom.utils import clean_create_column
+
+
+def test_column_kinds(writer_stock):
+    writer_stock.model["model"] = {"weight": torch.ones(2, 3)}
+    writer_stock.experiment["lr"] = 0.01
+    writer_stock.commit("adding model and tag")
+    index = writer_stock.index
+    assert index.kind("ndcol") == "data"
+    assert index.kind(parser.modelkey("model", "float32")) == "model"
+    assert index.kind(parser.tagkey()) == "experiment"
+    assert index.kind(parser.model_registrykey()) == "internal"
+    assert index.kind("wrongname") is None
+    assert index.owners("model") == ("model",)
+    assert index.names("data") == ("ndcol",)
+    assert len(index) == len(writer_stock.accessor.columns)
+
+
+def test_index_updates(writer_stock):
+    index = writer_stock.index
+    assert "newcol" not in index
+    index.create_columns(
+        [("add_ndarray_column", {"name": "newcol", "shape": (2,), "dtype": np.int64})]
+    )
+    assert index.kind("newcol") == "data"
+    index.create_columns([("columns.delete", {"column": "newcol"})])
+    assert "newcol" not in index
+
+    # columns created without the index are picked up on the next lookup
+    clean_create_column(
+        writer_stock.accessor, [("add_str_column", {"name": "othercol"})]
+    )
+    assert sorted(writer_stock.data.keys()) == ["ndcol", "othercol"]
+    # a drop and a create keep the number of columns the same
+    clean_create_column(
+        writer_stock.accessor,
+        [
+            ("columns.delete", {"column": "othercol"}),
+            ("add_str_column", {"name": parser.tagkey()}),
+        ],
+    )
+    assert len(index) == 2
+    assert "othercol" not in index
+    assert index.kind(parser.tagkey()) == "experiment"
+
+
+def test_lookups_do_not_list_columns(writer_stock, monkeypatch):
+    index = writer_stock.index
+    assert index.kind("ndcol") == "data"
+
+    def fail(self):
+        raise AssertionError("Column names listed on a lookup")
+
+    monkeypatch.setattr(type(writer_stock.accessor.columns), "keys", fail)
+    assert "ndcol" in index and index.names("data") == ("ndcol",)
+    index.create_columns([("add_str_column", {"name": "othercol"})])
+    assert index.kind("othercol") == "data"
+
+
+def test_index_without_storage(writer_stock):
+    index = ColumnIndex(writer_stock.accessor)
+    assert index.names("model") == ()
+    assert index.owners("experiment") == ()
@@ -3,6 +3,11 @@ from copy import deepcopy
 import numpy as np
 import pytest
 import torch
+from hangar.columns.layout_flat import FlatSampleWriter
+from stockroom import parser
+from stockroom.storages import index
+from stockroom.storages.model import _read_sample
+from stockroom.utils import clean_create_column, memmap_sample
 
 
 def get_model():
@@ -12,6 +17,12 @@ def get_model():
     return torch_model
 
 
+@pytest.fixture(params=["layered", "packed", "dedup"])
+def layout_kwargs(request):
+    # keyword arguments of Model.save and Model.declare for each layout
+    return {"packed": request.param == "packed", "dedup": request.param == "dedup"}
+
+
 # TODO: Ingore warning has no effect
 @pytest.mark.filterwarnings("ignore:the imp module is deprecated:DeprecationWarning")
 def test_saving_model(writer_stock):
@@ -92,3 +103,341 @@ def test_load_nonexisting_key(writer_stock):
     with pytest.raises(KeyError) as error:
         writer_stock.model["wrongname"]
     assert "Model with key wrongname not found" == error.value.args[0]
+
+
+def test_saving_packed_model(writer_stock):
+    model = get_model()
+    old_weights = model.state_dict()
+    writer_stock.model.save("model", old_weights, packed=True)
+    writer_stock.commit("adding packed model")
+    assert writer_stock.model.keys() == ("model",)
+
+    new_weights = writer_stock.model["model"]
+    assert list(new_weights.keys()) == list(old_weights.keys())
+    for k in old_weights:
+        assert new_weights[k].shape == old_weights[k].shape
+        assert np.allclose(old_weights[k], new_weights[k])
+    model.load_state_dict(new_weights)
+
+    # switching back to layered layout on the same name
+    writer_stock.model.save("model", old_weights)
+    writer_stock.commit("adding layered model")
+    for k, v in writer_stock.model.load("model").items():
+        assert np.allclose(old_weights[k], v)
+
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_mmap_load(writer_stock, packed):
+    model = get_model()
+    old_weights = model.state_dict()
+    writer_stock.model.save("model", old_weights, packed=packed, backend="10")
+    writer_stock.commit("adding model")
+
+    new_weights = writer_stock.model.load("model", mmap=True)
+    for k in old_weights:
+        assert np.allclose(old_weights[k], new_weights[k])
+    model.load_state_dict(new_weights)
+
+    col = writer_stock.data[
+        next(k for k in writer_stock.accessor.keys() if "float32" in k)
+    ]
+    sample = memmap_sample(col, next(iter(col.keys())))
+    assert isinstance(sample.base, np.memmap)
+    assert not sample.flags.writeable
+
+
+def test_mmap_load_fallback(writer_stock):
+    model = get_model()
+    old_weights = model.state_dict()
+    writer_stock.model.save("model", old_weights, packed=True, backend="00")
+    writer_stock.commit("adding model")
+    new_weights = writer_stock.model.load("model", mmap=True)
+    for k in old_weights:
+        assert np.allclose(old_weights[k], new_weights[k])
+
+    col = writer_stock.data[
+        next(k for k in writer_stock.accessor.keys() if "float32" in k)
+    ]
+    assert memmap_sample(col, 0) is None
+
+
+def test_mmap_load_unknown_backend_layout(writer_stock):
+    writer_stock.model.save("model", get_model().state_dict(), backend="10")
+    writer_stock.commit("adding model")
+    col = writer_stock.data[
+        next(k for k in writer_stock.accessor.keys() if "float32" in k)
+    ]
+
+    class Column:
+        # as if hangar kept the file handles of the backends elsewhere
+        _samples = col._samples
+
+        def __getitem__(self, key):
+            return col[key]
+
+    assert memmap_sample(Column(), 0) is None
+    assert np.array_equal(_read_sample(Column(), 0, mmap=True), col[0])
+
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_incremental_save(writer_stock, monkeypatch, packed):
+    written = []
+    original = FlatSampleWriter.__setitem__
+
+    def counting_setitem(col, key, value):
+        if isinstance(value, np.ndarray):
+            written.append((col.column, key))
+        original(col, key, value)
+
+    monkeypatch.setattr(FlatSampleWriter, "__setitem__", counting_setitem)
+    model = get_model()
+    model[2].bias.data = model[2].bias.data.double()
+    writer_stock.model.save("model", model.state_dict(), packed=packed)
+    writer_stock.commit("adding model")
+    assert len(written) == (2 if packed else 4)
+
+    written.clear()
+    writer_stock.model.save("model", model.state_dict(), packed=packed)
+    assert written == []
+
+    def stored():
+        metacol = writer_stock.accessor.columns[parser.model_metakey("model")]
+        float32 = next(c for c in writer_stock.model.columns("model") if "32" in c)
+        specs = writer_stock.accessor.columns[float32]._samples
+        return parser.destringify(metacol["digests"]), repr(dict(specs))
+
+    digests, float32_specs = stored()
+    with torch.no_grad():
+        model[2].bias.add_(1.0)
+    writer_stock.model.save("model", model.state_dict(), packed=packed)
+    if packed:
+        assert written == [(parser.model_packedkey("model", "float64"), 0)]
+    else:
+        assert written == [(parser.modelkey("model", "float64"), 3)]
+    new_digests, new_float32_specs = stored()
+    # only the digest of the changed layer moves and the other samples are reused
+    assert [a != b for a, b in zip(digests, new_digests)] == [False] * 3 + [True]
+    assert new_float32_specs == float32_specs
+    writer_stock.commit("updated model")
+    loaded = writer_stock.model["model"]
+    for k, v in model.state_dict().items():
+        assert torch.equal(loaded[k], v)
+
+
+def test_dedup_across_models(writer_stock):
+    backbone = get_model()
+    writer_stock.model.save("base", backbone.state_dict(), dedup=True)
+    writer_stock.commit("adding base model")
+    layer_col = writer_stock.data.accessor.columns["_STKL--_float32"]
+    assert len(layer_col) == 4
+
+    finetuned = deepcopy(backbone)
+    with torch.no_grad():
+        finetuned[2].weight.add_(1.0)
+    writer_stock.model.save("finetuned", finetuned.state_dict(), dedup=True)
+    writer_stock.commit("adding finetuned model")
+    # only the changed layer is stored again
+    assert len(layer_col) == 5
+    assert sorted(writer_stock.model.keys()) == ["base", "finetuned"]
+
+    for name, model in [("base", backbone), ("finetuned", finetuned)]:
+        loaded = writer_stock.model[name]
+        for k, v in model.state_dict().items():
+            assert torch.equal(loaded[k], v)
+
+    with pytest.raises(ValueError):
+        writer_stock.model.save("model", backbone.state_dict(), packed=True, dedup=True)
+
+
+@pytest.mark.parametrize("packed", [True, False])
+def test_architecture_change_reuses_columns(writer_stock, packed):
+    writer_stock.model.save("model", get_model().state_dict(), packed=packed)
+    writer_stock.commit("adding model")
+    columns = set(writer_stock.accessor.keys())
+    assert set(writer_stock.model.columns("model")) < columns
+
+    wider = torch.nn.Sequential(torch.nn.Linear(2, 300), torch.nn.Linear(300, 1))
+    writer_stock.model.save("model", wider.state_dict(), packed=packed)
+    writer_stock.commit("changing architecture")
+    assert set(writer_stock.accessor.keys()) == columns
+    for k, v in writer_stock.model["model"].items():
+        assert torch.equal(v, wider.state_dict()[k])
+    with pytest.raises(KeyError):
+        writer_stock.model.columns("wrongname")
+
+
+def test_load_legacy_layout(writer_stock):
+    state_dict = get_model().state_dict()
+    weights = [w.numpy() for w in state_dict.values()]
+    longest = max(w.size for w in weights)
+    clean_create_column(
+        writer_stock.accessor,
+        [
+            ("add_str_column", {"name": parser.model_metakey("old")}),
+            (
+                "add_ndarray_column",
+                {
+                    "name": parser.legacy_model_shapekey("old", longest),
+                    "shape": 10,
+                    "dtype": np.array(1).dtype,
+                    "variable_shape": True,
+                },
+            ),
+            (
+                "add_ndarray_column",
+                {
+                    "name": parser.legacy_modelkey("old", longest, "float32"),
+                    "shape": longest,
+                    "dtype": np.float32,
+                    "variable_shape": True,
+                },
+            ),
+        ],
+    )
+    shape_col = writer_stock.accessor[parser.legacy_model_shapekey("old", longest)]
+    weight_col = writer_stock.accessor[
+        parser.legacy_modelkey("old", longest, "float32")
+    ]
+    for i, w in enumerate(weights):
+        weight_col[i] = w.reshape(-1)
+        shape_col[i] = np.array(w.shape)
+    metacol = writer_stock.accessor[parser.model_metakey("old")]
+    metacol["library"] = "torch"
+    metacol["libraryVersion"] = str(torch.__version__)
+    metacol["dtypes"] = parser.stringify(["float32"] * len(weights))
+    metacol["numLayers"] = str(len(weights))
+    metacol["layers"] = parser.stringify(state_dict.keys())
+    metacol["longest"] = str(longest)
+    writer_stock.commit("adding legacy model")
+    assert writer_stock.model.keys() == ("old",)
+
+    # the registry is created with the legacy models in it
+    writer_stock.model["new"] = get_model().state_dict()
+    writer_stock.commit("adding model")
+    assert sorted(writer_stock.model.keys()) == ["new", "old"]
+    for k, v in writer_stock.model["old"].items():
+        assert torch.equal(state_dict[k], v)
+
+
+def test_declare_model(writer_stock, monkeypatch, layout_kwargs):
+    model = get_model()
+    writer_stock.declare_model("model", model.state_dict(), **layout_kwargs)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Column created after declaration")
+
+    monkeypatch.setattr(index, "clean_create_column", fail)
+    writer_stock.model.save("model", model.state_dict(), **layout_kwargs)
+    writer_stock.experiment["lr"] = 0.01
+    writer_stock.experiment.log(0, loss=1.0)
+    writer_stock.commit("adding model")
+    for k, v in writer_stock.model["model"].items():
+        assert torch.equal(v, model.state_dict()[k])
+
+
+def test_declare_model_from_shapes(writer_stock):
+    spec = {"weight": ((3, 2), "float32"), "bias": ((3,), np.float64)}
+    writer_stock.model.declare("model", spec)
+    assert writer_stock.index.kind(parser.modelkey("model", "float64")) == "model"
+    with pytest.raises(TypeError):
+        writer_stock.model.declare("model", set())
+
+
+@pytest.mark.parametrize("store_dtype", ["float16", "bfloat16", "int8-per-channel"])
+def test_store_dtype(writer_stock, layout_kwargs, store_dtype):
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8))
+    state_dict = model.state_dict()
+    state_dict["half"] = torch.randn(3, 2).bfloat16()
+    state_dict["scalar"] = torch.tensor(0.5)
+    state_dict["empty"] = torch.zeros(0, 3)
+    writer_stock.model.save(
+        "model", state_dict, store_dtype=store_dtype, **layout_kwargs
+    )
+    writer_stock.commit("quantized")
+    stored = {col.rsplit("--_", 1)[-1] for col in writer_stock.model.columns("model")}
+    expected = {"int8": "int8-per-channel", "uint16": "bfloat16"}.get
+    assert {expected(x, x) for x in stored} >= {store_dtype, "meta"}
+
+    loaded = writer_stock.model.load("model")
+    restored = writer_stock.model.load("model", restore_dtype=True)
+    # buffers that are not floating point are stored as they are
+    assert torch.equal(
+        loaded["1.num_batches_tracked"], state_dict["1.num_batches_tracked"]
+    )
+    shapes = writer_stock.model.open("model").shapes
+    for k, v in state_dict.items():
+        assert restored[k].dtype == v.dtype
+        assert shapes[k] == loaded[k].shape == restored[k].shape == v.shape
+        if not v.is_floating_point() or not v.numel():
+            continue
+        if store_dtype == "int8-per-channel":
+            assert loaded[k].dtype == v.dtype
+            # off by at most half of the scale of the channel
+            channels = v.float().reshape(v.shape[0] if v.dim() > 1 else 1, -1)
+            bound = channels.abs().max(dim=1).values / 254 + 1e-6
+            error = (restored[k].float() - v.float()).reshape(channels.shape).abs()
+            # and the dequantized values are rounded again to the original dtype
+            bound = bound[:, None] + channels.abs() * torch.finfo(v.dtype).eps
+            assert (error <= bound).all()
+        else:
+            assert loaded[k].dtype == getattr(torch, store_dtype)
+            assert torch.allclose(restored[k].float(), v.float(), rtol=1e-2, atol=1e-2)
+
+
+def test_bfloat16_model(writer_stock, monkeypatch):
+    state_dict = {"weight": torch.randn(3, 4).bfloat16(), "step": torch.tensor(3)}
+    writer_stock.model["model"] = state_dict
+    writer_stock.model.save("quantized", state_dict, store_dtype="int8-per-channel")
+    loaded = writer_stock.model["model"]
+    assert loaded["weight"].dtype == torch.bfloat16
+    assert torch.equal(loaded["weight"], state_dict["weight"])
+    assert writer_stock.model["quantized"]["weight"].dtype == torch.bfloat16
+
+    # saving again in full precision drops the quantization metadata
+    writer_stock.model["quantized"] = state_dict
+    assert torch.equal(writer_stock.model["quantized"]["weight"], state_dict["weight"])
+    with pytest.raises(ValueError):
+        writer_stock.model.save("model", state_dict, store_dtype="int4")
+
+    writer_stock.model.declare("declared", state_dict, store_dtype="float16")
+    monkeypatch.setattr(index, "clean_create_column", pytest.fail)
+    writer_stock.model.save("declared", state_dict, store_dtype="float16")
+
+
+def test_open_model(writer_stock, monkeypatch, layout_kwargs):
+    state_dict = get_model().state_dict()
+    state_dict["1.step"] = torch.tensor(7)
+    writer_stock.model.save("model", state_dict, store_dtype="float16", **layout_kwargs)
+    writer_stock.commit("adding model")
+
+    reads = []
+    read_layer = type(writer_stock.model)._read_layer
+    monkeypatch.setattr(
+        type(writer_stock.model),
+        "_read_layer",
+        lambda self, meta, i, *args: reads.append(i)
+        or read_layer(self, meta, i, *args),
+    )
+    view = writer_stock.model.open("model")
+    assert list(view) == list(state_dict)
+    assert "0.weight" in view and "0.missing" not in view
+    assert view.shapes == {k: tuple(v.shape) for k, v in state_dict.items()}
+    assert view.dtypes["0.weight"] == "float16" and view.dtypes["1.step"] == "int64"
+    restored = writer_stock.model.open("model", restore_dtype=True)
+    assert restored.dtypes["0.weight"] == "float32"
+    assert reads == []
+
+    bias = view["2.bias"]
+    assert bias.dtype == torch.float16
+    assert torch.allclose(bias.float(), state_dict["2.bias"], atol=1e-3)
+    assert reads == [3]
+    encoder = restored.select("0.")
+    assert list(encoder) == ["0.weight", "0.bias"]
+    assert torch.allclose(encoder["0.weight"], state_dict["0.weight"], atol=1e-3)
+    assert reads == [3, 0, 1]
+    loaded = writer_stock.model.load("model")
+    assert all(torch.equal(loaded[k], view[k]) for k in state_dict)
+    with pytest.raises(KeyError):
+        view["0.missing"]
+    with pytest.raises(KeyError):
+        writer_stock.model.open("missing")
@@ -1,9 +1,13 @@
+import threading
 from pathlib import Path
 
 import hangar
 import hangar.checkout
+import numpy as np
 import pytest
-from stockroom import init_repo
+import stockroom.storages.model as model_storage
+import torch
+from stockroom import StockRoom, init_repo
 
 
 class TestInit:
@@ -75,3 +79,210 @@ def test_hangar_checkout_from_stock_obj(writer_stock):
     co.close()
     with pytest.raises(PermissionError):
         writer_stock.experiment["key1"] = "value"
+
+
+def test_enable_write_session(reader_stock):
+    reader_stock.close()
+    stock = StockRoom()
+    reader, data = stock.accessor, stock.data
+    with stock.enable_write():
+        assert isinstance(stock.accessor, hangar.checkout.WriterCheckout)
+        assert stock.data is data
+    # nothing to commit, the same read checkout is used again
+    assert stock.accessor is reader
+
+    with stock.enable_write(keep_writer=True):
+        writer = stock.accessor
+        stock.experiment["lr"] = 0.01
+    assert stock.accessor is not reader
+    assert stock.accessor.commit_hash == stock.head
+    assert stock.experiment["lr"] == 0.01
+    with stock.enable_write():
+        assert stock.accessor is writer
+        stock.experiment["lr"] = 0.1
+    assert stock.experiment["lr"] == 0.1
+    # writer is released
+    StockRoom(enable_write=True).close()
+    stock.close()
+    stock._repo._env._close_environments()
+
+
+def test_update_head(reader_stock):
+    reader_stock.close()
+    stock = StockRoom()
+    reader = stock.accessor
+    assert stock.update_head() is False
+    assert stock.accessor is reader
+
+    writer = StockRoom(enable_write=True)
+    writer.experiment["lr"] = 0.01
+    digest = writer.commit("lr", update_head=False)
+    writer.close()
+    assert stock.update_head() is True
+    assert stock.head == digest
+    assert stock.accessor is not reader
+    assert stock.experiment["lr"] == 0.01
+    stock.close()
+    stock._repo._env._close_environments()
+
+
+def test_auto_refresh(reader_stock, monkeypatch):
+    reader_stock.close()
+    clock = [0.0]
+    monkeypatch.setattr("stockroom.core.time.monotonic", lambda: clock[0])
+    stock = StockRoom(auto_refresh=True, refresh_interval=10)
+    head = stock.head
+    writer = StockRoom(enable_write=True)
+    writer.experiment["epochs"] = 5
+    digest = writer.commit("epochs", update_head=False)
+    writer.close()
+    # polled at most once every refresh_interval
+    clock[0] = 5.0
+    assert stock.head == head
+    with pytest.raises(KeyError):
+        stock.experiment["epochs"]
+    clock[0] = 10.0
+    assert stock.experiment["epochs"] == 5
+    assert stock.head == digest
+    stock.close()
+    stock._repo._env._close_environments()
+
+
+def test_handles_across_refresh(writer_stock):
+    writer_stock.data["ndcol"][1] = np.zeros((4, 5), dtype=np.int64)
+    writer_stock.model["model"] = {"weight": torch.ones(2, 3)}
+    writer_stock.commit("model")
+    writer_stock.close()
+    stock = StockRoom()
+    view = stock.model.open("model")
+    col = stock.data["ndcol"]
+    writer = StockRoom(enable_write=True)
+    writer.data["ndcol"][1] = np.ones((4, 5), dtype=np.int64)
+    writer.model["model"] = {"weight": torch.zeros(2, 3)}
+    writer.commit("new weights", update_head=False)
+    writer.close()
+    assert stock.update_head() is True
+    # stale handles raise instead of reading the new commit with the old metadata
+    with pytest.raises(PermissionError, match="Open it again"):
+        view["weight"]
+    with pytest.raises(PermissionError):
+        col[1]
+    assert torch.equal(stock.model.open("model")["weight"], torch.zeros(2, 3))
+    assert stock.data["ndcol"][1].tolist() == np.ones((4, 5)).tolist()
+    stock.close()
+    stock._repo._env._close_environments()
+
+
+def test_commit_async(writer_stock, caplog):
+    model = torch.nn.Linear(2, 3)
+    expected = model.weight.detach().clone()
+    writer_stock.experiment.log(0, loss=1.0)
+    future = writer_stock.commit_async(
+        "checkpoint", models={"model": model.state_dict()}, tags={"lr": 0.1}
+    )
+    # the snapshot is taken right away
+    with torch.no_grad():
+        model.weight.add_(1.0)
+    digest = future.result()
+    assert writer_stock.accessor.log(return_contents=True)["head"] == digest
+    assert writer_stock.experiment["lr"] == 0.1
+    assert writer_stock.experiment.series("loss")[1].tolist() == [1.0]
+    loaded = writer_stock.model["model"]
+    assert torch.equal(loaded["weight"], expected)
+
+    with pytest.raises(TypeError):
+        writer_stock.commit_async("invalid", tags={"wrongdata": b"hi"})
+    with pytest.raises(RuntimeError):
+        # nothing to commit
+        writer_stock.commit_async("empty").result()
+    # failures are logged, for callers that drop the future
+    writer_stock.commit_async("empty again")
+    # done callbacks run in the commit thread, before it picks up the next job
+    writer_stock._commit_executor.submit(lambda: None).result()
+    assert [r.message for r in caplog.records].count("Asynchronous commit failed") == 2
+
+
+def test_commit_async_prepares_without_lock(writer_stock, monkeypatch):
+    preparing, release = threading.Event(), threading.Event()
+    original = model_storage.layer_digest
+
+    def slow_digest(array):
+        preparing.set()
+        assert release.wait(5)
+        return original(array)
+
+    monkeypatch.setattr(model_storage, "layer_digest", slow_digest)
+    model = torch.nn.Linear(2, 3)
+    future = writer_stock.commit_async(
+        "checkpoint", models={"model": model.state_dict()}
+    )
+    assert preparing.wait(5)
+    # would wait for the commit if the lock were held while hashing the layers
+    writer_stock.experiment["lr"] = 0.1
+    writer_stock.experiment.log(0, loss=1.0)
+    release.set()
+    future.result()
+    assert writer_stock.model.keys() == ("model",)
+
+
+def test_data_writes_wait_for_async_commit(writer_stock, monkeypatch):
+    committing, release = threading.Event(), threading.Event()
+    original = type(writer_stock.data)._update_stats
+
+    def slow_update_stats(self):
+        # runs under the write lock, right before the commit
+        committing.set()
+        assert release.wait(5)
+        return original(self)
+
+    monkeypatch.setattr(type(writer_stock.data), "_update_stats", slow_update_stats)
+    col = writer_stock.data["ndcol"]
+    writer_stock.experiment["lr"] = 0.1
+    future = writer_stock.commit_async("tags")
+    assert committing.wait(5)
+    arr = np.ones((4, 5), dtype=np.int64)
+    writes = [
+        lambda: writer_stock.data.__setitem__(("ndcol", 1), arr),
+        lambda: col.__setitem__(2, arr),
+        lambda: col.update({3: arr}),
+    ]
+    threads = [threading.Thread(target=write) for write in writes]
+    for thread in threads:
+        thread.start()
+    threads[-1].join(0.2)
+    assert all(thread.is_alive() for thread in threads)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    future.result()
+    # made after the commit, into the staging area
+    assert sorted(writer_stock.data["ndcol"].keys()) == [1, 2, 3]
+    writer_stock.commit("data")
+
+
+def test_commit_async_backpressure(writer_stock, monkeypatch):
+    writer_stock._commit_slots = threading.BoundedSemaphore(1)
+    release = threading.Event()
+    original = StockRoom._commit
+
+    def slow_commit(self, writer, message):
+        release.wait(5)
+        return original(self, writer, message)
+
+    monkeypatch.setattr(StockRoom, "_commit", slow_commit)
+    first = writer_stock.commit_async("first", tags={"a": 1})
+    submitted = []
+    thread = threading.Thread(
+        target=lambda: submitted.append(
+            writer_stock.commit_async("second", tags={"b": 2})
+        )
+    )
+    thread.start()
+    thread.join(0.2)
+    # blocked until the first commit is done
+    assert thread.is_alive() and not submitted
+    release.set()
+    thread.join(5)
+    writer_stock.wait_commits()
+    assert first.result() != submitted[0].result()
+    assert writer_stock.experiment.keys() == ("a", "b")
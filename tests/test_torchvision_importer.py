@@ -3,14 +3,18 @@ import pytest
 import stockroom.cli as cli
 from click.testing import CliRunner
 from stockroom import StockRoom
+import stockroom.external.importer.utils as importer_utils
+from stockroom.external.importer.base import BaseImporter
+from stockroom.external.importer.utils import importers_dict, iter_chunks
 
 
 @pytest.mark.parametrize(
     "dataset, splits, columns", [("cifar10", ["test", "train"], ["image", "label"])]
 )
-def test_import_cifar(repo, torchvision_datasets, dataset, splits, columns):
+@pytest.mark.parametrize("workers", ["0", "2"])
+def test_import_cifar(repo, torchvision_datasets, dataset, splits, columns, workers):
     runner = CliRunner()
-    res = runner.invoke(cli.import_data, [f"torchvision.{dataset}"])
+    res = runner.invoke(cli.import_data, [f"torchvision.{dataset}", "-w", workers])
     assert res.exit_code == 0
 
     keys = [f"{dataset}-{split}-{column}" for split in splits for column in columns]
@@ -20,6 +24,46 @@ def test_import_cifar(repo, torchvision_datasets, dataset, splits, columns):
     assert stock.data[f"{dataset}-train-image"][0].shape == (3, 32, 32)
     assert stock.data[f"{dataset}-test-label"][0].shape == tuple()
     assert stock.data[f"{dataset}-train-image"][0].dtype == np.float32
+    assert len(stock.data[f"{dataset}-train-image"]) == 3
+    assert stock.data[f"{dataset}-train-label"][2] == 2
+
+
+@pytest.mark.parametrize("dataset", ["cifar10", "mnist", "fashion_mnist"])
+def test_batches_match_samples(torchvision_datasets, dataset):
+    importer = importers_dict["torchvision"][dataset].gen_splits(None)[0]
+    batches = list(importer.iter_batches(2))
+    assert sum(len(batch[0]) for batch in batches) == len(importer)
+    images = [img for batch in batches for img in batch[0]]
+    labels = [lbl for batch in batches for lbl in batch[1]]
+    for i, (img, lbl) in enumerate(importer):
+        assert np.array_equal(images[i], img)
+        assert images[i].dtype == np.float32
+        assert labels[i] == lbl
+
+
+@pytest.mark.parametrize("dataset", ["cifar10", "mnist", "fashion_mnist"])
+def test_batches_are_vectorized(torchvision_datasets, monkeypatch, dataset):
+    importer = importers_dict["torchvision"][dataset].gen_splits(None)[0]
+    # the sample by sample fallback is never taken for in-memory datasets
+    monkeypatch.setattr(BaseImporter, "get_batch", pytest.fail)
+    images, labels = importer.get_batch(0, 2)
+    assert isinstance(images, np.ndarray) and images.dtype == np.float32
+    assert images.shape == (2, *importer.shapes()[0])
+    assert len(labels) == 2
+    assert sum(len(batch[0]) for batch in importer.iter_batches(2)) == len(importer)
+
+
+@pytest.mark.parametrize("initializer", [True, False])
+def test_parallel_chunks(torchvision_datasets, monkeypatch, initializer):
+    # python 3.6 has no pool initializer, the workers inherit the importer instead
+    monkeypatch.setattr(importer_utils, "_POOL_INITIALIZER", initializer)
+    importer = importers_dict["torchvision"]["cifar10"].gen_splits(None)[0]
+    serial = list(iter_chunks(importer, 2))
+    parallel = list(iter_chunks(importer, 2, workers=2))
+    assert len(parallel) == len(serial)
+    for expected, chunk in zip(serial, parallel):
+        assert all(np.array_equal(x, y) for x, y in zip(expected, chunk))
+    assert importer_utils._worker_importer is None
 
 
 @pytest.mark.parametrize(
@@ -20,3 +20,35 @@ def test_get_stock_root(repo):
     path = Path("/down/the/rabbit/hole")
     with pytest.raises(RuntimeError):
         utils.get_stock_root(path)
+
+
+@pytest.mark.parametrize("missing", ["torch", "torch.utils", "hangar", "rich.table"])
+def test_lazy_import_errors(monkeypatch, missing):
+    import importlib
+
+    import stockroom
+
+    def import_module(name):
+        raise ModuleNotFoundError(f"No module named '{missing}'", name=missing)
+
+    monkeypatch.delitem(vars(stockroom), "StockDataset", raising=False)
+    monkeypatch.setattr(importlib, "import_module", import_module)
+    if missing.startswith("torch"):
+        with pytest.raises(AttributeError, match="requires torch"):
+            stockroom.StockDataset
+    else:
+        with pytest.raises(ModuleNotFoundError):
+            stockroom.StockDataset
+
+
+def test_layer_digest():
+    import hashlib
+
+    import numpy as np
+
+    arr = np.arange(6, dtype=np.float32)
+    expected = hashlib.blake2b(arr.tobytes() + b"<f4(6,)", digest_size=20)
+    assert utils.layer_digest(arr) == expected.hexdigest()
+    # same bytes, different dtype or shape
+    assert utils.layer_digest(arr.view(np.int32)) != utils.layer_digest(arr)
+    assert utils.layer_digest(arr.reshape(2, 3)) != utils.layer_digest(arr)
@@ -12,29 +12,30 @@ class Torchvision:
 
 class CIFAR10(Torchvision):
     def __init__(self, root, train, download):
-        pass
+        self.data = np.random.randint(0, 256, (3, 32, 32, 3), dtype=np.uint8)
+        self.targets = [0, 1, 2]
+
+    def __len__(self):
+        return len(self.data)
 
     def __getitem__(self, index):
-        img = np.random.random((32, 32, 3)).astype(np.uint8)
-        return Image.fromarray(img), index
+        return Image.fromarray(self.data[index]), self.targets[index]
 
 
 class MNIST(Torchvision):
     def __init__(self, root, train, download):
-        pass
+        self.data = np.random.randint(0, 256, (3, 28, 28), dtype=np.uint8)
+        self.targets = np.zeros(3, dtype=np.int64)
 
-    def __getitem__(self, index):
-        img = np.random.random((28, 28)).astype(np.uint8)
-        return Image.fromarray(img), 0
+    def __len__(self):
+        return len(self.data)
 
+    def __getitem__(self, index):
+        return Image.fromarray(self.data[index]), int(self.targets[index])
 
-class FashionMNIST(Torchvision):
-    def __init__(self, root, train, download):
-        pass
 
-    def __getitem__(self, index):
-        img = np.random.random((28, 28)).astype(np.uint8)
-        return Image.fromarray(img), 0
+class FashionMNIST(MNIST):
+    pass
 
 
 class VOCSegmentation(Torchvision):